@@ -0,0 +1,177 @@
+# Замер точности секвенсера по темпам и размерам города (--bench)
+import csv
+import time
+
+import numpy as np
+
+from rhytm_city import (BENCH_BARS, BENCH_OVERSLEEP, BENCH_STALL, BENCH_TICK, BUILDING_TYPES,
+                        CITY_COLS, CITY_ROWS, STEPS_PER_BAR, STEPS_PER_BEAT, Game)
+
+
+def fill_city(game, count):
+    # Заполняет город count зданиями всех типов по очереди (для замеров)
+    game.clear_city()
+    side = max(1, int(np.ceil(np.sqrt(count))))
+    for i in range(count):
+        game.add_building(i % side, i // side, BUILDING_TYPES[i % len(BUILDING_TYPES)])
+
+
+def bench_scheduler(game, bpm, bars=BENCH_BARS, rng=None,
+                    oversleep=BENCH_OVERSLEEP, stall_rate=0.0):
+    """
+    Прогоняет планировщик секвенсера вместе с play_step по фиктивным часам:
+    крутится сам Sequencer.run_scheduler, а его часы, сон и sleep(0)
+    подменены. Каждое пробуждение опаздывает на случайное время
+    (экспоненциальное со средним oversleep), с вероятностью stall_rate -
+    ещё на BENCH_STALL. Время работы pump() и play_step() меряется
+    настоящими часами и прибавляется к фиктивным, поэтому размер города на
+    результат влияет, а разброс ОС - нет.
+    Возвращает строку таблицы: ошибки начала шага, дрейф за прогон,
+    пропущенные и слипшиеся шаги (сыгранные одним pump вслед за другим).
+    """
+    if rng is None:
+        rng = np.random.default_rng(0)
+
+    sequencer = game.sequencer
+    sequencer.stop()
+    game.set_bpm(bpm)
+    game.timeline.refresh()
+    step_time = 60.0 / bpm / STEPS_PER_BEAT
+    total = bars * STEPS_PER_BAR
+
+    fired = []  # (номер шага, должен был прозвучать, прозвучал, номер pump)
+    pump_start = [0.0, 0.0, -1]  # фиктивное и настоящее время начала pump, номер
+    pump_cost = [0.0]
+
+    def clock():
+        # run_scheduler берёт время раз за pump - тут pump и начинается
+        pump_start[:] = sequencer.virtual_time, time.perf_counter(), pump_start[2] + 1
+        return sequencer.virtual_time
+
+    def sleep(seconds):
+        # Сон планировщика: фиктивные часы идут на время pump, сон и опоздание
+        now, started, _ = pump_start
+        cost = time.perf_counter() - started
+        pump_cost[0] += cost
+        late = rng.exponential(oversleep) if oversleep > 0 else 0.0
+        if stall_rate and rng.random() < stall_rate:
+            late += BENCH_STALL
+        sequencer.virtual_time = now + cost + seconds + max(late, BENCH_TICK)
+
+    def on_step(step, bar, due, triggers, tick):
+        now, started, pump_index = pump_start
+        if tick == 0:
+            fired.append((bar * STEPS_PER_BAR + step, due,
+                          now + time.perf_counter() - started, pump_index))
+        game.play_step(step, bar, due, triggers, tick)
+
+    sequencer.on_step = on_step
+    sequencer.start()
+    start_time = sequencer.anchor_time
+    missed_before = sequencer.missed_steps
+    steps_before = sequencer.steps_done
+
+    real_clock = sequencer.clock
+    sequencer.clock = clock
+    try:
+        sequencer.run_scheduler(wait=sleep, sleep=sleep,
+                                running=lambda: sequencer.steps_done - steps_before < total)
+    finally:
+        sequencer.clock = real_clock
+        sequencer.stop()
+        sequencer.on_step = None
+    pumps = pump_start[2] + 1
+
+    index = np.array([item[0] for item in fired], dtype=np.int64)
+    due = np.array([item[1] for item in fired])
+    played = np.array([item[2] for item in fired])
+    pump_ids = np.array([item[3] for item in fired])
+
+    error = (played - due) * 1000.0
+    # Дрейф - насколько шаги последнего такта уехали от идеальной сетки
+    # по сравнению с первым (идеальная сетка считается от старта, без якорей)
+    ideal = start_time + index * step_time
+    offset = (played - ideal) * 1000.0
+    first = offset[index < STEPS_PER_BAR]
+    last = offset[index >= (bars - 1) * STEPS_PER_BAR]
+    drift = (last.mean() - first.mean()) if len(first) and len(last) else 0.0
+
+    return {
+        "bpm": bpm,
+        "buildings": len(game.buildings),
+        "steps": total,
+        "mean_ms": round(float(error.mean()), 3) if len(error) else None,
+        "p50_ms": round(float(np.percentile(error, 50)), 3) if len(error) else None,
+        "p99_ms": round(float(np.percentile(error, 99)), 3) if len(error) else None,
+        "max_ms": round(float(error.max()), 3) if len(error) else None,
+        "drift_ms": round(float(drift), 3),
+        "missed": round((sequencer.missed_steps - missed_before) / total, 4),
+        "collapsed": round(int(np.count_nonzero(pump_ids[1:] == pump_ids[:-1])) / total, 4),
+        "pump_ms": round(pump_cost[0] / max(pumps, 1) * 1000.0, 3),
+    }
+
+
+BENCH_COLUMNS = ("bpm", "buildings", "steps", "mean_ms", "p50_ms", "p99_ms",
+                 "max_ms", "drift_ms", "missed", "collapsed", "pump_ms")
+
+
+def read_bench(path):
+    # Читает таблицу прошлого замера: (bpm, зданий) -> строка
+    with open(path, newline="", encoding="utf-8") as f:
+        return {(int(row["bpm"]), int(row["buildings"])): row for row in csv.DictReader(f)}
+
+
+def print_bench(rows, baseline=None):
+    """
+    Печатает таблицу замера. Если есть baseline (прошлый замер),
+    рядом с p99 и долей пропусков печатается разница с ним.
+    """
+    columns = list(BENCH_COLUMNS)
+    if baseline:
+        columns[columns.index("p99_ms") + 1:columns.index("p99_ms") + 1] = ["Δp99"]
+        columns.append("Δmissed")
+
+    lines = []
+    for row in rows:
+        line = dict(row)
+        old = baseline.get((row["bpm"], row["buildings"])) if baseline else None
+        if old:
+            if row["p99_ms"] is not None and old["p99_ms"]:
+                line["Δp99"] = f"{row['p99_ms'] - float(old['p99_ms']):+.3f}"
+            line["Δmissed"] = f"{row['missed'] - float(old['missed']):+.4f}"
+        lines.append([str(line.get(name, "-")) for name in columns])
+
+    widths = [max(len(name), *(len(line[i]) for line in lines)) if lines else len(name)
+              for i, name in enumerate(columns)]
+    print("  ".join(name.rjust(width) for name, width in zip(columns, widths)))
+    for line in lines:
+        print("  ".join(cell.rjust(width) for cell, width in zip(line, widths)))
+
+
+def run_benchmark(bpms, sizes, bars, out_path, compare_path=None,
+                  oversleep=BENCH_OVERSLEEP, stall_rate=0.0, seed=0):
+    """
+    Замер точности секвенсера: все темпы для каждого размера города.
+    Таблица пишется в CSV, чтобы сравнивать с ней следующие замеры
+    (--bench-compare).
+    """
+    side = max(1, int(np.ceil(np.sqrt(max(sizes)))))
+    game = Game(headless=True, city_size=(max(side, CITY_COLS), max(side, CITY_ROWS)))
+    rng = np.random.default_rng(seed)
+    baseline = read_bench(compare_path) if compare_path else None
+
+    rows = []
+    for count in sizes:
+        fill_city(game, count)
+        for bpm in bpms:
+            rows.append(bench_scheduler(game, bpm, bars, rng, oversleep, stall_rate))
+            print(f"  {count} зданий, {bpm} BPM: p99 {rows[-1]['p99_ms']} мс")
+
+    with open(out_path, "w", newline="", encoding="utf-8") as f:
+        writer = csv.DictWriter(f, fieldnames=BENCH_COLUMNS)
+        writer.writeheader()
+        writer.writerows(rows)
+
+    print()
+    print_bench(rows, baseline)
+    print(f"Таблица: {out_path}")
@@ -0,0 +1,252 @@
+# Экран калибровки звука: буфер, каналы и задержка вывода (--calibrate)
+import threading
+import time
+
+import numpy as np
+import pygame
+
+from rhytm_city import (AUDIO_CHUNK, CALIBRATE_BPM, CALIBRATE_BUFFERS, CALIBRATE_CHANNELS,
+                        CALIBRATE_FEED, CALIBRATE_FREQUENCIES, CALIBRATE_PROBES, CALIBRATE_SKIP,
+                        CALIBRATE_TAPS, COLOR_BG, COLOR_TEXT, FPS, MAX_LATENCY, MIXER_DEFAULTS,
+                        WINDOW_HEIGHT, WINDOW_WIDTH, float_to_pcm, save_mixer_config)
+
+
+class Calibration:
+    """
+    Экран калибровки звука (--calibrate). Петля выход-вход не нужна:
+
+    1. Для каждой частоты, буфера и числа каналов (CALIBRATE_CHANNELS)
+       микшер поднимается заново. Задержку выдаёт сам микшер: щелчок
+       играется на канале с end-событием, а событие шлёт колбэк, когда
+       доиграл последний кусок щелчка - сколько оно опоздало против длины
+       щелчка, плюс один буфер до выхода.
+       Пропуски считаются, как в шине: поток кормит канал кусками по
+       AUDIO_CHUNK, пока главный рисует, и отмечает, когда канал замолк.
+    2. Из настроек без пропусков берётся самая быстрая, и игрок стучит
+       ПРОБЕЛОМ под щелчки: среднее опоздание ударов - слышимая задержка
+       (ESC - взять оценку по колбэку).
+
+    Итог пишется в файл настроек, его читает Game при запуске.
+    """
+
+    def __init__(self, config_path):
+        self.config_path = config_path
+        pygame.display.init()
+        pygame.font.init()
+        self.screen = pygame.display.set_mode((WINDOW_WIDTH, WINDOW_HEIGHT))
+        pygame.display.set_caption("Ритм-город: калибровка звука")
+        self.font = pygame.font.Font(None, 28)
+        self.font_small = pygame.font.Font(None, 22)
+        self.end_event = pygame.USEREVENT + 1
+        self.running = True
+        self.next_draw = 0.0
+
+        self.results = []  # Замер каждой настройки (словари как в файле)
+        self.status = ""
+        self.ended = []  # Когда пришли end-события канала
+        self.taps = []  # Опоздания ударов игрока относительно щелчков, с
+        self.estimate = None  # Задержка по колбэку для выбранной настройки
+
+    def frame(self):
+        """
+        События окна и кадр (не чаще FPS). Время событий берётся сразу при
+        разборе, до отрисовки. Возвращает нажатые клавиши: (клавиша, время).
+        """
+        keys = []
+        for event in pygame.event.get():
+            now = time.perf_counter()
+            if event.type == pygame.QUIT:
+                self.running = False
+            elif event.type == self.end_event:
+                self.ended.append(now)
+            elif event.type == pygame.KEYDOWN:
+                keys.append((event.key, now))
+
+        now = time.perf_counter()
+        if now >= self.next_draw:
+            self.next_draw = now + 1.0 / FPS
+            self.draw()
+        return keys
+
+    def wait(self, seconds):
+        # Пауза, во время которой окно живёт
+        deadline = time.perf_counter() + seconds
+        while self.running and time.perf_counter() < deadline:
+            self.frame()
+            time.sleep(0.001)
+
+    def click(self):
+        # Короткий щелчок в формате текущего микшера
+        rate, _, channels = pygame.mixer.get_init()
+        t = np.arange(int(rate * 0.01)) / rate
+        wave = np.sin(2 * np.pi * 1500 * t) * np.exp(-t * 400) * 0.8
+        if channels > 1:
+            wave = np.repeat(wave[:, None], channels, axis=1)
+        return pygame.sndarray.make_sound(float_to_pcm(wave))
+
+    def measure(self, frequency, buffer, channels=MIXER_DEFAULTS["channels"]):
+        """Поднимает микшер с этими настройками, замеряет задержку и пропуски."""
+        pygame.mixer.quit()
+        pygame.mixer.init(frequency=frequency, size=-16, channels=channels, buffer=buffer)
+        rate, _, channels = pygame.mixer.get_init()
+        result = {"frequency": rate, "buffer": buffer, "channels": channels,
+                  "latency": None, "underruns": 0.0}
+        self.results.append(result)
+
+        # Задержка колбэка: когда доиграл щелчок против его длины
+        self.status = f"{rate} Гц, буфер {buffer}, каналов {channels}: задержка..."
+        click = self.click()
+        length = click.get_length()
+        channel = pygame.mixer.Channel(0)
+        channel.set_endevent(self.end_event)
+        delays = []
+        for _ in range(CALIBRATE_PROBES):
+            self.ended = []
+            started = time.perf_counter()
+            channel.play(click)
+            while self.running and not self.ended and time.perf_counter() - started < 0.5:
+                self.frame()
+                time.sleep(0.0005)
+            if self.ended:
+                delays.append(max(self.ended[0] - started - length, 0.0))
+            self.wait(0.02)
+        channel.set_endevent()
+        if delays:
+            result["latency"] = float(np.median(delays)) + buffer / rate
+
+        # Пропуски: поток кормит канал кусками, главный в это время рисует
+        self.status = f"{rate} Гц, буфер {buffer}, каналов {channels}: пропуски..."
+        silence = np.zeros((AUDIO_CHUNK, channels) if channels > 1 else AUDIO_CHUNK)
+        underruns = [0]
+        feeding = [True]
+
+        def feed():
+            played = False
+            while feeding[0]:
+                if channel.get_queue() is None:
+                    sound = pygame.sndarray.make_sound(float_to_pcm(silence))
+                    if channel.get_busy():
+                        channel.queue(sound)
+                    else:
+                        underruns[0] += played
+                        channel.play(sound)
+                        played = True
+                time.sleep(0.002)
+
+        thread = threading.Thread(target=feed, name="calibrate-feed", daemon=True)
+        thread.start()
+        self.wait(CALIBRATE_FEED)
+        feeding[0] = False
+        thread.join()
+        channel.stop()
+        result["underruns"] = underruns[0] / CALIBRATE_FEED
+        return result
+
+    def choose(self):
+        # Самая быстрая настройка без пропусков (или с наименьшими)
+        measured = [result for result in self.results if result["latency"] is not None]
+        if not measured:
+            return dict(MIXER_DEFAULTS)
+        return min(measured, key=lambda result: (result["underruns"], result["latency"]))
+
+    def tap_test(self, best):
+        """
+        Щелчки на CALIBRATE_BPM, игрок стучит пробелом. Экран ударов не
+        показывает, чтобы стучали на слух. Возвращает медиану опозданий
+        (None - ESC или окно закрыли).
+        """
+        pygame.mixer.quit()
+        pygame.mixer.init(frequency=best["frequency"], size=-16, channels=best["channels"],
+                          buffer=best["buffer"])
+        click = self.click()
+        channel = pygame.mixer.Channel(0)
+        beat = 60.0 / CALIBRATE_BPM
+        self.taps = []
+        self.status = "Стучите ПРОБЕЛОМ в такт щелчкам (ESC - пропустить)"
+
+        fired = []  # Когда запущены щелчки
+        next_click = time.perf_counter() + 1.0
+        while self.running and len(self.taps) < CALIBRATE_TAPS:
+            now = time.perf_counter()
+            if now >= next_click:
+                channel.play(click)
+                fired.append(next_click)
+                next_click += beat
+            for key, when in self.frame():
+                if key == pygame.K_ESCAPE:
+                    return None
+                if key == pygame.K_SPACE and fired:
+                    # Удар мог и опередить щелчок - берём ближайший
+                    nearest = min(fired[-2:] + [next_click], key=lambda t: abs(when - t))
+                    self.taps.append(when - nearest)
+            time.sleep(0.0005)
+
+        if len(self.taps) < CALIBRATE_TAPS:
+            return None
+        return float(np.median(self.taps[CALIBRATE_SKIP:]))
+
+    def draw(self):
+        self.screen.fill(COLOR_BG)
+        y = 40
+        title = self.font.render("Калибровка звука", True, COLOR_TEXT)
+        self.screen.blit(title, (40, y))
+        y += 50
+        for result in self.results:
+            latency = "..." if result["latency"] is None else f"{result['latency'] * 1000:5.1f} мс"
+            line = (f"{result['frequency']} Гц  буфер {result['buffer']:4d}  "
+                    f"каналов {result['channels']}:  задержка {latency}  "
+                    f"пропуски {result['underruns']:.1f}/с")
+            self.screen.blit(self.font_small.render(line, True, COLOR_TEXT), (40, y))
+            y += 26
+        y += 20
+        self.screen.blit(self.font.render(self.status, True, COLOR_TEXT), (40, y))
+        if self.taps:
+            y += 36
+            line = f"Ударов: {len(self.taps)}/{CALIBRATE_TAPS}"
+            counted = self.taps[CALIBRATE_SKIP:]
+            if counted:
+                line += f"  опоздание {np.median(counted) * 1000:.0f} мс"
+            self.screen.blit(self.font_small.render(line, True, COLOR_TEXT), (40, y))
+        pygame.display.flip()
+
+    def run(self):
+        """Замер всех настроек, проверка на слух, запись файла."""
+        for frequency in CALIBRATE_FREQUENCIES:
+            for buffer in CALIBRATE_BUFFERS:
+                for channels in CALIBRATE_CHANNELS:
+                    if self.running:
+                        self.measure(frequency, buffer, channels)
+        if not self.running:
+            pygame.quit()
+            return None
+
+        best = self.choose()
+        self.estimate = best["latency"]
+        tapped = self.tap_test(best)
+        latency = self.estimate if tapped is None else tapped
+        config = {
+            "frequency": best["frequency"],
+            "buffer": best["buffer"],
+            "channels": best["channels"],
+            "latency": round(min(max(latency, 0.0), MAX_LATENCY), 4),
+            "callback_latency": self.estimate,
+            "tapped_latency": tapped,
+            "measured": self.results,
+        }
+        save_mixer_config(self.config_path, config)
+
+        print("Частота  Буфер  Каналов  Задержка, мс  Пропуски/с")
+        for result in self.results:
+            latency = "-" if result["latency"] is None else f"{result['latency'] * 1000:.1f}"
+            print(f"{result['frequency']:7d}  {result['buffer']:5d}  {result['channels']:7d}  "
+                  f"{latency:>12}  {result['underruns']:10.1f}")
+        source = "по ударам" if tapped is not None else "по колбэку микшера"
+        print(f"Выбрано: {config['frequency']} Гц, буфер {config['buffer']}, "
+              f"каналов {config['channels']}, задержка {config['latency'] * 1000:.0f} мс ({source})")
+        print(f"Сохранено в {self.config_path}")
+
+        self.status = f"Сохранено: задержка {config['latency'] * 1000:.0f} мс. Любая клавиша - выход"
+        while self.running and not self.frame():
+            time.sleep(0.01)
+        pygame.quit()
+        return config
@@ -0,0 +1,244 @@
+# Запись проигрывания города без окна: GIF, MP4 или кадры PNG (--capture)
+import os
+import shutil
+import struct
+import subprocess
+import time
+from collections import deque
+from multiprocessing import Pool
+
+import numpy as np
+import pygame
+
+from rhytm_city import (CAPTURE_AHEAD, CAPTURE_FPS, CAPTURE_SECONDS, GIF_FREQUENT, Game,
+                        render_song, write_wav)
+
+
+def gif_palette(frame):
+    """
+    Палитра GIF для записи: GIF_FREQUENT самых частых цветов первого кадра
+    (фон, сетка, панели рисуются ровными цветами) и равномерная сетка
+    4x8x4 на всё остальное. Возвращает (палитра 256x3, таблица 32x32x32:
+    цвет с точностью до 5 бит -> номер ближайшего цвета палитры).
+    """
+    coarse = frame.reshape(-1, 3) >> 3
+    keys = coarse[:, 0].astype(np.int32) << 10 | coarse[:, 1].astype(np.int32) << 5 | coarse[:, 2]
+    counts = np.bincount(keys, minlength=32 ** 3)
+    frequent = np.argsort(counts)[::-1][:GIF_FREQUENT]
+    frequent = frequent[counts[frequent] > 0]
+    levels = np.stack(np.meshgrid(np.linspace(0, 31, 4), np.linspace(0, 31, 8), np.linspace(0, 31, 4),
+                                  indexing="ij"), axis=-1).reshape(-1, 3)
+    colors = np.concatenate([np.stack([frequent >> 10, frequent >> 5 & 31, frequent & 31], axis=1),
+                             np.round(levels)])[:256]
+
+    # Ближайший цвет для каждого из 32768 цветов - по слоям, чтобы не держать 32768x256x3
+    grid = np.stack(np.meshgrid(np.arange(32), np.arange(32), np.arange(32), indexing="ij"),
+                    axis=-1).reshape(-1, 3)
+    lookup = np.empty(len(grid), dtype=np.uint8)
+    for start in range(0, len(grid), 4096):
+        part = grid[start:start + 4096]
+        distance = np.square(part[:, None, :] - colors[None, :, :]).sum(axis=2)
+        lookup[start:start + 4096] = np.argmin(distance, axis=1)
+
+    palette = np.zeros((256, 3), dtype=np.uint8)
+    palette[:len(colors)] = (colors * 255 / 31).round()
+    return palette, lookup.reshape(32, 32, 32)
+
+
+def lzw_encode(indices):
+    """
+    Сжатие LZW по правилам GIF для 8-битных номеров цветов: коды от 9 до 12
+    бит, при заполнении словаря - код очистки. Возвращает данные кадра
+    вместе с размером кода и разбивкой на блоки по 255 байт.
+    """
+    clear, end = 256, 257
+    out = bytearray()
+    bits = 0  # Ещё не записанные биты
+    count = 0
+
+    def emit(code, width):
+        nonlocal bits, count
+        bits |= code << count
+        count += width
+        while count >= 8:
+            out.append(bits & 255)
+            bits >>= 8
+            count -= 8
+
+    data = indices.tobytes()
+    codes = {}
+    next_code = end + 1
+    width = 9
+    emit(clear, width)
+    prefix = data[0]
+    for byte in data[1:]:
+        key = prefix << 8 | byte
+        code = codes.get(key)
+        if code is not None:
+            prefix = code
+            continue
+        emit(prefix, width)
+        if next_code >= 1 << width and width < 12:
+            width += 1
+        if next_code >= 4095:
+            emit(clear, width)
+            codes = {}
+            next_code = end + 1
+            width = 9
+        else:
+            codes[key] = next_code
+            next_code += 1
+        prefix = byte
+    emit(prefix, width)
+    emit(end, width)
+    if count:
+        out.append(bits & 255)
+
+    blocks = bytearray(b"\x08")
+    for start in range(0, len(out), 255):
+        chunk = out[start:start + 255]
+        blocks.append(len(chunk))
+        blocks += chunk
+    blocks.append(0)
+    return bytes(blocks)
+
+
+def gif_frame(job):
+    """
+    Сжимает кусок кадра для GIF (в процессе Pool): job - (x, y, пиксели
+    высота x ширина x 3, таблица цветов из gif_palette). Возвращает
+    описание куска и его данные; задержку кадра дописывает run_capture.
+    """
+    x, y, pixels, lookup = job
+    height, width = pixels.shape[:2]
+    coarse = pixels >> 3
+    indices = lookup[coarse[..., 0], coarse[..., 1], coarse[..., 2]]
+    return b"\x2c" + struct.pack("<4HB", x, y, width, height, 0) + lzw_encode(indices)
+
+
+def png_frame(job):
+    # Пишет кадр в PNG (в процессе Pool): job - (путь, (ширина, высота), пиксели RGB)
+    path, size, pixels = job
+    pygame.image.save(pygame.image.frombuffer(pixels, size, "RGB"), path)
+
+
+def run_capture(path, city_path, seconds=CAPTURE_SECONDS, fps=CAPTURE_FPS, workers=1):
+    """
+    Записывает проигрывание города из файла без окна и быстрее реального
+    времени: часы виртуальные, каждый кадр - update(1/fps) и Game.draw.
+    Кадры рисуются по порядку здесь, а сжимают их процессы Pool.
+    Звук того же отрезка сводит AudioMixer (как шина) в WAV рядом с записью.
+
+    path .gif - анимация GIF (меняющийся кусок кадра поверх прошлого);
+    .mp4 - кадры PNG в папке <имя>_frames, их с WAV сводит ffmpeg, если он
+    есть; иначе path - папка, куда ложатся кадры PNG и audio.wav.
+    """
+    stem, extension = os.path.splitext(path)
+    extension = extension.lower()
+    if extension == ".gif":
+        frames_dir, wav_path = None, stem + ".wav"
+    elif extension == ".mp4":
+        frames_dir, wav_path = stem + "_frames", stem + ".wav"
+    else:
+        frames_dir, wav_path = path, os.path.join(path, "audio.wav")
+
+    # Процессы - до окна, чтобы им не досталось состояние SDL
+    pool = Pool(workers) if workers > 1 else None
+    game = Game(headless=True)
+    if not game.load_city(city_path):
+        if pool:
+            pool.terminate()
+        return
+    if frames_dir:
+        os.makedirs(frames_dir, exist_ok=True)
+
+    started = time.perf_counter()
+    count = max(1, int(round(seconds * fps)))
+    size = game.screen.get_size()
+
+    # Звук: та же партитура и ограничитель, что у шины, с нулевого такта, как и секвенсер
+    rate = pygame.mixer.get_init()[0]
+    game.timeline.refresh()
+    write_wav(wav_path, render_song(game.buildings, game.timeline, game.sequencer.bpm, rate,
+                                    int(count / fps * rate), limit=True), rate)
+
+    game.sequencer.on_step = lambda step, bar, due, triggers, tick: game.show_flash(triggers, tick)
+    game.sequencer.start()
+    game.bars_seen = game.sequencer.bars_done
+
+    gif = None
+    if extension == ".gif":
+        gif = open(path, "wb")
+    waiting = deque()  # (ответ процесса или готовый результат, номер кадра)
+    pending = None  # Для GIF: сжатый кадр и его номер, ждёт следующего
+    lookup = None
+
+    def finish(result, index):
+        # Кадр сжат. В GIF прошлый кадр пишется, когда известен следующий:
+        # задержка кадра - до него
+        nonlocal pending
+        if gif is None:
+            return
+        if pending is not None:
+            data, start = pending
+            delay = round(index * 100 / fps) - round(start * 100 / fps)
+            gif.write(b"\x21\xf9\x04\x04" + struct.pack("<H", delay) + b"\x00\x00" + data)
+        pending = (result, index)
+
+    def collect(limit):
+        while len(waiting) > limit:
+            result, index = waiting.popleft()
+            finish(result.get() if pool else result, index)
+
+    for index in range(count):
+        game.update(1.0 / fps if index else 0.0)
+        dirty = game.draw()
+
+        if gif is None:
+            job = (os.path.join(frames_dir, f"frame_{index:05d}.png"), size,
+                   pygame.image.tobytes(game.screen, "RGB"))
+            waiting.append((pool.apply_async(png_frame, (job,)) if pool else png_frame(job), index))
+        else:
+            # В GIF - только то, что draw перерисовал; кадр без изменений не нужен
+            if not dirty:
+                continue
+            screen = game.screen.get_rect()
+            rect = dirty[0].unionall(dirty[1:]).clip(screen) if lookup is not None else screen
+            pixels = pygame.image.tobytes(game.screen.subsurface(rect), "RGB")
+            pixels = np.frombuffer(pixels, dtype=np.uint8).reshape(rect.height, rect.width, 3)
+            if lookup is None:
+                palette, lookup = gif_palette(pixels)
+                gif.write(b"GIF89a" + struct.pack("<2H3B", size[0], size[1], 0xf7, 0, 0))
+                gif.write(palette.tobytes())
+                gif.write(b"\x21\xff\x0bNETSCAPE2.0\x03\x01\x00\x00\x00")  # Повторять без конца
+            job = (rect.x, rect.y, pixels, lookup)
+            waiting.append((pool.apply_async(gif_frame, (job,)) if pool else gif_frame(job), index))
+        collect(max(1, workers) * CAPTURE_AHEAD)
+
+    collect(0)
+    if pool:
+        pool.close()
+        pool.join()
+    if gif is not None:
+        finish(None, count)
+        gif.write(b"\x3b")
+        gif.close()
+
+    spent = time.perf_counter() - started
+    print(f"Запись: {count} кадров ({count / fps:.1f} с) за {spent:.2f} с, звук - {wav_path}")
+
+    if extension == ".mp4":
+        command = ["ffmpeg", "-y", "-loglevel", "error", "-framerate", str(fps),
+                   "-i", os.path.join(frames_dir, "frame_%05d.png"), "-i", wav_path,
+                   "-c:v", "libx264", "-pix_fmt", "yuv420p", "-c:a", "aac", "-shortest", path]
+        if shutil.which("ffmpeg") is None:
+            print("ffmpeg не найден - свести кадры со звуком можно так:")
+            print("  " + subprocess.list2cmdline(command))
+        elif subprocess.run(command).returncode == 0:
+            print(f"Видео: {path}")
+        else:
+            print(f"ffmpeg не смог записать {path}")
+    elif gif is None:
+        print(f"Кадры: {frames_dir}")
+    else:
+        print(f"GIF: {path}")
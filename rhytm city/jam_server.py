@@ -0,0 +1,130 @@
+# Сервер совместной игры без окна и звука (--jam-server)
+import asyncio
+import time
+
+from rhytm_city import (BEATS_PER_BAR, DEFAULT_BPM, JAM_HOST, JAM_PORT, JAM_START_DELAY, MAX_BPM,
+                        MIN_BPM, NET_BPM, NET_CELL_KINDS, NET_CLEAR, NET_PING, NET_PLACE, NET_PLAY,
+                        NET_PONG, NET_REMOVE, NET_TRANSPORT, jam_apply, jam_delta, net_message,
+                        net_read)
+
+
+class JamServer:
+    """
+    Сервер совместной игры (--jam-server): держит главную копию города -
+    записи зданий по клеткам (jam_record) - и транспорт: темп, играет ли и
+    когда по его часам звучит шаг 0 песни. Правку клиента он применяет и
+    рассылает всем (и автору тоже - так у всех один порядок правок).
+    Правку, которая опоздала (клетку уже заняли, здание убрали), автору
+    возвращает исправлением: клетка как на сервере.
+
+    Пароля нет, поэтому по умолчанию сервер слушает только JAM_HOST; для
+    игры по сети адрес (например 0.0.0.0) задаётся явно.
+    """
+
+    def __init__(self, host=JAM_HOST, port=JAM_PORT):
+        self.host = host
+        self.port = port
+        self.records = {}  # Клетка -> запись здания
+        self.bpm = DEFAULT_BPM
+        self.playing = False
+        self.origin = 0.0  # Когда по часам сервера звучит шаг 0 песни
+        self.clients = set()  # Потоки записи подключённых игроков
+        self.clock = time.perf_counter
+
+    async def serve(self):
+        server = await asyncio.start_server(self.handle, self.host, self.port)
+        print(f"Сервер совместной игры: {self.host}:{self.port}")
+        if self.host not in ("127.0.0.1", "localhost", "::1"):
+            print("  Пароля нет: подключиться может любой, кому виден этот адрес")
+        async with server:
+            await server.serve_forever()
+
+    def bar_time(self):
+        return 60.0 / self.bpm * BEATS_PER_BAR
+
+    def transport(self):
+        return net_message(NET_TRANSPORT, self.playing, self.bpm, self.origin)
+
+    def snapshot(self):
+        # Весь город для нового игрока - единственный раз, когда шлём не правку
+        messages = [net_message(NET_CLEAR)]
+        for record in self.records.values():
+            messages += jam_delta(None, record)
+        messages += [net_message(NET_BPM, self.bpm), self.transport()]
+        return b"".join(messages)
+
+    def broadcast(self, data):
+        for writer in list(self.clients):
+            writer.write(data)
+
+    async def handle(self, reader, writer):
+        peer = writer.get_extra_info("peername")
+        print(f"Игрок подключился: {peer}")
+        writer.write(self.snapshot())
+        self.clients.add(writer)
+        try:
+            while True:
+                kind, fields = await net_read(reader)
+                reply = self.apply(kind, fields)
+                if reply:
+                    writer.write(reply)
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        finally:
+            self.clients.discard(writer)
+            writer.close()
+            print(f"Игрок отключился: {peer}")
+
+    def apply(self, kind, fields):
+        # Применяет сообщение клиента; возвращает то, что надо ответить только ему
+        if kind == NET_PING:
+            return net_message(NET_PONG, fields[0], self.clock())
+
+        if kind in NET_CELL_KINDS:
+            cell = tuple(fields[:2])
+            old = self.records.get(cell)
+            try:
+                if kind == NET_PLACE and old is not None:
+                    raise ValueError("клетка занята")
+                new = jam_apply(old, kind, fields)
+            except ValueError:
+                # У автора клетка не такая, как на сервере - присылаем её целиком
+                return b"".join([net_message(NET_REMOVE, *cell)] + jam_delta(None, old))
+            if new is None:
+                self.records.pop(cell, None)
+            else:
+                self.records[cell] = new
+            self.broadcast(b"".join(jam_delta(old, new)))
+        elif kind == NET_CLEAR:
+            self.records = {}
+            self.broadcast(net_message(NET_CLEAR))
+        elif kind == NET_BPM:
+            bpm = max(MIN_BPM, min(MAX_BPM, fields[0]))
+            if self.playing:
+                # Позиция в песне не прыгает: переносим начало под новый темп
+                now = self.clock()
+                position = (now - self.origin) / self.bar_time()
+                self.bpm = bpm
+                self.origin = now - position * self.bar_time()
+            self.bpm = bpm
+            self.broadcast(net_message(NET_BPM, bpm) + self.transport())
+        elif kind == NET_PLAY:
+            playing, bar = fields
+            self.playing = playing
+            if playing:
+                self.origin = self.clock() + JAM_START_DELAY - bar * self.bar_time()
+            self.broadcast(self.transport())
+        return None
+
+
+def run_jam_server(address):
+    # --jam-server [HOST:]PORT - только сервер, без окна и звука.
+    # Без HOST - только этот компьютер (JAM_HOST)
+    host, _, port = address.rpartition(":")
+    try:
+        asyncio.run(JamServer(host or JAM_HOST, int(port) if port else JAM_PORT).serve())
+    except OSError as error:
+        print(f"Не удалось запустить сервер: {error}")
+    except KeyboardInterrupt:
+        pass
@@ -1,27 +1,251 @@
-import pygame
+import time
+
+START_TIME = time.perf_counter()  # Начало запуска (от него считает --profile-startup)
+
 import sys
 import os
+import argparse
+import csv
+import hashlib
+import io
+import itertools
+import json
+import math
+import struct
+import threading
+import wave
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pygame
 
-# Инициализация pygame и звуковой системы
-pygame.init()
-pygame.mixer.init()  # Нужно для воспроизведения звуков
+# Инструменты (simulate, bench, capture, jam_server - модули рядом) импортируют
+# игру как rhytm_city, в том числе когда она запущена скриптом
+sys.modules.setdefault("rhytm_city", sys.modules[__name__])
+
+# Прогоны без окна и звука - фиктивные драйверы SDL
+# (должны быть заданы до инициализации pygame)
+HEADLESS_FLAGS = ("--simulate", "--bench", "--capture")
+if any(flag in sys.argv for flag in HEADLESS_FLAGS):
+    os.environ["SDL_VIDEODRIVER"] = "dummy"
+    os.environ["SDL_AUDIODRIVER"] = "dummy"
+
+# Подсистемы pygame (окно, звук, шрифты) поднимает Game - только те, что
+# нужны: серверу совместной игры и процессу звука окно не нужно вовсе.
+# asyncio (~50 мс импорта) нужен только совместной игре, multiprocessing
+# (~20 мс) - процессу звука: они импортируются там
+IMPORT_TIME = time.perf_counter() - START_TIME
+
+# Пути считаются от папки игры, а не от текущей папки
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+SOUNDS_DIR = os.path.join(BASE_DIR, "sounds")
+CACHE_DIR = os.path.join(BASE_DIR, ".cache")  # Раскодированные звуки
+SAVE_PATH = os.path.join(BASE_DIR, "city.rcity")  # Сохранение города (F5/F9)
+MIXER_CONFIG_PATH = os.path.join(BASE_DIR, "mixer.json")  # Настройки звука из --calibrate
 
 # Константы размеров окна
 WINDOW_WIDTH = 1280
 WINDOW_HEIGHT = 720
 FPS = 60  # Ограничение кадров в секунду
+STARTUP_BUDGET = 0.2  # За сколько секунд от запуска должен появиться первый кадр
+
+# Город
+CITY_COLS = 12  # Размер города по умолчанию (--city меняет)
+CITY_ROWS = 8
+MAX_CITY_SIDE = 2 ** 15 - 1  # Клетки в сети передаются как int16
+CHUNK_SIZE = 16  # Сторона куска города (в клетках) для быстрой отрисовки
+MIN_TILE = 8  # Пределы масштаба клетки в пикселях
+MAX_TILE = 128
 
 # Музыкальные константы
 DEFAULT_BPM = 120  # Темп по умолчанию (удары в минуту)
+MIN_BPM = 60  # Пределы темпа и шаг его изменения (клавиши +/-)
+MAX_BPM = 200
+BPM_STEP = 10
 BEATS_PER_BAR = 4  # Размер такта 4/4
 STEPS_PER_BEAT = 4  # Шагов на один удар (шестнадцатые ноты)
 STEPS_PER_BAR = 16  # Всего 16 шагов на такт
+TICKS_PER_BAR = 192  # Тиков в такте: делится и на 16/32/64 шага, и на триоли (12, 24)
+TICKS_PER_STEP = TICKS_PER_BAR // STEPS_PER_BAR
+RESOLUTIONS = {16: "1/16", 32: "1/32", 64: "1/64", 12: "1/8т", 24: "1/16т"}  # Шагов в такте
+MAX_SONG_BARS = 64  # Длиннее песня не компилируется (цепочки разной длины)
+LOOKAHEAD = 0.1  # На сколько секунд вперёд секвенсер планирует шаги
+CATCH_UP_STEPS = 2  # Сколько последних опоздавших шагов секвенсер догоняет после подвисания
+BOUNCE_BARS = 8  # Сколько тактов записывает экспорт (клавиша B)
+
+# Файл города: заголовок, потом записи фиксированной длины (запись = слот)
+CITY_MAGIC = b"RCITY"
+CITY_VERSION = 2
+CITY_HEADER = np.dtype([
+    ("magic", "S5"),
+    ("version", "u1"),
+    ("bpm", "<u2"),
+    ("level", "u1"),
+    ("completed", "u1"),
+    ("bars", "<u4"),  # Сколько тактов сыграно на уровне
+    ("cols", "<u4"),
+    ("rows", "<u4"),
+    ("records", "<u4"),
+    ("reserved", "V6"),
+])  # 32 байта
+CITY_RECORD = np.dtype([
+    ("col", "<i4"),
+    ("row", "<i4"),
+    ("mask", "<u2"),  # Паттерн, бит i = шаг i
+    ("type_id", "u1"),
+    ("volume", "u1"),  # Громкость * VOLUME_SCALE
+    ("flags", "u1"),  # RECORD_ALIVE | RECORD_MUTED | RECORD_SOLO
+    ("pan", "i1"),  # Панорама * PAN_SCALE
+])  # 14 байт на здание
+CITY_RECORDS = {1: np.dtype(CITY_RECORD.descr[:-1]), 2: CITY_RECORD}  # В версии 1 нет панорамы
+VOLUME_SCALE = 200  # Шаг громкости в файле 0.005 (шаги по 0.1 хранятся точно)
+PAN_SCALE = 100  # Шаг панорамы в файле 0.01
+RECORD_ALIVE = 1
+RECORD_MUTED = 2
+RECORD_SOLO = 4
+AUTOSAVE_INTERVAL = 5.0  # Раз во сколько секунд автосохранение (0 - выключено)
+UNDO_MEMORY = 32 * 2 ** 20  # Сколько байт может занимать история отмены (CTRL+Z)
+
+# Шина микшера: город сводится блоками в один канал (--mixer bus / process)
+MIXER_MODE = "channels"  # "channels" - канал на удар (и режим петли), "bus" - шина в игре, "process" - в отдельном процессе
+LIMITER_CEILING = 0.9  # Выше этого уровня мастер-ограничитель пики не пропускает
+LIMITER_RELEASE = 0.25  # За сколько секунд ограничитель отпускает громкость (в e раз)
+BUS_LEVEL_WINDOW = 1.0  # За сколько последних секунд шина считает RMS микса
+AUDIO_BLOCK = 256  # Кадров за один проход микшера
+AUDIO_CHUNK = 1024  # Кадров в одном звуке, который уходит в канал
+AUDIO_AHEAD = 0.08  # На сколько секунд микшер рендерит вперёд
+AUDIO_DRIFT = 0.005  # На сколько секунд микшер может разойтись с секвенсером, пока его не подвинут
+AUDIO_CLOCK = 0.25  # Раз во сколько секунд игра сообщает процессу звука часы секвенсера
+AUDIO_QUEUE = 65536  # Сколько сообщений помещается в очередь к процессу звука
+AUDIO_FRAME = np.dtype(("<i2", (2,)))  # Кадр вывода: 16 бит, стерео
+AUDIO_MESSAGE = np.dtype([
+    ("kind", "u1"),  # MSG_*
+    ("type_id", "u1"),
+    ("flags", "u1"),  # RECORD_ALIVE | RECORD_MUTED | RECORD_SOLO
+    ("steps", "u1"),  # Сетка такта паттерна
+    ("bar", "<u2"),  # Номер такта (паттерн, старт, переход)
+    ("bars", "<u2"),  # Длина цепочки
+    ("slot", "<i4"),
+    ("value", "<f4"),  # Громкость или BPM
+    ("mask", "<u8"),  # Шаги такта (до 64)
+    ("pan", "<f4"),
+])  # 28 байт
+MSG_BUILDING = 1  # Поля здания (тип, громкость, mute, solo, стоит ли)
+MSG_PATTERN = 2  # Один такт цепочки здания
+MSG_CLEAR = 3  # Город очищен
+MSG_START = 4
+MSG_STOP = 5
+MSG_BPM = 6
+MSG_SEEK = 7
+MSG_QUIT = 8
+MSG_NOTE = 9  # Нота одного шага здания (шаг в bar, полутоны в value)
+MSG_CLOCK = 10  # Часы секвенсера: шаг, который звучит сейчас, в slot, его доля в value
+
+# Совместная игра по сети (--jam-server / --jam): сервер держит город и
+# транспорт, клиенты шлют правки - каждая по сообщению в несколько байт
+JAM_PORT = 7777
+JAM_HOST = "127.0.0.1"  # Сервер без пароля: по умолчанию слушает только этот компьютер
+JAM_START_DELAY = 0.3  # Через сколько секунд после старта все клиенты начинают такт
+JAM_PING_INTERVAL = 1.0  # Раз во сколько секунд клиент сверяет часы с сервером
+JAM_PING_SAMPLES = 8  # Сдвиг часов берётся из самого быстрого из последних замеров
+JAM_RESYNC = 0.002  # На сколько секунд должен уехать сдвиг часов, чтобы поправить расписание
+NET_PLACE = 1  # Поставить здание: клетка, тип
+NET_REMOVE = 2  # Убрать здание с клетки
+NET_STEP = 3  # Один шаг такта цепочки: такт, номер бита, вкл/выкл
+NET_BAR = 4  # Такт цепочки целиком: такт, сетка, маска
+NET_CHAIN = 5  # Цепочка целиком (поменялись длина или сетка): тактов, потом такты
+NET_VOLUME = 6  # Громкость * VOLUME_SCALE
+NET_PAN = 7  # Панорама * PAN_SCALE
+NET_MUTE = 8
+NET_SOLO = 9
+NET_NOTE = 10  # Нота шага: шаг, полутоны
+NET_BPM = 11
+NET_TRANSPORT = 12  # От сервера: играет ли, темп, когда по часам сервера звучит шаг 0 песни
+NET_PLAY = 13  # К серверу: старт с такта или стоп
+NET_PING = 14  # Часы клиента
+NET_PONG = 15  # Часы клиента из PING и часы сервера
+NET_CLEAR = 16  # Город очищен (и перед снимком города для нового игрока)
+NET_FORMATS = {  # Поля после байта вида; клетка - два int16
+    NET_PLACE: "<hhB",
+    NET_REMOVE: "<hh",
+    NET_STEP: "<hhBB?",
+    NET_BAR: "<hhBBQ",
+    NET_CHAIN: "<hhB",
+    NET_VOLUME: "<hhB",
+    NET_PAN: "<hhb",
+    NET_MUTE: "<hh?",
+    NET_SOLO: "<hh?",
+    NET_NOTE: "<hhBb",
+    NET_BPM: "<H",
+    NET_TRANSPORT: "<?Hd",
+    NET_PLAY: "<?H",
+    NET_PING: "<d",
+    NET_PONG: "<dd",
+    NET_CLEAR: "",
+}
+NET_CELL_KINDS = set(range(NET_PLACE, NET_NOTE + 1))  # Правки одного здания
+NET_CHAIN_BAR = "<BQ"  # Такт в NET_CHAIN: сетка, маска
+
+# Замер точности секвенсера (--bench)
+BENCH_BARS = 100  # Сколько тактов играет каждый прогон
+BENCH_SIZES = (1, 10, 100, 1000, 10000)  # Размеры города (зданий)
+BENCH_OVERSLEEP = 0.0005  # Среднее опоздание пробуждения потока, секунды
+BENCH_STALL = 0.03  # Длина подвисания (долгий кадр держит GIL), секунды
+BENCH_TICK = 0.00005  # Сколько занимает time.sleep(0) при нулевом опоздании
+
+# Запись проигрывания без окна (--capture)
+CAPTURE_SECONDS = 30.0  # Длина записи, с
+CAPTURE_FPS = 25  # Кадров в секунду (задержка кадра GIF - в сотых долях секунды)
+CAPTURE_AHEAD = 4  # Сколько кадров на процесс может ждать сжатия
+GIF_FREQUENT = 128  # Цветов палитры GIF из первого кадра, остальные - равномерная сетка
+
+# Настройки микшера pygame (до калибровки) и калибровка (--calibrate)
+MIXER_DEFAULTS = {"frequency": 44100, "buffer": 512, "channels": 2, "latency": 0.0}
+MAX_LATENCY = 0.3  # Больше задержку вывода не учитываем, с
+CALIBRATE_FREQUENCIES = (44100, 48000)  # Какие частоты проверять
+CALIBRATE_BUFFERS = (256, 512, 1024, 2048)  # Какие буферы проверять, кадров
+CALIBRATE_CHANNELS = (1, 2)  # Моно и стерео: задержка и пропуски у них бывают разные
+CALIBRATE_PROBES = 12  # Щелчков на замер задержки колбэка микшера
+CALIBRATE_FEED = 1.5  # Сколько секунд кормить канал кусками, считая пропуски
+CALIBRATE_BPM = 100  # Темп щелчков, под которые игрок стучит пробелом
+CALIBRATE_TAPS = 16  # Сколько ударов игрока нужно
+CALIBRATE_SKIP = 4  # Первые удары - разгон, не считаются
+
+# Голоса микшера
+VOICE_BUDGET = 32  # Сколько каналов микшера могут звучать одновременно
+VOICE_RESERVE = "building"  # Канал закреплён за зданием ("building") или типом ("type")
+VOICE_STEAL = "oldest"  # Кого глушить, когда каналы кончились: "oldest", "quietest" или None
+OWNER_VOICES = 2  # Сколько каналов может держать одно здание (хвост удара звучит под следующим)
+
+# Ноты шагов у зданий на 808
+PITCHED_TYPES = ("bass", "percussion")  # У этих типов в редакторе есть ноты (колесо над шагом)
+NOTE_RANGE = 12  # Нота шага - от -12 до +12 полутонов
+PITCH_CACHE_BYTES = 16 * 2 ** 20  # Предел памяти кеша транспонированных сэмплов
+
+# Измеритель громкости
+ENVELOPE_BLOCK = 64  # Размер блока (в кадрах) для огибающей пиков сэмпла
+WAVEFORM_POINTS = 128  # Столбцов в миниатюре волны сэмпла (в кеше на диске)
+RMS_REFERENCE = 0.9  # RMS микса, который показывается на индикаторе как 1.0
+# (шесть разных зданий с громкостью 0.7 на 120 BPM дают около 0.7)
+
+# Подсказка к уровню (solve_level)
+HINT_VOLUME_STEP = 0.05  # Шаг потолка громкости зданий среди кандидатов
+HINT_BPM_COST = 0.1  # Цена шага темпа (BPM_STEP) в единицах снятой громкости
 
 # Цвета для интерфейса
 COLOR_BG = (20, 20, 30)  # Тёмный фон
 COLOR_GRID = (50, 50, 70)  # Линии сетки
 COLOR_TEXT = (200, 200, 220)  # Основной текст
 
+# Состояния плитки здания в атласе (SpriteAtlas)
+SPRITE_NORMAL = 0
+SPRITE_MUTED = 1
+SPRITE_SOLO = 2
+SPRITE_SELECTED = 3
+SPRITE_FLASH = 4  # Здание прозвучало на текущем шаге
+SPRITE_STATES = 5
+
 # Уровни игры - список словарей с параметрами каждого уровня
 LEVELS = [
     {
@@ -77,82 +301,211 @@ BUILDING_COLORS = {
 }
 
 
+BUILDING_TYPES = list(BUILDING_COLORS)  # Номер типа в хранилище = индекс в этом списке
+
+# Сдвиги для разбора битовой маски паттерна на шаги
+STEP_SHIFTS = np.arange(STEPS_PER_BAR, dtype=np.uint16)
+PATTERNS = {}  # Интернированные паттерны (intern_pattern)
+
+
+def make_default_pattern(building_type):
+    """Создаёт паттерн по умолчанию для типа здания."""
+    pattern = [False] * 16
+
+    if building_type == "kick":
+        # Бочка на каждый удар
+        pattern[0] = pattern[4] = pattern[8] = pattern[12] = True
+
+    elif building_type == "snare":
+        # Снейр на 2 и 4
+        pattern[4] = pattern[12] = True
+
+    elif building_type == "hihat":
+        # Хэт каждую восьмую
+        for i in range(0, 16, 2):
+            pattern[i] = True
+
+    elif building_type == "bass":
+        # Бас на 1 и 3
+        pattern[0] = pattern[8] = True
+
+    elif building_type == "percussion":
+        # Перкуссия на офбитах
+        pattern[2] = pattern[6] = pattern[10] = pattern[14] = True
+
+    elif building_type == "fx":
+        # FX на начале половин
+        pattern[0] = pattern[8] = True
+
+    return pattern
+
+
+def pattern_to_mask(pattern):
+    # Список из 16 True/False -> битовая маска (бит i = шаг i)
+    return sum(1 << i for i, on in enumerate(pattern) if on)
+
+
+def intern_pattern(pattern):
+    # Один общий объект на каждый разный паттерн (кортеж): цепочки, ноты,
+    # буфер обмена и история отмены ссылаются на него, а не копируют
+    return PATTERNS.setdefault(pattern, pattern)
+
+
+def pattern_ticks(steps, mask):
+    # Тики включённых шагов паттерна (steps шагов на такт) от начала такта
+    return np.array([i * TICKS_PER_BAR // steps for i in range(steps) if mask >> i & 1],
+                    dtype=np.int64)
+
+
+def resample_pattern(steps, mask, new_steps):
+    # Переносит паттерн на другую сетку: каждый удар - в ближайший шаг новой
+    return sum({1 << (round(i * new_steps / steps) % new_steps)
+                for i in range(steps) if mask >> i & 1})
+
+
+def parse_pattern(text):
+    # "x...x..." -> (шагов, маска); сетка определяется длиной строки
+    if len(text) not in RESOLUTIONS:
+        raise ValueError(f"паттерн из {len(text)} шагов, а можно {sorted(RESOLUTIONS)}")
+    return len(text), pattern_to_mask(c == "x" for c in text)
+
+
+def mask_to_bits(mask):
+    # Маска (или массив масок) -> массив 0/1 по шагам
+    return (np.asarray(mask, dtype=np.uint16)[..., None] >> STEP_SHIFTS) & 1
+
+
+def pan_gains(pan):
+    # Панорама (-1 слева ... 1 справа) -> множители левого и правого канала.
+    # В центре оба канала на полной громкости, как и без панорамы
+    return np.minimum(1.0, 1.0 - pan), np.minimum(1.0, 1.0 + pan)
+
+
+def store_field(name, convert):
+    # Свойство Building, которое читает и пишет столбец хранилища
+    def get(self):
+        return convert(getattr(self.store, name)[self.slot])
+
+    def set(self, value):
+        self.store.set(self.slot, name, value)
+
+    return property(get, set)
+
+
 class Building:
-    """Класс здания - один инструмент."""
+    """
+    Класс здания - один инструмент.
+    Данные зданий лежат по столбцам в BuildingStore, а Building - лёгкий
+    вид на одну запись для кода, которому удобно работать с одним зданием
+    (редактор, экспорт дорожек).
+    """
+    __slots__ = ("store", "slot")
+
     sounds = {}  # Общий словарь звуков для всех зданий
+    voices = None  # Общий VoiceManager - через него звучат все здания
+    pitch = None  # Общий PitchCache - транспонированные звуки для нот
+    files = {}  # Тип -> файл звука (несколько типов могут играть один файл)
+    samples = {}  # Те же звуки как массивы float32 (кадры, каналы) для рендера
+    envelopes = {}  # SampleEnvelope - громкость, длина и миниатюра волны каждого звука
 
     @classmethod
-    def load_sounds(cls):
-        """Загружает звуки из папки sounds."""
-
+    def load_sounds(cls, verbose=True):
+        """
+        Загружает звуки из папки sounds.
+        Каждый файл раскодируется один раз (несколько типов могут играть
+        один файл), файлы грузятся параллельно, а раскодированный звук и его
+        разбор берутся из дискового кеша, если они там уже есть.
+        verbose=False - без отчёта в консоль (процесс звука).
+        """
         files = {
-            "kick": "sounds/Navie D Kick 13.wav",
-            "snare": "sounds/Navie D Snare 7.wav",
-            "hihat": "sounds/Hi Hat - Hit 1.wav",
-            "bass": "sounds/808 - Spinz.wav",
-            "percussion": "sounds/808 - Spinz.wav",
-            "fx": "sounds/Hi Hat - Hit 1.wav"
+            "kick": "Navie D Kick 13.wav",
+            "snare": "Navie D Snare 7.wav",
+            "hihat": "Hi Hat - Hit 1.wav",
+            "bass": "808 - Spinz.wav",
+            "percussion": "808 - Spinz.wav",
+            "fx": "Hi Hat - Hit 1.wav"
         }
 
-        for name, path in files.items():
-            if os.path.exists(path):
-                cls.sounds[name] = pygame.mixer.Sound(path)
-                print(f"  + {name}")
+        start = time.perf_counter()
+        paths = {name: os.path.join(SOUNDS_DIR, file) for name, file in files.items()}
+        loaded = load_pcm_files(set(paths.values()))
+        cls.files = paths
+        if cls.pitch is None:
+            cls.pitch = PitchCache()
+
+        # Звук, массив и огибающая тоже одни на файл
+        by_path = {}
+        for path, (pcm, envelope) in loaded.items():
+            if pcm is not None:
+                by_path[path] = (pygame.sndarray.make_sound(pcm), pcm_to_float(pcm), envelope)
+
+        # Словари собираются заново и подменяются разом: игра грузит звуки
+        # в фоне и в это время уже читает их
+        sounds, samples, envelopes = {}, {}, {}
+        for name, path in paths.items():
+            if path in by_path:
+                sounds[name], samples[name], envelopes[name] = by_path[path]
+                if verbose:
+                    print(f"  + {name}")
             else:
-                cls.sounds[name] = None
+                sounds[name] = None
+                samples[name] = None
+                envelopes[name] = None
                 print(f"  ✗ {name} не найден")
+        cls.sounds, cls.samples, cls.envelopes = sounds, samples, envelopes
 
-    def __init__(self, col, row, building_type):
-        self.col = col
-        self.row = row
-        self.type = building_type
-        self.color = BUILDING_COLORS.get(building_type, (100, 100, 100))
-        self.sound = Building.sounds.get(building_type)
+        if verbose:
+            print(f"  Звуки загружены за {time.perf_counter() - start:.3f} с")
 
-        # Паттерн - 16 шагов (True/False)
-        self.pattern = self.make_default_pattern()
+    def __init__(self, store, slot):
+        self.store = store
+        self.slot = slot
 
-        # Простые параметры
-        self.volume = 0.7  # Громкость здания (0.0 - 1.0)
-        self.muted = False
-        self.solo = False
+    def __eq__(self, other):
+        return isinstance(other, Building) and other.store is self.store and other.slot == self.slot
 
-    def make_default_pattern(self):
-        """Создаёт паттерн по умолчанию для типа здания."""
-        pattern = [False] * 16
+    def __hash__(self):
+        return hash(self.slot)
 
-        if self.type == "kick":
-            # Бочка на каждый удар
-            pattern[0] = pattern[4] = pattern[8] = pattern[12] = True
+    col = store_field("col", int)
+    row = store_field("row", int)
+    volume = store_field("volume", float)  # Громкость здания (0.0 - 1.0)
+    pan = store_field("pan", float)  # Панорама (-1.0 слева - 1.0 справа)
+    muted = store_field("muted", bool)
+    solo = store_field("solo", bool)
+    mask = store_field("mask", int)  # Паттерн - 16 шагов битами
 
-        elif self.type == "snare":
-            # Снейр на 2 и 4
-            pattern[4] = pattern[12] = True
+    @property
+    def type(self):
+        return BUILDING_TYPES[self.store.type_id[self.slot]]
 
-        elif self.type == "hihat":
-            # Хэт каждую восьмую
-            for i in range(0, 16, 2):
-                pattern[i] = True
+    @property
+    def color(self):
+        return BUILDING_COLORS.get(self.type, (100, 100, 100))
 
-        elif self.type == "bass":
-            # Бас на 1 и 3
-            pattern[0] = pattern[8] = True
+    @property
+    def sound(self):
+        return Building.sounds.get(self.type)
 
-        elif self.type == "percussion":
-            # Перкуссия на офбитах
-            pattern[2] = pattern[6] = pattern[10] = pattern[14] = True
+    @property
+    def pattern(self):
+        # Паттерн списком из 16 True/False (копия - менять через сеттер)
+        mask = self.mask
+        return [bool(mask >> i & 1) for i in range(STEPS_PER_BAR)]
 
-        elif self.type == "fx":
-            # FX на начале половин
-            pattern[0] = pattern[8] = True
+    @pattern.setter
+    def pattern(self, pattern):
+        self.mask = pattern_to_mask(pattern)
 
-        return pattern
+    def toggle_step(self, step):
+        # Включает/выключает шаг паттерна
+        self.mask = self.mask ^ (1 << step)
 
     def should_play(self, step):
         # Проверяет, играть ли на этом шаге
-        return self.pattern[step]
+        return bool(self.mask >> step & 1)
 
-    def play(self, any_solo):
+    def play(self, any_solo=False):
         # Воспроизводит звук
         # Если есть соло и это не я, то тогда не играю
         if any_solo and not self.solo:
@@ -162,159 +515,3567 @@ class Building:
         if self.muted:
             return
 
-        # Играем звук с учётом громкости
-        if self.sound:
-            self.sound.set_volume(self.volume)
-            self.sound.play()
+        # Играем звук с учётом громкости (громкость ставится на канал,
+        # общий Sound не трогаем)
+        sound = self.sound
+        if sound and Building.voices:
+            Building.voices.play(self.slot, self.type, sound, self.volume, self.pan)
+
+
+class BuildingStore:
+    """
+    Хранилище зданий по столбцам: каждое поле - свой numpy-массив, здание -
+    номер слота в них (около 22 байт на здание вместо целого объекта).
+    Слоты удалённых зданий переиспользуются, так что номер слота не
+    меняется, пока здание стоит.
+
+    Маска звучащих слотов (mute и solo уже учтены) кешируется и после правки
+    пересобирается одной векторной операцией при первом обращении.
+
+    Хранилище из файла (from_records) столбцы сразу не заводит: каждый
+    раскодируется из записей файла целиком при первом обращении к нему.
+    """
+
+    FIELDS = {
+        "col": np.int32,
+        "row": np.int32,
+        "type_id": np.uint8,
+        "volume": np.float32,
+        "pan": np.float32,
+        "muted": np.bool_,
+        "solo": np.bool_,
+        "mask": np.uint16,
+        "alive": np.bool_,  # Слот занят
+    }
+    SNAPSHOT = np.dtype(list(FIELDS.items()))  # Все поля одного слота (история отмены)
+    RECORD_FLAGS = {"alive": RECORD_ALIVE, "muted": RECORD_MUTED, "solo": RECORD_SOLO}
+
+    def __init__(self, capacity=64, source=None):
+        self.capacity = capacity  # Длина столбцов, которые ещё не раскодированы
+        self.source = source  # Записи файла (CITY_RECORD), пока не раскодированы все столбцы
+        self.decode_lock = threading.Lock()
+        if source is None:
+            for name, dtype in self.FIELDS.items():
+                setattr(self, name, np.zeros(capacity, dtype=dtype))
+
+        self.size = 0  # Слоты дальше этого ни разу не занимались
+        self.count = 0  # Сколько зданий стоит
+        self.free = []  # Освободившиеся слоты
+        self.audible_cache = None  # Маска звучащих слотов; None - надо пересобрать
+        self.changed = set()  # Слоты, изменённые с прошлого автосохранения
+        self.journal = None  # Слот -> поля до первой правки в действии (History); None - не ведём
+
+        # Списки по шагам читает поток секвенсера
+        self.lock = threading.Lock()
+
+    def __getattr__(self, name):
+        # Столбец, которого ещё нет: раскодируется из записей файла
+        source = self.__dict__.get("source")
+        if source is None or name not in self.FIELDS:
+            raise AttributeError(name)
+        with self.decode_lock:
+            if name in self.__dict__:
+                return self.__dict__[name]  # Раскодировал другой поток
+            column = np.zeros(self.capacity, dtype=self.FIELDS[name])
+            n = len(source)
+            if name == "volume":
+                column[:n] = source["volume"] / np.float32(VOLUME_SCALE)
+            elif name == "pan":
+                if "pan" in source.dtype.names:
+                    column[:n] = source["pan"] / np.float32(PAN_SCALE)
+            elif name in self.RECORD_FLAGS:
+                column[:n] = (source["flags"] & self.RECORD_FLAGS[name]) != 0
+            else:
+                column[:n] = source[name]
+            setattr(self, name, column)
+            if all(field in self.__dict__ for field in self.FIELDS):
+                self.source = None  # Всё раскодировано - файл больше не держим
+        return column
+
+    def grow(self):
+        # Удваивает массивы, когда слоты кончились
+        for name in self.FIELDS:
+            column = getattr(self, name)
+            bigger = np.zeros(len(column) * 2, dtype=column.dtype)
+            bigger[:len(column)] = column
+            setattr(self, name, bigger)
+
+    def add(self, col, row, building_type):
+        # Добавляет здание с параметрами по умолчанию, возвращает слот
+        with self.lock:
+            if self.free:
+                slot = self.free.pop()
+            else:
+                if self.size == len(self.alive):
+                    self.grow()
+                slot = self.size
+                self.size += 1
+
+            self.log(slot)
+            self.col[slot] = col
+            self.row[slot] = row
+            self.type_id[slot] = BUILDING_TYPES.index(building_type)
+            self.volume[slot] = 0.7
+            self.pan[slot] = 0.0
+            self.muted[slot] = False
+            self.solo[slot] = False
+            self.mask[slot] = pattern_to_mask(make_default_pattern(building_type))
+            self.alive[slot] = True
+
+            self.count += 1
+            self.audible_cache = None
+            self.changed.add(slot)
+        return slot
+
+    def remove(self, slot):
+        with self.lock:
+            self.log(slot)
+            self.alive[slot] = False
+            self.free.append(slot)
+            self.count -= 1
+            self.audible_cache = None
+            self.changed.add(slot)
+
+    def set(self, slot, name, value):
+        # Меняет одно поле здания
+        with self.lock:
+            self.log(slot)
+            getattr(self, name)[slot] = value
+            self.audible_cache = None
+            self.changed.add(slot)
+
+    def put(self, slot, type_id, volume, pan, muted, solo, alive):
+        # Записывает здание прямо в слот (копия города в процессе звука)
+        with self.lock:
+            while slot >= len(self.alive):
+                self.grow()
+            self.size = max(self.size, slot + 1)
+            self.count += int(alive) - int(self.alive[slot])
+            self.type_id[slot] = type_id
+            self.volume[slot] = volume
+            self.pan[slot] = pan
+            self.muted[slot] = muted
+            self.solo[slot] = solo
+            self.alive[slot] = alive
+            self.audible_cache = None
+            self.changed.add(slot)
+
+    def log(self, slot):
+        # Запоминает поля слота перед первой правкой в текущем действии.
+        # Вызывается под self.lock
+        if self.journal is not None and slot not in self.journal:
+            self.journal[slot] = self.snapshot([slot])[0]
+
+    def snapshot(self, slots):
+        # Поля слотов одним массивом SNAPSHOT (слоты за концом массивов - пустые)
+        slots = np.asarray(slots, dtype=np.int64)
+        out = np.zeros(len(slots), dtype=self.SNAPSHOT)
+        inside = slots < len(self.alive)
+        for name in self.FIELDS:
+            out[name][inside] = getattr(self, name)[slots[inside]]
+        return out
+
+    def restore(self, slots, records):
+        # Записывает слотам поля из snapshot() (отмена и повтор)
+        with self.lock:
+            if len(slots):
+                while slots.max() >= len(self.alive):
+                    self.grow()
+                self.size = max(self.size, int(slots.max()) + 1)
+            self.count += int(records["alive"].sum()) - int(self.alive[slots].sum())
+            for name in self.FIELDS:
+                getattr(self, name)[slots] = records[name]
+
+            # Пустые слоты снова свободны, занятые - уже нет
+            restored = set(slots.tolist())
+            self.free = ([slot for slot in self.free if slot not in restored]
+                         + slots[~records["alive"]].tolist())
+            self.audible_cache = None
+            self.changed.update(restored)
+
+    def view(self, slot):
+        return Building(self, int(slot))
+
+    def records(self, slots=None):
+        # Записи файла города (CITY_RECORD) для слотов, по умолчанию для всех.
+        # Вызывается под self.lock
+        if slots is None:
+            slots = slice(0, self.size)
+        records = np.zeros(len(self.alive[slots]), dtype=CITY_RECORD)
+        records["col"] = self.col[slots]
+        records["row"] = self.row[slots]
+        records["mask"] = self.mask[slots]
+        records["type_id"] = self.type_id[slots]
+        records["volume"] = np.rint(np.clip(self.volume[slots], 0.0, 1.0) * VOLUME_SCALE)
+        records["pan"] = np.rint(np.clip(self.pan[slots], -1.0, 1.0) * PAN_SCALE)
+        records["flags"] = (self.alive[slots] * RECORD_ALIVE | self.muted[slots] * RECORD_MUTED
+                            | self.solo[slots] * RECORD_SOLO)
+        return records
+
+    def take_changed(self):
+        # Записи слотов, изменённых с прошлого вызова: (слоты, записи, всего слотов)
+        with self.lock:
+            slots = np.array(sorted(self.changed), dtype=np.int64)
+            self.changed = set()
+            return slots, self.records(slots), self.size
+
+    @classmethod
+    def from_records(cls, records):
+        # Хранилище из записей файла (номер записи становится слотом).
+        # Записи (memmap из open_city) не копируются: столбец раскодируется
+        # векторно при первом обращении, а до того лежит на диске. Сразу
+        # читается только признак занятости - для счётчика и свободных слотов
+        n = len(records)
+        store = cls(max(64, n), source=records)
+        store.size = n
+        alive = store.alive[:n]
+        store.count = int(alive.sum())
+        store.free = np.flatnonzero(~alive).tolist()[::-1]
+        return store
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        for slot in np.flatnonzero(self.alive[:self.size]):
+            yield self.view(slot)
+
+    def any_solo(self):
+        # Есть ли здания в соло (даже заглушенные - они всё равно глушат остальных)
+        n = self.size
+        return bool((self.solo[:n] & self.alive[:n]).any())
+
+    def audible(self):
+        # Маска слотов, которые звучат с учётом mute и solo
+        n = self.size
+        audible = self.alive[:n] & ~self.muted[:n]
+        if self.any_solo():
+            audible &= self.solo[:n]
+        return audible
+
+    def audible_slots(self):
+        # Кешированная маска audible() для потока секвенсера
+        with self.lock:
+            if self.audible_cache is None:
+                self.audible_cache = self.audible()
+            return self.audible_cache
+
+
+class Timeline:
+    """
+    Скомпилированная партитура города.
+
+    У здания может быть цепочка тактов (chains): каждый такт - (шагов, маска),
+    где шагов - одна из RESOLUTIONS (16, 32, 64 или триоли). Здание без цепочки
+    каждый такт играет свой 16-шаговый паттерн из хранилища. Песня длится
+    столько тактов, чтобы все цепочки сошлись (НОК длин), и крутится по кругу.
+
+    У зданий на 808 (PITCHED_TYPES) могут быть ноты (notes): по полутону
+    на каждую шестнадцатую такта, одни и те же во всех тактах цепочки.
+
+    Все удары песни лежат в массивах, отсортированных по времени: tick (тик
+    от начала песни), slot (здание), gain (громкость) и note. Секвенсер
+    читает их курсором шаг за шагом; прыжок в любой такт - двоичный поиск.
+    Правка одного здания не пересобирает всё: его удары вырезаются и
+    вставляются заново на свои места (много правок разом - полная сборка).
+    """
+
+    def __init__(self, store):
+        self.store = store
+        self.chains = {}  # Слот -> список тактов (шагов, маска)
+        self.notes = {}  # Слот -> полутоны по 16 шагам такта (только ненулевые)
+        self.journal = None  # Слот -> (цепочка, ноты) до первой правки в действии (History)
+        self.version = 0  # Растёт при каждой правке цепочек и нот (для автосохранения)
+        self.bars = 1  # Длина песни в тактах
+
+        self.tick = np.zeros(0, dtype=np.int64)
+        self.slot = np.zeros(0, dtype=np.int32)
+        self.gain = np.zeros(0, dtype=np.float32)
+        self.note = np.zeros(0, dtype=np.int8)
+
+        self.dirty = True  # Нужна полная сборка
+        self.pending = set()  # Слоты, чьи удары надо пересобрать
+        self.cursor = 0  # Индекс первого ещё не прочитанного удара
+        self.cursor_tick = None  # Тик песни, на котором стоит курсор
+
+        # Счётчики
+        self.compiles = 0
+        self.patches = 0
+        self.seeks = 0
+
+        # Удары читает поток секвенсера, правит главный поток
+        self.lock = threading.Lock()
+        self.compile_lock = threading.Lock()  # Одна сборка за раз
+
+    def chain(self, slot):
+        # Цепочка тактов здания (без своей цепочки - один 16-шаговый такт)
+        chain = self.chains.get(slot)
+        if chain is None:
+            return ((STEPS_PER_BAR, int(self.store.mask[slot])),)
+        return chain
+
+    def log(self, slot):
+        # Запоминает цепочку и ноты слота перед первой правкой (под self.lock)
+        if self.journal is not None and slot not in self.journal:
+            self.journal[slot] = (self.chains.get(slot), self.notes.get(slot))
+
+    def set_chain(self, slot, chain):
+        """
+        Задаёт зданию цепочку тактов. Один 16-шаговый такт хранится прямо
+        в маске хранилища; для остальных цепочек маска хранилища - первый
+        такт, сведённый к 16 шагам (по ней считают измеритель и экспорт).
+        """
+        chain = intern_pattern(tuple((int(steps), int(mask)) for steps, mask in chain))
+        with self.lock:
+            self.log(slot)
+            old_bars = self.song_bars(self.chains)
+            if len(chain) == 1 and chain[0][0] == STEPS_PER_BAR:
+                self.chains.pop(slot, None)
+            else:
+                self.chains[slot] = chain
+            self.dirty |= self.song_bars(self.chains) != old_bars
+            self.version += 1
+        steps, mask = chain[0]
+        self.store.set(slot, "mask", resample_pattern(steps, mask, STEPS_PER_BAR))
+        self.update(slot)
+
+    def set_notes(self, slot, notes):
+        # Задаёт зданию ноты по 16 шагам (все нули - без нот)
+        notes = intern_pattern(tuple(int(note) for note in notes))
+        with self.lock:
+            self.log(slot)
+            if any(notes):
+                self.notes[slot] = notes
+            else:
+                self.notes.pop(slot, None)
+            self.version += 1
+            self.pending.add(slot)
+
+    def song_bars(self, chains):
+        # Длина песни: через сколько тактов все цепочки начнутся заново
+        bars = 1
+        for chain in chains.values():
+            bars = math.lcm(bars, len(chain))
+        if bars > MAX_SONG_BARS:
+            bars = max(len(chain) for chain in chains.values())
+        return bars
+
+    def restore(self, slot, chain, notes):
+        # Возвращает слоту цепочку и ноты (отмена и повтор; маска - в хранилище)
+        with self.lock:
+            old_bars = self.song_bars(self.chains)
+            for table, value in ((self.chains, chain), (self.notes, notes)):
+                if value is None:
+                    table.pop(slot, None)
+                else:
+                    table[slot] = value
+            self.dirty |= self.song_bars(self.chains) != old_bars
+            self.version += 1
+            self.pending.add(slot)
+
+    def update(self, slot):
+        # Здание поставили или изменили - его удары пересоберутся при чтении
+        with self.lock:
+            self.pending.add(slot)
+
+    def remove(self, slot):
+        with self.lock:
+            self.log(slot)
+            if self.chains.pop(slot, None) is not None:
+                self.dirty = True
+                self.version += 1
+            if self.notes.pop(slot, None) is not None:
+                self.version += 1
+            self.pending.add(slot)
+
+    def slot_events(self, slot, bars, chains):
+        # Тики ударов одного здания за bars тактов (вызывается под store.lock)
+        chain = chains.get(slot) or [(STEPS_PER_BAR, int(self.store.mask[slot]))]
+        one = np.concatenate([pattern_ticks(steps, mask) + bar * TICKS_PER_BAR
+                              for bar, (steps, mask) in enumerate(chain)])
+        repeats = -(-bars // len(chain))
+        ticks = (one[None, :] + np.arange(repeats)[:, None] * len(chain) * TICKS_PER_BAR).ravel()
+        return ticks[ticks < bars * TICKS_PER_BAR]
+
+    def event_notes(self, tick, slot, notes):
+        # Ноты ударов: полутон шестнадцатой, на которую попал удар
+        note = np.zeros(len(tick), dtype=np.int8)
+        if notes and len(tick):
+            keys = np.array(sorted(notes))
+            table = np.array([notes[key] for key in keys], dtype=np.int8)
+            row = np.minimum(np.searchsorted(keys, slot), len(keys) - 1)
+            hit = keys[row] == slot
+            note[hit] = table[row[hit], tick[hit] % TICKS_PER_BAR // TICKS_PER_STEP]
+        return note
+
+    def compile(self, chains, notes, bars):
+        # Полная сборка: 16-шаговые здания разом векторно, цепочки - по одной
+        store = self.store
+        with store.lock:
+            slots = np.flatnonzero(store.alive[:store.size])
+            # Без цепочек isin не нужен (его np.unique подтягивает numpy.ma -
+            # лишние ~15 мс на первом кадре)
+            chained = np.isin(slots, list(chains)) if chains else np.zeros(len(slots), dtype=np.bool_)
+
+            plain = slots[~chained]
+            rows, steps = np.nonzero(mask_to_bits(store.mask[plain]))
+            bar_ticks = steps * TICKS_PER_STEP
+            parts_tick = [(bar_ticks[None, :] + np.arange(bars)[:, None] * TICKS_PER_BAR).ravel()]
+            parts_slot = [np.tile(plain[rows], bars)]
+
+            for slot in slots[chained]:
+                ticks = self.slot_events(int(slot), bars, chains)
+                parts_tick.append(ticks)
+                parts_slot.append(np.full(len(ticks), slot))
+
+            tick = np.concatenate(parts_tick)
+            slot = np.concatenate(parts_slot).astype(np.int32)
+            gain = store.volume[slot]
+
+        order = np.lexsort((slot, tick))
+        tick, slot = tick[order], slot[order]
+        self.compiles += 1
+        return tick, slot, gain[order], self.event_notes(tick, slot, notes)
+
+    def patch(self, pending, chains, notes):
+        # Пересобирает удары только изменённых зданий
+        store = self.store
+        keep = ~np.isin(self.slot, list(pending))
+        tick, slot, gain, note = self.tick[keep], self.slot[keep], self.gain[keep], self.note[keep]
+
+        with store.lock:
+            for changed in sorted(pending):
+                if changed >= store.size or not store.alive[changed]:
+                    continue
+                ticks = self.slot_events(changed, self.bars, chains)
+                # Вставляем после ударов с тем же тиком и меньшим слотом
+                at = np.searchsorted(tick * (store.size + 1) + slot,
+                                     ticks * (store.size + 1) + changed)
+                note = np.insert(note, at, self.event_notes(ticks, np.full(len(ticks), changed),
+                                                            notes))
+                tick = np.insert(tick, at, ticks)
+                slot = np.insert(slot, at, changed)
+                gain = np.insert(gain, at, store.volume[changed])
+
+        self.patches += 1
+        return tick, slot, gain, note
+
+    def refresh(self):
+        """
+        Применяет накопившиеся правки: заплатка или полная сборка, и
+        публикует новые массивы. Зовёт только тот, кто правит партитуру
+        (Game.update каждый кадр); поток секвенсера лишь читает
+        опубликованные массивы (events).
+        """
+        with self.compile_lock:
+            with self.lock:
+                if not self.dirty and not self.pending:
+                    return
+                full = self.dirty or len(self.pending) > 64
+                pending = self.pending
+                chains = dict(self.chains)
+                notes = dict(self.notes)
+                self.pending = set()
+                self.dirty = False
+
+            if full:
+                bars = self.song_bars(chains)
+                tick, slot, gain, note = self.compile(chains, notes, bars)
+            else:
+                bars = self.bars
+                tick, slot, gain, note = self.patch(pending, chains, notes)
+
+            with self.lock:
+                self.tick, self.slot, self.gain, self.note = tick, slot, gain, note
+                self.bars = bars
+                self.cursor_tick = None
+
+    def events(self, index):
+        """
+        Удары шага index (номер 16-шагового шага с начала игры), сгруппированные
+        по тикам внутри шага: [(тик, слоты, громкости, ноты), ...]. Первая группа
+        всегда на тике 0 (может быть пустой). Mute и solo учитываются здесь.
+        Читает последние опубликованные массивы и ничего не собирает.
+        """
+        with self.lock:
+            song_ticks = self.bars * TICKS_PER_BAR
+            start = index * TICKS_PER_STEP % song_ticks
+            end = start + TICKS_PER_STEP
+
+            # Подряд идущие шаги читаем с курсора, иначе - прыжок
+            if start != self.cursor_tick:
+                self.cursor = int(np.searchsorted(self.tick, start))
+                self.seeks += 1
+            lo = self.cursor
+            hi = int(np.searchsorted(self.tick, end, side="left"))
+            self.cursor = hi if end < song_ticks else 0
+            self.cursor_tick = end % song_ticks
+
+            ticks = self.tick[lo:hi] - start
+            slots = self.slot[lo:hi]
+            gains = self.gain[lo:hi]
+            notes = self.note[lo:hi]
+
+        heard = self.store.audible_slots()[slots]
+        ticks, slots, gains, notes = ticks[heard], slots[heard], gains[heard], notes[heard]
+
+        groups = []
+        if not len(ticks) or ticks[0] != 0:
+            groups.append((0, slots[:0], gains[:0], notes[:0]))
+        bounds = np.flatnonzero(np.diff(ticks)) + 1
+        for part_ticks, part_slots, part_gains, part_notes in zip(np.split(ticks, bounds),
+                                                                  np.split(slots, bounds),
+                                                                  np.split(gains, bounds),
+                                                                  np.split(notes, bounds)):
+            if len(part_ticks):
+                groups.append((int(part_ticks[0]), part_slots, part_gains, part_notes))
+        return groups
+
+
+class VoiceManager:
+    """
+    Раздаёт каналы микшера под удары зданий.
+
+    За каждым зданием (или типом, см. reserve) закрепляются свои каналы,
+    до OWNER_VOICES: если прошлый удар ещё звучит (длинный хвост 808),
+    следующий идёт на второй свободный канал, и хвост не обрывается. Когда
+    свои каналы все заняты, а свободных нет, перезапускается самый старый
+    свой голос - чужие ради хвоста не глушатся. Громкость ставится на
+    канал, поэтому здания одного типа не сбивают друг другу громкость.
+    Каналов не больше budget; зданию без каналов, когда свободных нет,
+    отдаётся самый старый или самый тихий голос, а если steal=None - удар
+    пропускается.
+    """
+
+    def __init__(self, budget=VOICE_BUDGET, reserve=VOICE_RESERVE, steal=VOICE_STEAL):
+        self.budget = budget
+        self.reserve = reserve
+        self.steal = steal
+
+        # Все каналы наши: Sound.play() сам по себе их не займёт
+        pygame.mixer.set_num_channels(budget)
+        pygame.mixer.set_reserved(budget)
+        self.channels = [pygame.mixer.Channel(i) for i in range(budget)]
+
+        self.owner = [None] * budget  # Кто занимает канал
+        self.channel_of = {}  # Владелец -> номера его каналов
+        self.started = [0.0] * budget  # Когда запущен голос
+        self.gain = [0.0] * budget  # Громкость голоса
+        self.length = [1.0] * budget  # Длина звука в секундах
+
+        # Счётчики
+        self.triggers = 0  # Сколько ударов пришло
+        self.stolen = 0  # Сколько голосов заглушено ради новых
+        self.dropped = 0  # Сколько ударов не сыграно
+
+        # Играет поток секвенсера, счётчики читает HUD
+        self.lock = threading.Lock()
+
+    def play(self, slot, building_type, sound, volume, pan=0.0):
+        # Запускает звук здания на его канале (панорама - громкостями каналов)
+        owner = slot if self.reserve == "building" else building_type
+        now = time.perf_counter()
+
+        with self.lock:
+            self.triggers += 1
+
+            # Свой замолкший канал, иначе ещё один свободный под хвост,
+            # иначе свой самый старый голос
+            own = self.channel_of.get(owner, [])
+            index = next((i for i in own if not self.channels[i].get_busy()), None)
+            if index is None and len(own) < OWNER_VOICES:
+                index = self.free_channel()
+                if index is not None:
+                    self.assign(index, owner)
+            if index is None and own:
+                index = min(own, key=lambda i: self.started[i])
+            if index is None:
+                index = self.find_channel(now)
+                if index is None:
+                    self.dropped += 1
+                    return
+                self.assign(index, owner)
+
+            self.started[index] = now
+            self.gain[index] = volume
+            self.length[index] = sound.get_length() or 1.0
+
+            left, right = pan_gains(pan)
+            channel = self.channels[index]
+            channel.set_volume(volume * float(left), volume * float(right))
+            channel.play(sound)
+
+    def assign(self, index, owner):
+        # Отдаёт канал владельцу (у прошлого владельца канал забираем)
+        old = self.owner[index]
+        if old is not None:
+            channels = self.channel_of[old]
+            channels.remove(index)
+            if not channels:
+                del self.channel_of[old]
+        self.owner[index] = owner
+        self.channel_of.setdefault(owner, []).append(index)
+
+    def free_channel(self):
+        # Замолкший канал (None - звучат все)
+        for index, channel in enumerate(self.channels):
+            if not channel.get_busy():
+                return index
+        return None
 
-    def draw(self, screen, grid):  # Рисует здание на сетке
-        x = grid.offset_x + self.col * grid.tile_size
-        y = grid.offset_y + self.row * grid.tile_size
+    def find_channel(self, now):
+        # Свободный канал или голос, который можно заглушить
+        index = self.free_channel()
+        if index is not None:
+            return index
 
-        rect = pygame.Rect(x + 4, y + 4, grid.tile_size - 8, grid.tile_size - 8)  # Квадрат здания
-        pygame.draw.rect(screen, self.color, rect)
-        pygame.draw.rect(screen, (255, 255, 255), rect, 2)
+        if self.steal is None:
+            return None
+
+        self.stolen += 1
+        if self.steal == "quietest":
+            # Громкость с поправкой на то, сколько звука уже прозвучало
+            def loudness(i):
+                left = 1.0 - (now - self.started[i]) / self.length[i]
+                return self.gain[i] * max(0.0, left)
+            return min(range(self.budget), key=loudness)
+
+        return min(range(self.budget), key=lambda i: self.started[i])
+
+    def active(self):
+        # Сколько голосов звучит сейчас
+        return sum(1 for channel in self.channels if channel.get_busy())
+
+
+class Profiler:
+    """
+    Замеры, чтобы понять, кто виноват в подтормаживании: отрисовка, цикл
+    событий или звук. По кадрам - время handle_events, update, draw и
+    ожидания в clock.tick; по шагам - опоздание запуска звуков относительно
+    положенного времени; плюс число звучащих голосов. Хранит скользящее окно
+    значений для p50/p99 и может писать всё в JSON lines или CSV.
+    Выключенный профайлер ничего не замеряет.
+    """
+
+    FRAME_FIELDS = ("events", "update", "draw", "wait", "voices")
+    CSV_FIELDS = ("kind", "time", "events", "update", "draw", "wait", "voices",
+                  "step", "lateness")
+
+    def __init__(self, log_path=None, window=600):
+        self.enabled = False
+        self.history = {name: deque(maxlen=window)
+                        for name in self.FRAME_FIELDS + ("lateness",)}
+        self.steps = deque()  # Шаги от потока секвенсера, пишутся в лог на кадре
+        self.started = time.perf_counter()
+
+        self.log = None
+        self.writer = None
+        if log_path:
+            self.open_log(log_path)
+            self.enabled = True
+
+    def open_log(self, path):
+        # Формат по расширению: .csv - CSV, иначе JSON lines
+        self.log = open(path, "w", newline="", encoding="utf-8")
+        if path.lower().endswith(".csv"):
+            self.writer = csv.DictWriter(self.log, fieldnames=self.CSV_FIELDS)
+            self.writer.writeheader()
+
+    def write(self, record):
+        if self.writer:
+            self.writer.writerow(record)
+        elif self.log:
+            self.log.write(json.dumps(record) + "\n")
+
+    def step(self, step, due, fired):
+        # Шаг запущен в fired, а должен был в due (вызывается из потока секвенсера)
+        lateness = fired - due
+        self.history["lateness"].append(lateness)
+        if self.log:
+            self.steps.append({"kind": "step", "time": round(fired - self.started, 6),
+                               "step": step, "lateness": round(lateness, 6)})
+
+    def frame(self, events, update, draw, wait, voices):
+        # Времена частей кадра в секундах и число голосов
+        values = {"events": events, "update": update, "draw": draw,
+                  "wait": wait, "voices": voices}
+        for name, value in values.items():
+            self.history[name].append(value)
+
+        if self.log:
+            while self.steps:
+                self.write(self.steps.popleft())
+            record = {"kind": "frame", "time": round(time.perf_counter() - self.started, 6)}
+            for name, value in values.items():
+                record[name] = round(value, 6)
+            self.write(record)
+
+    def percentiles(self, name):
+        # (p50, p99) по окну значений
+        values = self.history[name]
+        if not values:
+            return 0.0, 0.0
+        p50, p99 = np.percentile(np.fromiter(values, dtype=float), [50, 99])
+        return p50, p99
+
+    def close(self):
+        if self.log:
+            self.log.close()
+            self.log = None
+            self.writer = None
+
+
+class StartupProfile:
+    """
+    Замер запуска (--profile-startup): сколько заняли импорт, окно, звук,
+    шрифты и сэмплы и когда после старта появился первый кадр. Шрифты и
+    сэмплы грузятся в фоне, уже под первым кадром, поэтому отчёт
+    печатается, когда есть и кадр, и конец фоновой загрузки.
+    """
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.parts = [("импорт", IMPORT_TIME, False)]  # (часть, секунды, в фоне ли)
+        self.first_frame = None  # Секунд от запуска до первого кадра
+        self.ready = None  # Секунд от запуска до конца фоновой загрузки
+        self.reported = False
+
+    def mark(self, name, since, background=False):
+        # Часть запуска шла с since до сих пор; возвращает "сейчас"
+        now = time.perf_counter()
+        self.parts.append((name, now - since, background))
+        return now
+
+    def frame(self):
+        # Первый кадр нарисован
+        self.first_frame = time.perf_counter() - START_TIME
+        self.check()
+
+    def loaded(self):
+        # Фоновая загрузка закончилась
+        self.ready = time.perf_counter() - START_TIME
+        self.check()
+
+    def check(self):
+        if self.enabled and not self.reported and self.first_frame is not None and self.ready is not None:
+            self.reported = True
+            self.report()
+
+    def report(self):
+        print("\n=== Запуск ===")
+        foreground = 0.0
+        for name, seconds, background in self.parts:
+            print(f"  {name:<12} {seconds * 1000:7.1f} мс{'  (в фоне)' if background else ''}")
+            if not background:
+                foreground += seconds
+        print(f"  {'остальное':<12} {(self.first_frame - foreground) * 1000:7.1f} мс")
+        verdict = "в норме" if self.first_frame <= STARTUP_BUDGET else "медленно"
+        print(f"  Первый кадр через {self.first_frame * 1000:.1f} мс "
+              f"(цель {STARTUP_BUDGET * 1000:.0f} мс, {verdict})")
+        print(f"  Всё загружено через {self.ready * 1000:.1f} мс")
 
 
 class Sequencer:
     """
     Секвенсер - управляет ритмом и воспроизведением.
     Отсчитывает такты и шаги, чтобы все инструменты играли синхронно.
+
+    Шаги считает отдельный поток по часам высокого разрешения: каждый шаг
+    планируется заранее, за lookahead секунд, и запускается точно в свой
+    момент, а не тогда, когда до него дойдёт кадр. update() оставлен для Game
+    и только сообщает, что с прошлого кадра прошли новые шаги.
+
+    После подвисания шаги, чьё время прошло, догоняются по одному правилу:
+    позиция проходит их все по порядку, а звучат (сразу, по порядку)
+    только те, что опоздали не больше чем на max_late плюс catch_up шагов.
+    Какие шаги прозвучат, зависит только от расписания и текущего времени.
     """
 
-    def __init__(self, bpm):
+    def __init__(self, bpm, lookahead=LOOKAHEAD, threaded=True, latency=0.0):
         self.bpm = bpm
         self.playing = False  # Играет музыка или на паузе
 
         # Вычисляет, сколько времени занимает один шаг
         # Формула: 60 секунд / BPM / количество шагов в одном ударе
         self.step_time = 60.0 / bpm / STEPS_PER_BEAT
-        self.timer = 0.0  # Накопитель времени
 
-        # Текущая позиция воспроизведения
+        # Текущая позиция воспроизведения (последний прозвучавший шаг)
         self.current_step = 0  # От 0 до 15
         self.current_bar = 0  # Номер текущего такта
 
-    def start(self):
-        # Запускает воспроизведение с начала
-        self.playing = True
-        self.current_step = 0
-        self.current_bar = 0
-        self.timer = 0.0
+        # Колбэки от Game:
+        # prepare(index) - заранее собирает удары шага index (номер с начала)
+        #   группами по тикам: [(тик, слоты, громкости, ноты), ...], первая на тике 0
+        # on_step(step, bar, due, triggers, tick) - запускает звуки в момент удара;
+        #   triggers - (слоты, громкости, ноты), tick - тик внутри шага (0 - сам шаг)
+        self.prepare = None
+        self.on_step = None
+
+        self.lookahead = lookahead  # На сколько секунд вперёд планируем шаги
+        self.max_late = 0.05  # Опоздание, которое ещё не считается подвисанием
+        self.catch_up = CATCH_UP_STEPS  # Сколько шагов сверх max_late догоняем после подвисания
+        # Задержка вывода звука (из калибровки): шаг запускается на столько
+        # раньше положенного, чтобы удар прозвучал вовремя, и окно
+        # планирования на столько же длиннее
+        self.latency = latency
+
+        # threaded=False - без потока, время двигает сам update(dt)
+        # (нужно для прогонов без окна и звука)
+        self.threaded = threaded
+        self.virtual_time = 0.0
+        self.clock = time.perf_counter if threaded else self.get_virtual_time
+
+        # Расписание. Время шага n считается от якоря, а не накоплением,
+        # поэтому ошибка округления не копится
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.anchor_index = 0  # Номер шага, от которого считаем время
+        self.anchor_time = 0.0  # Когда этот шаг должен прозвучать
+        self.next_index = 0  # Следующий шаг, который ещё не запланирован
+        self.scheduled = deque()  # (due, index, tick, triggers) - ждут своего времени
+        self.pending_bpm = None  # Новый темп, применится на границе шага
+
+        # Счётчики
+        self.steps_done = 0  # Сколько шагов прошло всего
+        self.steps_seen = 0  # Сколько из них уже видел update()
+        self.bars_done = 0  # Сколько тактов закончилось всего
+        self.missed_steps = 0  # Сколько шагов пропущено из-за опоздания
+        self.caught_up_steps = 0  # Сколько опоздавших шагов сыграно, догоняя
+
+        self.thread = None
+
+    def get_virtual_time(self):
+        return self.virtual_time
+
+    def start(self, bar=0):
+        # Запускает воспроизведение с начала такта bar
+        with self.lock:
+            if self.pending_bpm is not None:
+                self.apply_bpm(self.pending_bpm)
+            self.playing = True
+            self.current_step = 0
+            self.current_bar = bar
+            self.anchor_index = bar * STEPS_PER_BAR
+            # Первый шаг запускается сразу, а звучит через задержку вывода
+            self.anchor_time = self.clock() + self.latency
+            self.next_index = self.anchor_index
+            self.scheduled.clear()
+
+        if self.threaded and self.thread is None:
+            self.thread = threading.Thread(target=self.run_scheduler,
+                                           name="sequencer", daemon=True)
+            self.thread.start()
+        self.wakeup.set()
+
+    def seek(self, bar):
+        """
+        Переходит к такту bar. Уже запланированные шаги (на lookahead вперёд)
+        доиграют, а следующий шаг будет первым шагом такта bar - в тот же
+        момент, когда прозвучал бы очередной шаг. Партитуру не проигрываем
+        с начала: Timeline найдёт место двоичным поиском.
+        """
+        bar = max(0, bar)
+        with self.lock:
+            if not self.playing:
+                return
+            self.anchor_time = self.due_time(self.next_index)
+            self.anchor_index = bar * STEPS_PER_BAR
+            self.next_index = self.anchor_index
+
+    def sync(self, origin, bpm):
+        """
+        Ставит расписание на общие часы совместной игры: шаг n с начала песни
+        звучит в origin + n * длина шага (origin - по часам этого секвенсера).
+        Если уже играем, запланированные шаги доиграют, а дальше пойдут шаги
+        общего расписания - так правка сдвига часов или темпа не даёт ни
+        повторов, ни скачка назад.
+        """
+        with self.lock:
+            self.bpm = bpm
+            self.pending_bpm = None
+            self.step_time = 60.0 / bpm / STEPS_PER_BEAT
+            # В очереди и по часам - время запуска, а расписание - когда звучит
+            if self.playing and self.scheduled:
+                index = math.floor((self.scheduled[-1][0] + self.latency - origin)
+                                   / self.step_time) + 1
+            else:
+                index = math.ceil((self.clock() + self.latency - origin) / self.step_time)
+                self.scheduled.clear()
+            index = max(0, index)
+
+            if not self.playing:
+                self.playing = True
+                self.current_step = index % STEPS_PER_BAR
+                self.current_bar = index // STEPS_PER_BAR
+            self.anchor_index = index
+            self.anchor_time = origin + index * self.step_time
+            self.next_index = index
+
+        if self.threaded and self.thread is None:
+            self.thread = threading.Thread(target=self.run_scheduler,
+                                           name="sequencer", daemon=True)
+            self.thread.start()
+        self.wakeup.set()
 
     def stop(self):
         # Останавливает воспроизведение
-        self.playing = False
+        with self.lock:
+            self.playing = False
+            self.scheduled.clear()
+
+    def shutdown(self):
+        # Останавливает поток планировщика (при выходе из игры)
+        self.stop()
+        thread = self.thread
+        self.thread = None
+        self.wakeup.set()
+        if thread is not None:
+            thread.join(timeout=1.0)
 
     def update(self, dt):
         """
         Обновляет таймер секвенсера.
         dt - время с прошлого кадра в секундах.
-        Возвращает True, если наступил новый шаг
+        Возвращает True, если с прошлого вызова прошли новые шаги
         """
-        if not self.playing:
-            return False
+        if not self.threaded:
+            # Без потока время идёт только вперёд на dt
+            self.virtual_time += dt
+            self.pump(self.virtual_time)
+
+        with self.lock:
+            new_steps = self.steps_done != self.steps_seen
+            self.steps_seen = self.steps_done
 
-        # Накапливает время
-        self.timer += dt
+        return new_steps
 
-        # Если набралось достаточно времени - переходим на следующий шаг
-        if self.timer >= self.step_time:
-            self.timer -= self.step_time  # Сбрасываем таймер
+    def set_bpm(self, bpm):
+        # Изменяет темп. Длительность шага меняется на ближайшей границе шага
+        self.bpm = bpm
+        with self.lock:
+            if self.playing:
+                self.pending_bpm = bpm
+            else:
+                self.apply_bpm(bpm)
 
-            self.current_step += 1  # Увеличиваем номер шага
+    def apply_bpm(self, bpm):
+        # Пересчитывает длительность шага и переносит якорь на следующий шаг
+        # (вызывается под self.lock)
+        self.anchor_time = self.due_time(self.next_index)
+        self.anchor_index = self.next_index
+        self.step_time = 60.0 / bpm / STEPS_PER_BEAT
+        self.pending_bpm = None
 
-            # Если закончился такт - начинает новый
-            if self.current_step >= 16:
-                self.current_step = 0
-                self.current_bar += 1
+    def due_time(self, index):
+        # Когда должен прозвучать шаг с номером index
+        return self.anchor_time + (index - self.anchor_index) * self.step_time
 
-            return True  # Сообщает, что наступил новый шаг
+    def position(self, at):
+        # Номер шага (дробный), который звучит в момент at (под self.lock)
+        return self.anchor_index + (at - self.anchor_time) / self.step_time
 
-        return False
+    def catch_up_limit(self):
+        # На сколько шаг может опоздать и всё же прозвучать
+        return self.max_late + self.catch_up * self.step_time
 
-    def set_bpm(self, bpm):
-        # Изменяет темп и пересчитывает длительность шага
-        self.bpm = bpm
-        self.step_time = 60.0 / bpm / STEPS_PER_BEAT
+    def pump(self, now):
+        """
+        Планирует шаги в окне lookahead и запускает те, чьё время пришло.
+        Шаги, опоздавшие больше чем на max_late (подвисание), догоняются:
+        последние catch_up из них звучат сразу и по порядку, более старые
+        не звучат, но позиция всё равно проходит их по порядку.
+        Возвращает, сколько секунд можно ждать до следующего дела.
+        """
+        fire = []
+
+        with self.lock:
+            if not self.playing:
+                return self.lookahead
+
+            # Планируем шаги на lookahead вперёд (due - когда запускать)
+            while True:
+                if self.pending_bpm is not None:
+                    self.apply_bpm(self.pending_bpm)
+
+                due = self.due_time(self.next_index) - self.latency
+                if due > now + self.lookahead:
+                    break
+
+                groups = None
+                if due >= now - self.catch_up_limit() and self.prepare:
+                    groups = self.prepare(self.next_index)
+
+                if groups is None:
+                    self.scheduled.append((due, self.next_index, 0, None))
+                else:
+                    # Удары между шагами (32-е, триоли) ставим в очередь на свои тики
+                    tick_time = self.step_time / TICKS_PER_STEP
+                    for tick, slots, gains, notes in groups:
+                        self.scheduled.append((due + tick * tick_time, self.next_index,
+                                               tick, (slots, gains, notes)))
+                self.next_index += 1
+
+            # Проходим удары, время которых наступило
+            limit = self.catch_up_limit()
+            while self.scheduled and self.scheduled[0][0] <= now:
+                due, index, tick, triggers = self.scheduled.popleft()
+                step = index % STEPS_PER_BAR
+                late = now - due
+                skipped = late > limit
+
+                if tick == 0:
+                    self.current_step = step
+                    self.current_bar = index // STEPS_PER_BAR
+                    self.steps_done += 1
+                    if step == 0 and index > 0:
+                        self.bars_done += 1
+
+                    if triggers is None or skipped:
+                        self.missed_steps += 1
+                        continue
+                    if late > self.max_late:
+                        self.caught_up_steps += 1
+                elif skipped:
+                    continue
+
+                fire.append((step, index // STEPS_PER_BAR, due, triggers, tick))
+
+            if self.scheduled:
+                wait = self.scheduled[0][0] - now
+            else:
+                wait = self.due_time(self.next_index) - self.latency - self.lookahead - now
+
+        # Звуки запускаем вне блокировки
+        if self.on_step:
+            for step, bar, due, triggers, tick in fire:
+                self.on_step(step, bar, due, triggers, tick)
+
+        return max(0.0, wait)
+
+    def sleep_until_wakeup(self, seconds):
+        # Сон планировщика: до срока или пока не разбудят (старт, темп)
+        self.wakeup.wait(seconds)
+        self.wakeup.clear()
+
+    def run_scheduler(self, wait=None, sleep=time.sleep, running=None):
+        """
+        Поток планировщика. wait(секунд) - долгий сон, sleep(0) - уступить
+        процессор, running() - продолжать ли (по умолчанию - пока есть поток).
+        Замер (bench.bench_scheduler) подставляет свои вместе с часами self.clock.
+        """
+        wait = wait or self.sleep_until_wakeup
+        running = running or (lambda: self.thread is not None)
+        while running():
+            if not self.playing:
+                self.wakeup.wait()
+                self.wakeup.clear()
+                continue
+
+            ahead = self.pump(self.clock())
+
+            # Спим почти до нужного момента, последнюю миллисекунду
+            # добираем короткими засыпаниями - так точнее
+            if ahead > 0.002:
+                wait(ahead - 0.001)
+            else:
+                sleep(0)
 
 
 class Grid:
     # Сетка города
+    # Город может быть намного больше окна - видна только часть под камерой
 
-    def __init__(self):
-        self.cols = 12
-        self.rows = 8
+    def __init__(self, cols=CITY_COLS, rows=CITY_ROWS):
+        self.cols = cols
+        self.rows = rows
         self.tile_size = 64
 
-        # Центрируем сетку
-        self.offset_x = (WINDOW_WIDTH - self.cols * self.tile_size) // 2
-        self.offset_y = (WINDOW_HEIGHT - self.rows * self.tile_size) // 2
+        # Область экрана под сетку (12x8 клеток по 64 пикселя, по центру)
+        view_w = 12 * 64
+        view_h = 8 * 64
+        self.view = pygame.Rect((WINDOW_WIDTH - view_w) // 2,
+                                (WINDOW_HEIGHT - view_h) // 2, view_w, view_h)
+
+        # Камера - левый верхний угол видимой части города в пикселях
+        self.camera_x = 0
+        self.camera_y = 0
+        self.update_offset()
+
+    def update_offset(self):
+        # Держит камеру в границах города и пересчитывает смещение сетки.
+        # Если город меньше области просмотра - центрируем его
+        world_w = self.cols * self.tile_size
+        world_h = self.rows * self.tile_size
+
+        if world_w <= self.view.width:
+            self.camera_x = -((self.view.width - world_w) // 2)
+        else:
+            self.camera_x = max(0, min(self.camera_x, world_w - self.view.width))
+
+        if world_h <= self.view.height:
+            self.camera_y = -((self.view.height - world_h) // 2)
+        else:
+            self.camera_y = max(0, min(self.camera_y, world_h - self.view.height))
+
+        self.offset_x = self.view.x - self.camera_x
+        self.offset_y = self.view.y - self.camera_y
+
+    def pan(self, dx, dy):
+        # Двигает камеру на dx, dy пикселей экрана
+        self.camera_x -= dx
+        self.camera_y -= dy
+        self.update_offset()
+
+    def zoom(self, factor, mouse_x, mouse_y):
+        # Меняет масштаб, оставляя точку под мышью на месте
+        new_size = max(MIN_TILE, min(MAX_TILE, round(self.tile_size * factor)))
+        if new_size == self.tile_size:
+            return
+
+        world_x = (mouse_x - self.offset_x) / self.tile_size
+        world_y = (mouse_y - self.offset_y) / self.tile_size
+        self.tile_size = new_size
+        self.camera_x = round(world_x * new_size - (mouse_x - self.view.x))
+        self.camera_y = round(world_y * new_size - (mouse_y - self.view.y))
+        self.update_offset()
 
     def get_cell(self, mouse_x, mouse_y):
         # Возвращает клетку по координатам мыши
-        # Проверяет, попадает ли мышь в сетку
-        if (self.offset_x <= mouse_x < self.offset_x + self.cols * self.tile_size and
-                self.offset_y <= mouse_y < self.offset_y + self.rows * self.tile_size):
-            col = (mouse_x - self.offset_x) // self.tile_size
-            row = (mouse_y - self.offset_y) // self.tile_size
+        # Проверяет, попадает ли мышь в область просмотра и в город
+        if not self.view.collidepoint(mouse_x, mouse_y):
+            return None
+
+        col = (mouse_x - self.offset_x) // self.tile_size
+        row = (mouse_y - self.offset_y) // self.tile_size
+        if 0 <= col < self.cols and 0 <= row < self.rows:
             return (col, row)
 
         return None
 
-    def draw(self, screen):   # Рисует линии сетки
+    def visible_cells(self):
+        # Диапазон видимых клеток: (col0, row0, col1, row1), правая граница не входит
+        col0 = max(0, (self.view.left - self.offset_x) // self.tile_size)
+        row0 = max(0, (self.view.top - self.offset_y) // self.tile_size)
+        col1 = min(self.cols, -(-(self.view.right - self.offset_x) // self.tile_size))
+        row1 = min(self.rows, -(-(self.view.bottom - self.offset_y) // self.tile_size))
+        return col0, row0, col1, row1
+
+    def draw(self, screen):   # Рисует линии сетки (только видимые)
+        col0, row0, col1, row1 = self.visible_cells()
+        top = max(self.view.top, self.offset_y + row0 * self.tile_size)
+        bottom = min(self.view.bottom, self.offset_y + row1 * self.tile_size)
+        left = max(self.view.left, self.offset_x + col0 * self.tile_size)
+        right = min(self.view.right, self.offset_x + col1 * self.tile_size)
+
         # Вертикальные линии
-        for col in range(self.cols + 1):
+        for col in range(col0, col1 + 1):
             x = self.offset_x + col * self.tile_size
-            pygame.draw.line(screen, COLOR_GRID,
-                             (x, self.offset_y),
-                             (x, self.offset_y + self.rows * self.tile_size))
+            if self.view.left <= x <= self.view.right:
+                pygame.draw.line(screen, COLOR_GRID, (x, top), (x, bottom))
 
-        for row in range(self.rows + 1):     # Горизонтальные линии
+        for row in range(row0, row1 + 1):     # Горизонтальные линии
             y = self.offset_y + row * self.tile_size
-            pygame.draw.line(screen, COLOR_GRID,
-                             (self.offset_x, y),
-                             (self.offset_x + self.cols * self.tile_size, y))
+            if self.view.top <= y <= self.view.bottom:
+                pygame.draw.line(screen, COLOR_GRID, (left, y), (right, y))
+
+
+class SpriteAtlas:
+    """
+    Плитки зданий, заранее нарисованные на одной поверхности: строка на
+    тип (BUILDING_TYPES), столбец на состояние (SPRITE_*). Пересобирается
+    только при смене масштаба, а слой зданий рисуется кусками атласа одним
+    вызовом Surface.blits, без pygame.draw на каждое здание.
+    Здесь же живут миниатюры волны сэмплов: на плитках и в редакторе.
+    """
+
+    def __init__(self):
+        self.tile_size = None
+        self.surface = None
+        self.margin = 0  # Отступ плитки от линий сетки
+        self.areas = []  # Номер типа * SPRITE_STATES + состояние -> кусок атласа
+        self.builds = 0  # Сколько раз пересобирали (для отладки)
+        self.waveforms = {}  # (тип, размер, цвет) -> поверхность с волной сэмпла
+
+    def invalidate(self):
+        # Звуки загрузились - плитки и миниатюры нарисовать заново, уже с волной
+        self.tile_size = None
+        self.waveforms = {}
+
+    def ensure(self, tile_size):
+        # Пересобирает атлас под новый размер клетки
+        if tile_size == self.tile_size:
+            return
+        self.tile_size = tile_size
+        self.waveforms = {}  # Старые размеры больше не нужны
+        self.margin = max(1, tile_size // 16)
+        size = tile_size - 2 * self.margin
+        border = 2 if tile_size >= 24 else 0  # На мелком масштабе рамка только мешает
+
+        self.surface = pygame.Surface((size * SPRITE_STATES, size * len(BUILDING_TYPES))).convert()
+        self.areas = []
+        for row, building_type in enumerate(BUILDING_TYPES):
+            color = BUILDING_COLORS.get(building_type, (100, 100, 100))
+            # Волна сэмпла на плитке - только когда её можно разглядеть
+            wave = None
+            if size >= 24:
+                wave = self.waveform(building_type, (size - 2 * border - 4, size // 2), (0, 0, 0), 90,
+                                     envelope=False)
+            for state in range(SPRITE_STATES):
+                rect = pygame.Rect(state * size, row * size, size, size)
+                self.draw_tile(rect, color, state, border)
+                if wave is not None:
+                    self.surface.blit(wave, wave.get_rect(center=rect.center))
+                self.areas.append(rect)
+        self.builds += 1
+
+    def waveform(self, building_type, size, color, opacity=255, envelope=True):
+        """
+        Миниатюра волны сэмпла типа (прозрачная поверхность) или None, если
+        звука нет. Рисуется один раз на размер и цвет: столбцы между
+        минимумом и максимумом заливаются одной маской через surfarray,
+        envelope=True - поверх линией огибающая громкости.
+        """
+        key = (building_type, size, color, opacity, envelope)
+        if key in self.waveforms:
+            return self.waveforms[key]
+
+        analysis = Building.envelopes.get(building_type)
+        width, height = size
+        if analysis is None or width < 2 or height < 2:
+            self.waveforms[key] = None
+            return None
+
+        low, high, loudness = analysis.columns(width)
+        scale = max(float(np.abs(low).max()), float(np.abs(high).max()), 1e-6)
+        middle = (height - 1) / 2
+        top = np.round(middle - high / scale * middle)
+        bottom = np.round(middle - low / scale * middle)
+        ys = np.arange(height)[None, :]
+        mask = (ys >= top[:, None]) & (ys <= bottom[:, None])
+
+        surface = pygame.Surface(size, pygame.SRCALPHA)
+        surface.fill(color)
+        alpha = pygame.surfarray.pixels_alpha(surface)
+        alpha[:] = mask * (opacity // 2 if envelope else opacity)
+        del alpha  # Отпускаем блокировку поверхности
+
+        if envelope:
+            level = loudness / max(float(loudness.max()), 1e-6)
+            points = list(zip(range(width), (height - 1 - level * (height - 1)).tolist()))
+            pygame.draw.lines(surface, (*color, opacity), False, points)
+
+        self.waveforms[key] = surface
+        return surface
+
+    def draw_tile(self, rect, color, state, border):
+        fill, edge, width = color, (255, 255, 255), border
+        if state == SPRITE_MUTED:
+            fill = tuple(c // 3 for c in color)
+            edge = (90, 90, 110)
+        elif state == SPRITE_SOLO:
+            edge, width = (255, 200, 50), border + 1
+        elif state == SPRITE_SELECTED:
+            edge, width = (255, 255, 100), max(2, border * 2)
+        elif state == SPRITE_FLASH:
+            fill = tuple((c + 255) // 2 for c in color)
+
+        pygame.draw.rect(self.surface, fill, rect)
+        if width:
+            pygame.draw.rect(self.surface, edge, rect, width)
+
+    def sprites(self, grid, cols, rows, type_ids, states):
+        # Список для Surface.blits: (атлас, место на экране, кусок атласа)
+        xs = (grid.offset_x + self.margin + cols * grid.tile_size).tolist()
+        ys = (grid.offset_y + self.margin + rows * grid.tile_size).tolist()
+        areas = self.areas
+        keys = (type_ids.astype(np.int64) * SPRITE_STATES + states).tolist()
+        surface = self.surface
+        return [(surface, (x, y), areas[key]) for x, y, key in zip(xs, ys, keys)]
+
+
+def load_pcm(path):
+    """
+    Раскодирует WAV в формат микшера (частота, разрядность, каналы) и
+    разбирает его (SampleEnvelope).
+    Оба результата кешируются в CACHE_DIR по хешу содержимого файла, так
+    что при следующих запусках WAV не разбирается, а кеш звука открывается
+    через memory map. Возвращает (PCM, SampleEnvelope) или (None, None),
+    если файла нет.
+    """
+    if not os.path.exists(path):
+        return None, None
+
+    with open(path, "rb") as f:
+        data = f.read()
+
+    frequency, size, channels = pygame.mixer.get_init()
+    key = hashlib.sha1(data).hexdigest()
+    cache_path = os.path.join(CACHE_DIR, f"{key}_{frequency}_{size}_{channels}.npy")
+    envelope_path = os.path.join(CACHE_DIR, f"{key}_{frequency}_{size}_{channels}_{WAVEFORM_POINTS}.env.npz")
+
+    pcm = None
+    if os.path.exists(cache_path):
+        try:
+            pcm = np.load(cache_path, mmap_mode="r")
+        except (OSError, ValueError):
+            pass  # Битый кеш - раскодируем заново
+
+    if pcm is None:
+        pcm = pygame.sndarray.array(pygame.mixer.Sound(file=io.BytesIO(data)))
+
+        # Пишем через временный файл, чтобы параллельный запуск не прочитал половину
+        try:
+            os.makedirs(CACHE_DIR, exist_ok=True)
+            tmp_path = f"{cache_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp_path, "wb") as f:
+                np.save(f, pcm)
+            os.replace(tmp_path, cache_path)
+        except OSError:
+            pass  # Без кеша тоже работаем
+
+    envelope = None
+    if os.path.exists(envelope_path):
+        envelope = SampleEnvelope.load(envelope_path, frequency)
+    if envelope is None:
+        envelope = SampleEnvelope.from_sample(pcm_to_float(pcm), frequency)
+        envelope.save(envelope_path)
+
+    return pcm, envelope
+
+
+def load_pcm_files(paths):
+    # Раскодирует файлы параллельно, возвращает {путь: (PCM, огибающая)}
+    paths = sorted(set(paths))
+    with ThreadPoolExecutor() as pool:
+        return dict(zip(paths, pool.map(load_pcm, paths)))
+
+
+def pcm_to_float(data):
+    """Переводит PCM в формате микшера в массив float32 (кадры, каналы) в диапазоне -1..1."""
+    if data.ndim == 1:
+        data = data[:, None]
+
+    if data.dtype.kind == "f":
+        return data.astype(np.float32)
+
+    bits = data.dtype.itemsize * 8
+    if data.dtype.kind == "u":
+        # 8-битный звук беззнаковый, ноль посередине
+        return (data.astype(np.float32) - 2 ** (bits - 1)) / 2 ** (bits - 1)
+    return data.astype(np.float32) / 2 ** (bits - 1)
+
+
+class SampleEnvelope:
+    """
+    Разбор сэмпла, общий для измерителя, миниатюр и всего, кому нужна
+    громкость или длина звука: накопленная энергия по кадрам (энергия любого
+    отрезка - разность двух чисел), пики по блокам ENVELOPE_BLOCK кадров,
+    миниатюра волны (минимум и максимум по WAVEFORM_POINTS столбцам) и
+    огибающая громкости (RMS тех же столбцов).
+    Считается один раз на файл и лежит в CACHE_DIR рядом с раскодированным звуком.
+    """
+    FIELDS = ("cum_energy", "block_peaks", "low", "high", "loudness")
+    __slots__ = FIELDS + ("rate",)
+
+    def __init__(self, rate, cum_energy, block_peaks, low, high, loudness):
+        self.rate = rate
+        self.cum_energy = cum_energy
+        self.block_peaks = block_peaks
+        self.low = low
+        self.high = high
+        self.loudness = loudness
+
+    @classmethod
+    def from_sample(cls, sample, rate):
+        # Всё считается векторно: блоки и столбцы - reshape и reduceat
+        power = (sample.astype(np.float64) ** 2).mean(axis=1)
+        cum_energy = np.concatenate(([0.0], np.cumsum(power)))
+
+        blocks = -(-len(sample) // ENVELOPE_BLOCK)
+        padded = np.zeros((blocks * ENVELOPE_BLOCK, sample.shape[1]), dtype=np.float32)
+        padded[:len(sample)] = np.abs(sample)
+        block_peaks = padded.reshape(blocks, -1).max(axis=1)
+
+        # Столбцы миниатюры по моно-сумме каналов
+        mono = sample.mean(axis=1)
+        frames = max(1, len(mono))
+        if not len(mono):
+            mono = np.zeros(1, dtype=np.float32)
+        bounds = np.arange(WAVEFORM_POINTS + 1) * frames // WAVEFORM_POINTS
+        starts = np.minimum(bounds[:-1], frames - 1)
+        low = np.minimum.reduceat(mono, starts).astype(np.float32)
+        high = np.maximum.reduceat(mono, starts).astype(np.float32)
+        widths = np.maximum(1, np.diff(bounds))
+        loudness = np.sqrt(np.diff(cum_energy[np.minimum(bounds, len(cum_energy) - 1)]) / widths)
+
+        return cls(rate, cum_energy, block_peaks, low, high, loudness.astype(np.float32))
+
+    @classmethod
+    def load(cls, path, rate):
+        # Разбор из дискового кеша или None
+        try:
+            with np.load(path) as data:
+                return cls(rate, *(data[name] for name in cls.FIELDS))
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def save(self, path):
+        # Тоже через временный файл - кеш могут читать параллельно
+        try:
+            tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp_path, "wb") as f:
+                np.savez(f, **{name: getattr(self, name) for name in self.FIELDS})
+            os.replace(tmp_path, path)
+        except OSError:
+            pass
+
+    @property
+    def frames(self):
+        return len(self.cum_energy) - 1
+
+    @property
+    def length(self):
+        # Длина в секундах
+        return self.frames / self.rate
+
+    @property
+    def peak(self):
+        return float(self.block_peaks.max()) if len(self.block_peaks) else 0.0
+
+    @property
+    def rms(self):
+        return float(np.sqrt(self.cum_energy[-1] / self.frames)) if self.frames else 0.0
+
+    def columns(self, width):
+        """
+        Миниатюра на width столбцов: (минимум, максимум, громкость).
+        Узкая - пики соседних столбцов сливаются, широкая - столбцы повторяются.
+        """
+        if width >= WAVEFORM_POINTS:
+            index = np.arange(width) * WAVEFORM_POINTS // width
+            return self.low[index], self.high[index], self.loudness[index]
+        starts = np.arange(width) * WAVEFORM_POINTS // width
+        return (np.minimum.reduceat(self.low, starts),
+                np.maximum.reduceat(self.high, starts),
+                np.maximum.reduceat(self.loudness, starts))
+
+
+def step_profile(envelope, step_samples, period=STEPS_PER_BAR):
+    """
+    Энергия и пик сэмпла по шагам после удара, свёрнутые по кругу в period
+    шагов (хвост, ушедший за конец, ложится на начало следующего повтора).
+    """
+    cum_energy, block_peaks = envelope.cum_energy, envelope.block_peaks
+    frames = envelope.frames
+    steps = max(1, int(np.ceil(frames / step_samples)))
+
+    bounds = np.minimum(np.round(np.arange(steps + 1) * step_samples).astype(int), frames)
+    energy = np.diff(cum_energy[bounds])
+
+    first_block = np.minimum(bounds[:-1] // ENVELOPE_BLOCK, len(block_peaks) - 1)
+    peaks = np.maximum.reduceat(block_peaks, first_block)
+
+    # Сворачиваем по повторам
+    folded_energy = np.zeros(period)
+    folded_peaks = np.zeros(period)
+    np.add.at(folded_energy, np.arange(steps) % period, energy)
+    np.add.at(folded_peaks, np.arange(steps) % period, peaks)
+    return folded_energy, folded_peaks
+
+
+def pitch_sample(sample, semitones):
+    # Сэмпл на semitones полутонов выше (или ниже): читаем его быстрее
+    # (медленнее) с линейной интерполяцией, векторно по всем кадрам
+    ratio = 2.0 ** (semitones / 12.0)
+    positions = np.arange(0.0, len(sample) - 1, ratio)
+    index = positions.astype(np.int64)
+    frac = (positions - index).astype(np.float32)[:, None]
+    return sample[index] * (1.0 - frac) + sample[index + 1] * frac
+
+
+class PitchCache:
+    """
+    Транспонированные звуки для нот шагов: LRU-кеш по (файл, полутоны) с
+    пределом памяти. Пересэмплирование идёт в фоновом потоке, так что
+    get() никогда не ждёт: при промахе он возвращает None и ставит ноту в
+    очередь (удар пока играет без транспонирования). Редактор зовёт warm()
+    при правке ноты, поэтому к первому удару нота обычно уже готова.
+    """
+
+    def __init__(self, limit=PITCH_CACHE_BYTES):
+        self.limit = limit
+        self.entries = OrderedDict()  # (файл, полутоны) -> (массив, Sound, байт)
+        self.pending = set()  # Что сейчас пересэмплируется
+        self.bytes = 0
+
+        # Счётчики
+        self.hits = 0
+        self.misses = 0
+        self.evicted = 0
+
+        # get() зовут поток секвенсера и шина, заполняет фоновый поток
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="pitch")
+
+    def get(self, building_type, semitones):
+        # (массив float32, Sound) для ноты или None, если она ещё не готова
+        key = (Building.files.get(building_type), int(semitones))
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[:2]
+            self.misses += 1
+        self.request(key, building_type)
+        return None
+
+    def drain(self):
+        # Ждёт, пока готовы все заказанные ноты (для экспорта, где ждать можно)
+        self.executor.submit(int).result()
+
+    def warm(self, building_type, semitones):
+        # Готовит ноту заранее, не считая это обращением
+        key = (Building.files.get(building_type), int(semitones))
+        with self.lock:
+            if key in self.entries:
+                return
+        self.request(key, building_type)
+
+    def request(self, key, building_type):
+        sample = Building.samples.get(building_type)
+        with self.lock:
+            if sample is None or key in self.pending:
+                return
+            self.pending.add(key)
+        self.executor.submit(self.build, key, sample)
+
+    def build(self, key, sample):
+        # Фоновый поток: пересэмплирует и вытесняет давно не нужные ноты.
+        # Нота, которую не удалось собрать, снимается с очереди - следующий
+        # промах закажет её заново
+        try:
+            pitched = pitch_sample(sample, key[1])
+            sound = None
+            size = pitched.nbytes
+            if pygame.mixer.get_init():
+                pcm = float_to_pcm(pitched)
+                sound = pygame.sndarray.make_sound(pcm)
+                size += pcm.nbytes
+
+            with self.lock:
+                self.entries[key] = (pitched, sound, size)
+                self.bytes += size
+                while self.bytes > self.limit and len(self.entries) > 1:
+                    _, (_, _, old_size) = self.entries.popitem(last=False)
+                    self.bytes -= old_size
+                    self.evicted += 1
+        except Exception as error:
+            print(f"Не удалось транспонировать {key[0]} на {key[1]:+d}: {error}")
+        finally:
+            with self.lock:
+                self.pending.discard(key)
+
+
+class Meter:
+    """
+    Измеритель громкости микса по настоящим сэмплам.
+
+    Громкости ударов берутся из скомпилированной партитуры (Timeline) - той
+    же, что играет секвенсер, так что цепочки тактов, 32-е и триоли учтены.
+    Для каждого типа копится сумма громкостей звучащих зданий по тикам
+    песни: здания одного типа на одном тике складываются по амплитуде,
+    разные типы и хвосты - по энергии. RMS и пики по тикам - круговая
+    свёртка этих сумм с огибающей сэмпла (через FFT), так что стоимость
+    зависит от числа ударов, а не от длины сэмплов. Пересчёт идёт, когда
+    спросят level(), и только если партитура опубликовала новые массивы,
+    сменился темп или здания менялись (invalidate).
+    """
+
+    def __init__(self, bpm):
+        self.profiles = {}  # Тип -> FFT (энергии, пиков) сэмпла по тикам песни
+        self.profile_ticks = 0  # Длина песни в тиках, для которой посчитаны профили
+        self.tick_samples = 1.0
+        self.set_bpm(bpm)
+
+        # Результаты
+        self.tick_rms = np.zeros(0)
+        self.tick_peak = np.zeros(0)
+        self.song_rms = 0.0
+        self.song_peak = 0.0
+        self.published = None  # Массив тиков партитуры, по которому они посчитаны
+        self.dirty = False
+
+    def set_bpm(self, bpm):
+        # При смене темпа меняется длина тика - профили сэмплов считаем заново
+        rate = pygame.mixer.get_init()[0] if pygame.mixer.get_init() else 44100
+        self.tick_samples = rate * 60.0 / bpm / STEPS_PER_BEAT / TICKS_PER_STEP
+        self.profiles = {}
+        self.dirty = True
+
+    def invalidate(self):
+        # Здания изменились (mute и solo партитура не пересобирает)
+        self.dirty = True
+
+    def profile(self, building_type, ticks):
+        # Спектры энергии и пиков сэмпла, свёрнутых по кругу в песню из ticks тиков
+        if ticks != self.profile_ticks:
+            self.profiles = {}
+            self.profile_ticks = ticks
+        if building_type not in self.profiles:
+            envelope = Building.envelopes.get(building_type)
+            self.profiles[building_type] = None if envelope is None else tuple(
+                np.fft.rfft(part) for part in step_profile(envelope, self.tick_samples, ticks))
+        return self.profiles[building_type]
+
+    def compute(self, timeline):
+        # Пересчитывает RMS и пики микса по тикам и за всю песню
+        store = timeline.store
+        with timeline.lock:
+            tick, slot, gain = timeline.tick, timeline.slot, timeline.gain
+            ticks = timeline.bars * TICKS_PER_BAR
+        heard = store.audible_slots()[slot]
+        types = store.type_id[slot[heard]].astype(np.int64)
+        amps = np.bincount(types * ticks + tick[heard], weights=gain[heard],
+                           minlength=len(BUILDING_TYPES) * ticks).reshape(len(BUILDING_TYPES), ticks)
+
+        energy = np.zeros(ticks)
+        peak = np.zeros(ticks)
+        for type_id in np.flatnonzero(amps.any(axis=1)):
+            profile = self.profile(BUILDING_TYPES[type_id], ticks)
+            if profile is None:
+                continue
+            profile_energy, profile_peaks = profile
+            a = amps[type_id]
+            energy += np.fft.irfft(profile_energy * np.fft.rfft(a * a), ticks)
+            peak += np.fft.irfft(profile_peaks * np.fft.rfft(a), ticks)
+        # После FFT вместо нулей бывают -1e-17 - корень из них не берём
+        energy = np.maximum(energy, 0.0)
+
+        self.tick_rms = np.sqrt(energy / self.tick_samples)
+        self.tick_peak = peak
+        self.song_rms = float(np.sqrt(energy.sum() / (self.tick_samples * ticks)))
+        self.song_peak = float(peak.max())
+        self.published = tick
+        self.dirty = False
+
+    def level(self, timeline):
+        # Уровень для индикатора и целей уровня (0..1): RMS песни относительно RMS_REFERENCE
+        if self.dirty or timeline.tick is not self.published:
+            self.compute(timeline)
+        return min(1.0, self.song_rms / RMS_REFERENCE)
+
+
+def solve_level(level, timeline, bpm):
+    """
+    Подсказка к уровню: ближайшая к построенному городу конфигурация, которая
+    проходит target_buildings, required_bpm и max_volume вместе.
+
+    Кандидаты - все сочетания темпа, типов недостающих зданий (с паттерном и
+    громкостью по умолчанию) и потолка громкости зданий - оцениваются разом
+    массивами. Громкость считается по тем же ударам опубликованной партитуры
+    (Timeline), что и у Meter, так что цепочки тактов, 32-е и триоли учтены.
+    Свёртка по кругу сохраняет энергию, поэтому RMS песни в квадрате - это
+    bpm * сумма по типам (энергия сэмпла * сумма квадратов громкостей по тикам)
+    с постоянным множителем, и сетка кандидатов сводится к паре умножений матриц.
+    Цена кандидата - сколько громкости снято со зданий плюс HINT_BPM_COST за
+    каждый BPM_STEP темпа. Возвращает словарь (bpm, add - тип -> сколько
+    поставить, new_volume - их громкость, cap - потолок громкости или None,
+    quieter - слоты, которым убавить громкость до cap, level - уровень после
+    правок) или None, если пройти нельзя.
+    """
+    store = timeline.store
+    types = len(BUILDING_TYPES)
+    rate = pygame.mixer.get_init()[0] if pygame.mixer.get_init() else 44100
+    energy = np.array([Building.envelopes[name].cum_energy[-1] if Building.envelopes.get(name) is not None else 0.0
+                       for name in BUILDING_TYPES])
+
+    # Удары звучащих зданий (как в Meter: mute и solo учтены)
+    with timeline.lock:
+        tick, slot, gain = timeline.tick, timeline.slot, timeline.gain
+        song_bars = timeline.bars
+    ticks = song_bars * TICKS_PER_BAR
+    audible = store.audible_slots()
+    heard = audible[slot]
+    slots = np.flatnonzero(audible)
+    with store.lock:
+        cell = store.type_id[slot[heard]].astype(np.uint64) * ticks + tick[heard].astype(np.uint64)
+
+    # Одинаковые удары (тип, тик, громкость) считаем одной строкой с весом
+    keys = cell << 32 | gain[heard].view(np.uint32).astype(np.uint64)
+    keys, counts = np.unique(keys, return_counts=True)
+    hit_gain = (keys & 0xFFFFFFFF).astype(np.uint32).view(np.float32).astype(np.float64)
+    cells, first = np.unique((keys >> 32).astype(np.int64), return_index=True)
+    cell_type = cells // ticks
+
+    # Кандидаты: темп, потолок громкости, сколько зданий какого типа добавить
+    if level["required_bpm"] is not None:
+        bpms = np.array([level["required_bpm"]], dtype=np.float64)
+    elif level["max_volume"] is not None:
+        bpms = np.arange(MIN_BPM, MAX_BPM + 1, BPM_STEP, dtype=np.float64)
+    else:
+        bpms = np.array([bpm], dtype=np.float64)
+    if level["max_volume"] is not None:
+        caps = np.arange(round(1.0 / HINT_VOLUME_STEP), -1, -1) * HINT_VOLUME_STEP
+    else:
+        caps = np.array([1.0])
+
+    missing = max(0, level["target_buildings"] - store.count)
+    bars = np.array(list(itertools.combinations(range(missing + types - 1), types - 1)), dtype=np.int64)
+    bars = bars.reshape(-1, types - 1)
+    added = np.diff(np.concatenate([np.full((len(bars), 1), -1), bars,
+                                    np.full((len(bars), 1), missing + types - 1)], axis=1)) - 1
+
+    # Громкость каждого (тип, тик) при каждом потолке: потолок режет каждый удар
+    amps = np.zeros((len(cells), len(caps)))
+    if len(cells):
+        capped = np.minimum(hit_gain[:, None], caps[None, :]) * counts[:, None]
+        amps = np.add.reduceat(capped, first, axis=0)
+    square = np.zeros((types, len(caps)))
+    np.add.at(square, cell_type, amps ** 2)
+
+    # Новые здания ставятся с громкостью 0.7 и паттерном по умолчанию (в каждом
+    # такте песни), а при соло не звучат
+    default_bits = mask_to_bits(np.array([pattern_to_mask(make_default_pattern(name))
+                                          for name in BUILDING_TYPES], dtype=np.uint16)).astype(np.float64)
+    new_amps = np.minimum(0.0 if store.any_solo() else 0.7, caps)
+    bar_tick = cells % TICKS_PER_BAR
+    on_step = bar_tick % TICKS_PER_STEP == 0
+    shared = np.zeros((types, len(caps)))
+    np.add.at(shared, cell_type[on_step],
+              amps[on_step] * default_bits[cell_type[on_step], bar_tick[on_step] // TICKS_PER_STEP, None])
+
+    # Сумма квадратов по тикам для (набор, потолок): (a + k * d)^2 по типам
+    cross = energy[:, None] * 2 * shared * new_amps
+    new_square = (energy * default_bits.sum(axis=1) * song_bars)[:, None] * new_amps ** 2
+    total = (energy @ square)[None, :] + added @ cross + (added ** 2) @ new_square
+
+    # Уровень как у Meter.level для каждого (темп, набор, потолок)
+    song_samples = rate * 60.0 / STEPS_PER_BEAT / TICKS_PER_STEP * ticks
+    levels = np.minimum(1.0, np.sqrt(bpms[:, None, None] * total[None] / song_samples) / RMS_REFERENCE)
+    passing = np.ones(levels.shape, dtype=np.bool_)
+    if level["max_volume"] is not None:
+        passing = levels <= level["max_volume"]
+    if not passing.any():
+        return None
+
+    # Цена: снятая громкость, сдвиг темпа; при равной цене - новые типы, а не повторы
+    n = store.size
+    have = np.bincount(store.type_id[:n][store.alive[:n]], minlength=types)
+    volume, volume_counts = np.unique(store.volume[slots].astype(np.float64), return_counts=True)
+    volume_cost = volume_counts @ (volume[:, None] - np.minimum(volume[:, None], caps[None, :]))
+    bpm_cost = np.abs(bpms - bpm) / BPM_STEP * HINT_BPM_COST
+    repeat_cost = 1e-3 * (added * (added - 1 + 2 * have)).sum(axis=1)
+    cost = bpm_cost[:, None, None] + repeat_cost[None, :, None] + volume_cost[None, None, :]
+    cost = np.where(passing, cost, np.inf)
+    b, m, c = np.unravel_index(np.argmin(cost), cost.shape)
+
+    cap = float(caps[c])
+    changed = slots[store.volume[slots] > cap + 1e-6]
+    return {
+        "bpm": int(bpms[b]),
+        "add": {name: int(k) for name, k in zip(BUILDING_TYPES, added[m]) if k},
+        "new_volume": min(0.7, cap),
+        "cap": cap if len(changed) or cap < 0.7 else None,
+        "quieter": changed,
+        "level": float(levels[b, m, c]),
+    }
+
+
+def song_events(buildings, timeline, only=None):
+    """
+    Удары звучащих зданий (mute и solo учтены) из опубликованной партитуры:
+    тики от начала песни, типы, ноты, громкости левого и правого канала
+    (кадры, 2) с учётом панорамы - и длина песни в тиках. only - только
+    удары этого слота.
+    """
+    with timeline.lock:
+        tick, slot, gain, note = timeline.tick, timeline.slot, timeline.gain, timeline.note
+        song_ticks = timeline.bars * TICKS_PER_BAR
+    heard = buildings.audible_slots()[slot]
+    if only is not None:
+        heard &= slot == only
+    slot = slot[heard]
+    with buildings.lock:
+        type_id, pan = buildings.type_id[slot], buildings.pan[slot]
+    gains = gain[heard, None] * np.stack(pan_gains(pan), axis=1)
+    return tick[heard], type_id, note[heard], gains.astype(np.float32), song_ticks
+
+
+def note_length(frames, lowest):
+    # Длина звука в frames кадров на самой низкой ноте lowest (ниже - длиннее)
+    return int(np.ceil(frames * 2.0 ** (max(0, -lowest) / 12.0)))
+
+
+def song_tail(buildings, lowest=0):
+    # Хвост после последнего удара: самый длинный звук звучащих типов на
+    # самой низкой ноте песни
+    with buildings.lock:
+        types = np.unique(buildings.type_id[np.flatnonzero(buildings.audible())])
+    longest = max((len(Building.samples[BUILDING_TYPES[type_id]]) for type_id in types.tolist()
+                   if Building.samples.get(BUILDING_TYPES[type_id]) is not None), default=0)
+    return note_length(longest, lowest)
+
+
+def note_sample(type_id, note):
+    # Сэмпл типа на ноте из Building.pitch (пока нота не готова - исходный)
+    building_type = BUILDING_TYPES[type_id]
+    if note and Building.pitch is not None:
+        pitched = Building.pitch.get(building_type, note)
+        if pitched is not None:
+            return pitched[0]
+    return Building.samples.get(building_type)
+
+
+def prepare_notes(type_id, note):
+    # Транспонирует все ноты ударов и ждёт их - для сведения вне реального
+    # времени, где ждать можно и ни один удар не должен звучать на исходной высоте
+    if Building.pitch is None:
+        return
+    pitched = note != 0
+    for type_index, semitones in set(zip(type_id[pitched].tolist(), note[pitched].tolist())):
+        Building.pitch.warm(BUILDING_TYPES[type_index], semitones)
+    Building.pitch.drain()
+
+
+def render_hits(tick, type_id, note, gains, tick_frames, length):
+    """
+    Сводит удары в массив float32 (length, 2); gains - громкости каналов
+    (удары, 2). Удары одного типа и одной ноты на одном кадре сначала
+    складываются в одни громкости (одна векторная группировка на все
+    удары), так что сэмпл кладётся один раз на звук и кадр, сколько бы
+    зданий ни звучало. Ноты берутся из Building.pitch (см. prepare_notes).
+    """
+    out = np.zeros((length, 2), dtype=np.float32)
+    onsets = np.round(tick * tick_frames).astype(np.int64)
+    voices = type_id.astype(np.int64) * 256 + note + 128
+    keys, inverse = np.unique(voices * length + onsets, return_inverse=True)
+    inverse = inverse.ravel()
+    summed = np.stack([np.bincount(inverse, weights=gains[:, side], minlength=len(keys))
+                       for side in (0, 1)], axis=1).astype(np.float32)
+    for key, hit_gain in zip(keys.tolist(), summed):
+        voice, start = divmod(key, length)
+        sample = note_sample(voice // 256, voice % 256 - 128)
+        if sample is None:
+            continue
+        part = out[start:start + len(sample)]
+        part += hit_gain * sample[:len(part)]
+    return out
+
+
+def limit_buffer(out, rate):
+    """
+    Мастер-ограничитель шины (AudioMixer.limit) сразу по всей записи, на
+    месте: блоки по AUDIO_BLOCK кадров, громкость к концу блока не выше
+    допустимой ни для него, ни для следующего, и отпускается за
+    LIMITER_RELEASE. Пики блоков и плавные переходы громкости считаются
+    векторно, по блокам идёт только сама громкость. Задержки на блок, как
+    у шины, здесь нет - следующий блок уже известен.
+    """
+    blocks = -(-len(out) // AUDIO_BLOCK)
+    padded = np.zeros((blocks * AUDIO_BLOCK, out.shape[1]), dtype=np.float32)
+    padded[:len(out)] = out
+    peaks = np.abs(padded.reshape(blocks, -1)).max(axis=1)
+    targets = np.minimum(1.0, LIMITER_CEILING / np.maximum(peaks, 1e-12))
+    if targets.min() >= 1.0:
+        return out
+
+    release = 1.0 - math.exp(-AUDIO_BLOCK / rate / LIMITER_RELEASE)
+    ahead = np.minimum(targets, np.append(targets[1:], 1.0)).tolist()
+    # Громкость успевает опуститься к началу первого блока - как у шины,
+    # пока ограничитель держал задержанный блок тишины
+    first = float(targets[0])
+    ends = np.empty(blocks)
+    gain = first
+    for block, target in enumerate(ahead):
+        gain = min(target, gain + (1.0 - gain) * release)
+        ends[block] = gain
+    starts = np.concatenate(([first], ends[:-1]))
+    ramp = np.arange(AUDIO_BLOCK, dtype=np.float32) / AUDIO_BLOCK
+    gains = (starts[:, None] + (ends - starts)[:, None] * ramp).astype(np.float32).ravel()
+    out *= gains[:len(out), None]
+    return out
+
+
+def render_song(buildings, timeline, bpm, rate, frames, steps=None, only=None, limit=False):
+    """
+    Сводит frames кадров города с нулевого такта в массив float32 (кадры, 2)
+    по опубликованной партитуре (Timeline) - той же, что играет секвенсер.
+    steps - сколько шагов раскладывать на удары (по умолчанию - на все
+    frames; дальше доигрывают хвосты), only - только этот слот, limit -
+    пропустить запись через мастер-ограничитель (limit_buffer). Здесь ждать
+    можно, поэтому все ноты партитуры сначала транспонируются.
+    Песня крутится по кругу, поэтому один её проход (с хвостами) сводится
+    один раз и складывается со сдвигом на каждый повтор; последний неполный
+    проход сводится отдельно.
+    """
+    tick_frames = rate * 60.0 / bpm / STEPS_PER_BEAT / TICKS_PER_STEP
+    tick, type_id, note, gain, song_ticks = song_events(buildings, timeline, only)
+    prepare_notes(type_id, note)
+    if steps is None:
+        steps = int(np.ceil(frames / (tick_frames * TICKS_PER_STEP)))
+    loops, rest = divmod(steps * TICKS_PER_STEP, song_ticks)
+    length = int(np.ceil(song_ticks * tick_frames)) + song_tail(buildings, int(note.min(initial=0)))
+
+    out = np.zeros((frames, 2), dtype=np.float32)
+    passes = []
+    if loops:
+        passes.append((range(loops), render_hits(tick, type_id, note, gain, tick_frames, length)))
+    if rest:
+        head = tick < rest
+        passes.append(([loops], render_hits(tick[head], type_id[head], note[head], gain[head],
+                                            tick_frames, length)))
+    for repeats, song in passes:
+        for repeat in repeats:
+            start = int(round(repeat * song_ticks * tick_frames))
+            part = out[start:start + len(song)]
+            part += song[:len(part)]
+    return limit_buffer(out, rate) if limit else out
+
+
+def render_city(buildings, timeline, bpm, bars, rate, stem_callback=None):
+    """
+    Сводит bars тактов города в массив float32 (кадры, 2) без pygame.mixer
+    по той же партитуре (Timeline), что играет секвенсер, вместе с
+    мастер-ограничителем шины. Учитывает цепочки тактов, ноты, громкость,
+    панораму, mute и solo.
+    Если задан stem_callback(building, stem), то для каждого звучащего здания
+    рендерится отдельная дорожка (без ограничителя); она сразу отдаётся в
+    колбэк и не хранится, иначе на больших городах не хватит памяти.
+    """
+    steps = bars * STEPS_PER_BAR
+    step_frames = rate * 60.0 / bpm / STEPS_PER_BEAT
+    with timeline.lock:
+        lowest = int(timeline.note.min(initial=0))
+    length = int(np.ceil(steps * step_frames)) + song_tail(buildings, lowest)
+
+    if stem_callback:
+        for slot in np.flatnonzero(buildings.audible_slots()).tolist():
+            building = buildings.view(slot)
+            if Building.samples.get(building.type) is None:
+                continue
+            stem_callback(building, render_song(buildings, timeline, bpm, rate, length, steps,
+                                                only=slot))
+
+    return render_song(buildings, timeline, bpm, rate, length, steps, limit=True)
+
+
+def fold_bar(bar, bar_frames):
+    # Сворачивает звук с хвостами в петлю длиной bar_frames:
+    # хвост, ушедший за конец, ложится на начало следующего повтора
+    out = np.zeros((bar_frames, bar.shape[1]), dtype=np.float32)
+    for start in range(0, len(bar), bar_frames):
+        part = bar[start:start + bar_frames]
+        out[:len(part)] += part
+    return out
+
+
+def float_to_pcm(data):
+    # float -1..1 (кадры, каналы) -> PCM в формате микшера (обратное pcm_to_float).
+    # Моно микшер берёт одномерный массив - каналы сводятся в один
+    _, size, channels = pygame.mixer.get_init()
+    if channels == 1 and data.ndim == 2:
+        data = data.mean(axis=1)
+    data = np.clip(data, -1.0, 1.0)
+    if size == 32:
+        return data.astype(np.float32)
+
+    bits = abs(size)
+    if size > 0:
+        # Беззнаковый формат, ноль посередине
+        dtype = np.uint8 if bits == 8 else np.uint16
+        return ((data + 1.0) * (2 ** (bits - 1) - 1)).astype(dtype)
+    dtype = {8: np.int8, 16: np.int16, 32: np.int32}[bits]
+    return (data * (2 ** (bits - 1) - 1)).astype(dtype)
+
+
+class BarLoop:
+    """
+    Режим петли: вся песня (timeline.bars тактов) со всеми зданиями заранее
+    сводится в один звук, который играет на одном канале. Сводится та же
+    партитура, что играет секвенсер, так что цепочки тактов звучат как при
+    обычной игре; хвосты, ушедшие за конец песни, ложатся на её начало.
+    На середине первого такта в канал ставится в очередь следующий повтор
+    (или новое сведение после правок), поэтому замена проходит без разрыва
+    на границе, а стоимость воспроизведения не зависит от числа зданий.
+
+    Когда партитура опубликовала новые массивы (follow), фоновый поток
+    пересводит только те типы зданий, у которых поменялись удары (тики, ноты
+    и громкости каналов): здания одного типа играют один сэмпл.
+    """
+
+    def __init__(self, game, channel_index):
+        self.game = game
+        self.enabled = False
+
+        # Отдельный канал сверх голосов зданий
+        pygame.mixer.set_num_channels(channel_index + 1)
+        pygame.mixer.set_reserved(channel_index + 1)
+        self.channel = pygame.mixer.Channel(channel_index)
+
+        self.sound = None  # Петля, которая играет сейчас
+        self.pending = None  # Новое сведение, ждёт начала петли
+        self.restart = False  # Сменилась длина петли - на её начале перезапускаем канал
+
+        # Кеш сведения по типам
+        self.bpm = None  # Темп и длина песни, с которыми сведена петля
+        self.bars = 1
+        self.published = None  # Массив тиков партитуры, по которому она сведена
+        self.type_hits = {}  # Тип -> (тики, ноты, громкости каналов), с которыми сведена его петля
+        self.type_loops = {}  # Тип -> свёрнутая петля
+        self.renders = 0  # Сколько раз пересводили тип (для отладки)
+
+        self.dirty = threading.Event()
+        self.thread = None
+
+    def set_enabled(self, enabled):
+        self.enabled = enabled
+        if enabled:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name="bar-loop", daemon=True)
+                self.thread.start()
+            self.restart = True
+            self.invalidate()
+        else:
+            self.channel.stop()
+
+    def invalidate(self):
+        # Город изменился - пересвести в фоне
+        if self.enabled:
+            self.dirty.set()
+
+    def follow(self, timeline):
+        # Game.update после refresh: партитура опубликовала новые массивы
+        if timeline.tick is not self.published:
+            self.invalidate()
+
+    def stop(self):
+        self.channel.stop()
+
+    def run(self):
+        # Фоновый поток сведения
+        while True:
+            self.dirty.wait()
+            self.dirty.clear()
+            self.render()
+
+    def render(self):
+        # Пересводит изменившиеся типы и готовит новую петлю
+        bpm = self.game.sequencer.bpm
+        timeline = self.game.timeline
+        rate = pygame.mixer.get_init()[0]
+        self.published = timeline.tick
+        tick, type_id, note, gains, song_ticks = song_events(self.game.buildings, timeline)
+        bars = song_ticks // TICKS_PER_BAR
+
+        if (bpm, bars) != (self.bpm, self.bars):
+            # Другая длина петли - сводим всё заново, старую нельзя доигрывать до конца
+            self.bpm, self.bars = bpm, bars
+            self.type_hits = {}
+            self.type_loops = {}
+            if self.sound is not None:
+                self.restart = True
+
+        tick_frames = rate * 60.0 / bpm / STEPS_PER_BEAT / TICKS_PER_STEP
+        loop_frames = int(round(tick_frames * song_ticks))
+        for index, building_type in enumerate(BUILDING_TYPES):
+            sample = Building.samples.get(building_type)
+            mine = type_id == index
+            hits = (tick[mine], note[mine], gains[mine])
+            if sample is None or not len(hits[0]):
+                self.type_hits.pop(building_type, None)
+                self.type_loops.pop(building_type, None)
+                continue
+
+            old = self.type_hits.get(building_type)
+            if old is not None and all(np.array_equal(a, b) for a, b in zip(old, hits)):
+                continue
+
+            self.type_hits[building_type] = hits
+            prepare_notes(type_id[mine], hits[1])
+            song = render_hits(hits[0], type_id[mine], hits[1], hits[2], tick_frames,
+                               loop_frames + note_length(len(sample), int(hits[1].min())))
+            self.type_loops[building_type] = fold_bar(song, loop_frames)
+            self.renders += 1
+
+        mix = np.zeros((loop_frames, 2), dtype=np.float32)
+        for loop in self.type_loops.values():
+            mix += loop
+
+        self.pending = pygame.sndarray.make_sound(float_to_pcm(mix))
+
+    def take_sound(self):
+        # Следующий повтор: новое сведение, если готово, иначе то же самое
+        if self.pending is not None:
+            self.sound = self.pending
+            self.pending = None
+        return self.sound
+
+    def on_step(self, step, bar):
+        # Вызывается секвенсером вместо запуска звуков зданий
+        position = bar % self.bars * STEPS_PER_BAR + step
+        if position == 0:
+            if self.restart or not self.channel.get_busy():
+                sound = self.take_sound()
+                if sound is not None:
+                    self.channel.play(sound)
+                    self.restart = False
+        elif position == STEPS_PER_BAR // 2 and not self.restart:
+            sound = self.take_sound()
+            if sound is not None:
+                self.channel.queue(sound)
+
+
+def write_wav(path, data, rate, chunk=65536):
+    # Записывает float-массив в 16-битный WAV (с обрезкой по ±1).
+    # Переводим кусками - так не нужна вторая копия всей записи
+    with wave.open(path, "wb") as f:
+        f.setnchannels(data.shape[1])
+        f.setsampwidth(2)
+        f.setframerate(rate)
+
+        buf = np.empty((chunk, data.shape[1]), dtype=np.float32)
+        for start in range(0, len(data), chunk):
+            part = buf[:len(data) - start] if start + chunk > len(data) else buf
+            np.clip(data[start:start + len(part)], -1.0, 1.0, out=part)
+            part *= 32767
+            f.writeframes(part.astype("<i2"))
+
+
+def city_header(game, records):
+    # Заголовок файла города: темп, прогресс уровня, размер города
+    header = np.zeros(1, dtype=CITY_HEADER)
+    header["magic"] = CITY_MAGIC
+    header["version"] = CITY_VERSION
+    header["bpm"] = game.sequencer.bpm
+    header["level"] = game.current_level_index
+    header["completed"] = game.level_completed
+    header["bars"] = game.bars_playing
+    header["cols"] = game.grid.cols
+    header["rows"] = game.grid.rows
+    header["records"] = records
+    return header
+
+
+def save_city(game, path):
+    # Записывает город целиком. Пишем во временный файл и подменяем,
+    # чтобы при сбое не остаться с половиной сохранения
+    store = game.buildings
+    with store.lock:
+        records = store.records()
+        store.changed = set()
+
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(city_header(game, len(records)).tobytes())
+        f.write(records.tobytes())
+    os.replace(tmp_path, path)
+    save_chains(game.timeline, path)
+    return len(records)
+
+
+def save_chains(timeline, path):
+    # Цепочки тактов и ноты (их мало, и они разной длины) лежат рядом с
+    # файлом города в JSON: .chains - {слот: [[шагов, маска], ...]},
+    # .notes - {слот: [полутоны по 16 шагам]}
+    with timeline.lock:
+        sidecars = {
+            ".chains": {str(slot): chain for slot, chain in timeline.chains.items()},
+            ".notes": {str(slot): list(notes) for slot, notes in timeline.notes.items()},
+        }
+    for suffix, data in sidecars.items():
+        sidecar_path = path + suffix
+        if data:
+            with open(sidecar_path, "w", encoding="utf-8") as f:
+                json.dump(data, f)
+        elif os.path.exists(sidecar_path):
+            os.remove(sidecar_path)
+
+
+def load_chains(path):
+    # Цепочки тактов для файла города (если они есть)
+    chains_path = path + ".chains"
+    if not os.path.exists(chains_path):
+        return {}
+    with open(chains_path, encoding="utf-8") as f:
+        return {int(slot): intern_pattern(tuple(tuple(bar) for bar in chain))
+                for slot, chain in json.load(f).items()}
+
+
+def load_notes(path):
+    # Ноты шагов для файла города (если они есть)
+    notes_path = path + ".notes"
+    if not os.path.exists(notes_path):
+        return {}
+    with open(notes_path, encoding="utf-8") as f:
+        return {int(slot): intern_pattern(tuple(notes)) for slot, notes in json.load(f).items()}
+
+
+def open_city(path):
+    """
+    Открывает файл города: возвращает заголовок и записи зданий.
+    Записи не читаются, а отображаются в память (np.memmap), так что
+    огромный город открывается сразу, а с диска подтягивается по мере чтения.
+    Файлы прошлых версий читаются их форматом записи (CITY_RECORDS).
+    """
+    header = np.fromfile(path, dtype=CITY_HEADER, count=1)
+    if len(header) == 0 or header["magic"][0] != CITY_MAGIC:
+        raise ValueError(f"{path}: это не файл города")
+    header = header[0]
+    if header["version"] > CITY_VERSION:
+        raise ValueError(f"{path}: файл новой версии {header['version']}")
+
+    count = int(header["records"])
+    record = CITY_RECORDS[int(header["version"])]
+    if count == 0:
+        return header, np.zeros(0, dtype=record)
+    records = np.memmap(path, dtype=record, mode="r",
+                        offset=CITY_HEADER.itemsize, shape=(count,))
+    return header, records
+
+
+class Autosave:
+    """
+    Автосохранение города в фоновом потоке.
+
+    Раз в interval секунд (или сразу по request()) в файл дописываются только
+    записи слотов, изменённых с прошлого сохранения, и заголовок. Под
+    блокировкой хранилища лишь копируются эти записи, диск - в потоке,
+    так что кадр не ждёт. Если город заменили целиком (очистка, загрузка
+    другого файла) - файл переписывается полностью.
+
+    Чужой файл не затирается: писать можно только в файл, который эта игра
+    загрузила (synced) или сохранила по F5 (request), либо которого ещё нет.
+    """
+
+    def __init__(self, game, path, interval=AUTOSAVE_INTERVAL):
+        self.game = game
+        self.path = path
+        self.interval = interval
+        self.store = None  # Хранилище, которое целиком лежит в файле
+        self.header = None  # Последний записанный заголовок
+        self.owned = False  # Файл загружен или сохранён по F5 в этой игре - его можно переписывать
+        self.refused = False  # Уже предупредили, что чужой файл не пишем
+        self.chains = None  # (партитура, её версия), чьи цепочки записаны
+
+        # Счётчики
+        self.saves = 0
+        self.records_written = 0
+
+        self.lock = threading.Lock()  # Одно сохранение за раз
+        self.wakeup = threading.Event()
+        self.thread = threading.Thread(target=self.run, name="autosave", daemon=True)
+        self.thread.start()
+
+    def run(self):
+        # Поток автосохранения (interval 0 - только по запросу)
+        while self.thread is not None:
+            self.wakeup.wait(self.interval or None)
+            self.wakeup.clear()
+            if self.thread is not None:
+                self.save()
+
+    def request(self):
+        # Сохранить как можно скорее (F5) - и дальше писать в этот файл
+        self.owned = True
+        self.wakeup.set()
+
+    def synced(self, store):
+        # Город только что прочитан из файла: файл наш. store - хранилище,
+        # которое лежит в файле целиком (None - файл старой версии, при
+        # первой правке его перепишем полностью)
+        self.owned = True
+        self.refused = False
+        self.header = None
+        if store is None:
+            self.store = None
+            return
+        with store.lock:
+            store.changed = set()
+        self.store = store
+        self.chains = (self.game.timeline, self.game.timeline.version)
+
+    def release(self):
+        # Город заменили чужим (совместная игра): файл больше не наш до F5
+        self.owned = False
+        self.store = None
+
+    def save(self):
+        with self.lock:
+            store = self.game.buildings
+            if self.store is None and not store.changed and not self.game.timeline.version:
+                return  # Город с запуска не трогали - старое сохранение не затираем
+            exists = os.path.exists(self.path)
+            if exists and not self.owned:
+                if not self.refused:
+                    print(f"Автосохранение не пишет в {self.path}: этот город не оттуда "
+                          f"(F9 - загрузить его, F5 - перезаписать текущим)")
+                    self.refused = True
+                return
+            if store is not self.store or not exists:
+                timeline = self.game.timeline
+                chains = (timeline, timeline.version)
+                self.records_written += save_city(self.game, self.path)
+                self.owned = True
+                self.store = store
+                self.header = None
+                self.chains = chains
+                self.saves += 1
+                return
+
+            timeline = self.game.timeline
+            chains = (timeline, timeline.version)
+            if chains != self.chains:
+                save_chains(timeline, self.path)
+                self.chains = chains
+
+            slots, records, size = store.take_changed()
+            header = city_header(self.game, size).tobytes()
+            if not len(slots) and header == self.header:
+                return
+
+            with open(self.path, "r+b") as f:
+                # Новые слоты в конце - файл растёт, пустые записи мёртвые
+                f.truncate(CITY_HEADER.itemsize + size * CITY_RECORD.itemsize)
+                # Подряд идущие слоты пишем одним куском
+                breaks = np.flatnonzero(np.diff(slots) != 1) + 1
+                for run, chunk in zip(np.split(slots, breaks), np.split(records, breaks)):
+                    if len(run):
+                        f.seek(CITY_HEADER.itemsize + int(run[0]) * CITY_RECORD.itemsize)
+                        f.write(chunk.tobytes())
+                f.seek(0)
+                f.write(header)
+
+            self.header = header
+            self.records_written += len(slots)
+            self.saves += 1
+
+    def stop(self):
+        # Останавливает поток и сохраняет последние правки (при выходе)
+        thread = self.thread
+        self.thread = None
+        self.wakeup.set()
+        thread.join(timeout=5.0)
+        self.save()
+
+
+class History:
+    """
+    Отмена и повтор правок (CTRL+Z, CTRL+Y).
+
+    Хранилище и партитура ведут журнал: перед первой правкой слота в
+    действии запоминаются его поля (и цепочка с нотами). commit() в конце
+    кадра превращает журнал в запись истории - массивы полей до и после
+    только для изменённых зданий, так что запись стоит O(изменённых), даже
+    если в городе 100 тысяч зданий. Цепочки и ноты интернированы
+    (intern_pattern), запись держит ссылки на общие объекты.
+
+    Число шагов не ограничено; когда записи занимают больше limit байт,
+    забываются самые старые. Замена города целиком (загрузка, новый
+    уровень) историю сбрасывает.
+    """
+
+    def __init__(self, game, limit=UNDO_MEMORY):
+        self.game = game
+        self.limit = limit
+        self.undo_stack = deque()  # (слоты, поля до, поля после, {слот: (до, после)}, байт)
+        self.redo_stack = []
+        self.bytes = 0
+        self.store = None  # Хранилище и партитура, в которых ведём журнал
+        self.timeline = None
+
+    def attach(self):
+        # Город заменили целиком - старая история к нему не относится
+        game = self.game
+        if game.buildings is self.store and game.timeline is self.timeline:
+            return
+        self.undo_stack.clear()
+        self.redo_stack = []
+        self.bytes = 0
+        self.store, self.timeline = game.buildings, game.timeline
+        self.store.journal = {}
+        self.timeline.journal = {}
+
+    def commit(self):
+        # Журнал действия -> запись истории (если что-то действительно поменялось)
+        self.attach()
+        store, timeline = self.store, self.timeline
+        with store.lock:
+            before_fields, store.journal = store.journal, {}
+        with timeline.lock:
+            before_sequences, timeline.journal = timeline.journal, {}
+        if not before_fields and not before_sequences:
+            return
+
+        slots = np.array(sorted(before_fields.keys() | before_sequences.keys()), dtype=np.int64)
+        with store.lock:
+            after = store.snapshot(slots)
+        before = after.copy()
+        for i, slot in enumerate(slots.tolist()):
+            if slot in before_fields:
+                before[i] = before_fields[slot]
+
+        sequences = {}
+        for slot, old in before_sequences.items():
+            new = (timeline.chains.get(slot), timeline.notes.get(slot))
+            if old != new:
+                sequences[slot] = (old, new)
+
+        if np.array_equal(before, after) and not sequences:
+            return  # Правку отменили в том же кадре
+
+        # Цепочки общие, считаем только ссылки на них
+        size = slots.nbytes + before.nbytes + after.nbytes + 128 * len(sequences)
+        self.undo_stack.append((slots, before, after, sequences, size))
+        self.bytes += size
+        self.redo_stack = []
+        while self.bytes > self.limit and len(self.undo_stack) > 1:
+            self.bytes -= self.undo_stack.popleft()[4]
+
+    def undo(self):
+        self.commit()
+        if not self.undo_stack:
+            return None
+        entry = self.undo_stack.pop()
+        self.bytes -= entry[4]
+        slots, before, _, sequences, _ = entry
+        self.apply(slots, before, {slot: old for slot, (old, _) in sequences.items()})
+        self.redo_stack.append(entry)
+        return len(slots)
+
+    def redo(self):
+        self.commit()
+        if not self.redo_stack:
+            return None
+        entry = self.redo_stack.pop()
+        slots, _, after, sequences, size = entry
+        self.apply(slots, after, {slot: new for slot, (_, new) in sequences.items()})
+        self.undo_stack.append(entry)
+        self.bytes += size
+        return len(slots)
+
+    def apply(self, slots, fields, sequences):
+        # Возвращает состояние; сам возврат в журнал не попадает
+        self.game.restore(slots, fields, sequences)
+        self.discard()
+
+    def discard(self):
+        # Забывает журнал текущего действия (возврат из истории, правки из сети)
+        self.attach()
+        with self.store.lock:
+            self.store.journal = {}
+        with self.timeline.lock:
+            self.timeline.journal = {}
+
+
+class SharedRing:
+    """
+    Кольцевой буфер в общей памяти для одного писателя и одного читателя
+    (они могут быть в разных процессах).
+
+    В начале памяти три счётчика uint64: сколько записано, сколько прочитано
+    и вместимость. Счётчики только растут, и каждый меняет только своя
+    сторона (писатель - записанное, читатель - прочитанное), поэтому
+    блокировки не нужны: писатель сначала кладёт данные, потом сдвигает
+    счётчик, а читатель видит только то, что уже лежит целиком.
+    """
+
+    HEADER = 24
+
+    def __init__(self, dtype, capacity=None, name=None):
+        # name=None - создать новый буфер, иначе подключиться к готовому
+        from multiprocessing import shared_memory
+        self.owner = name is None
+        if self.owner:
+            size = self.HEADER + capacity * dtype.itemsize
+            self.shm = shared_memory.SharedMemory(create=True, size=size)
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+        self.name = self.shm.name
+
+        self.counters = np.ndarray(3, dtype=np.uint64, buffer=self.shm.buf)
+        if self.owner:
+            self.counters[:] = (0, 0, capacity)
+        self.capacity = int(self.counters[2])
+        self.items = np.ndarray((self.capacity,), dtype=dtype, buffer=self.shm.buf,
+                                offset=self.HEADER)
+
+    def available(self):
+        # Сколько элементов можно прочитать
+        return int(self.counters[0] - self.counters[1])
+
+    def free(self):
+        # Сколько элементов можно записать
+        return self.capacity - self.available()
+
+    def push(self, items):
+        # Записывает сколько влезет, возвращает сколько записал
+        written = int(self.counters[0])
+        n = min(len(items), self.free())
+        start = written % self.capacity
+        first = min(n, self.capacity - start)
+        self.items[start:start + first] = items[:first]
+        self.items[:n - first] = items[first:n]
+        self.counters[0] = written + n
+        return n
+
+    def pop(self, limit):
+        # Читает до limit элементов (копию)
+        read = int(self.counters[1])
+        n = min(limit, self.available())
+        start = read % self.capacity
+        first = min(n, self.capacity - start)
+        items = np.concatenate([self.items[start:start + first], self.items[:n - first]])
+        self.counters[1] = read + n
+        return items
+
+    def close(self):
+        # Отпускаем виды на память до закрытия, иначе SharedMemory не закроется
+        self.counters = self.items = None
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+
+class AudioMixer:
+    """
+    Микшер-шина: сам отсчитывает шаги по счётчику кадров и сводит удары
+    города блоками с точностью до кадра. Удары одного типа и одной ноты на
+    одном тике складываются в один голос (у них один сэмпл) с громкостями
+    левого и правого канала - так громкость и панорама каждого здания
+    учтены, а голосов не больше, чем разных звуков на тике, сколько бы
+    зданий ни играло. Ноты берутся из Building.pitch; пока нота не готова,
+    удар звучит без транспонирования.
+    После сведения блок проходит мастер-ограничитель (limit), который
+    задерживает звук на один блок.
+
+    В процессе звука микшер держит свою копию города, которую обновляют
+    сообщения от игры; шина в игре (MixerBus) читает город игры напрямую.
+    Часы у микшера свои (счётчик кадров), но ведёт его секвенсер игры:
+    align подвигает счёт шагов, если он разошёлся с часами секвенсера,
+    по которым идут интерфейс, вспышки и цели.
+    """
+
+    def __init__(self, rate, bpm, buildings=None, timeline=None):
+        self.rate = rate
+        self.buildings = buildings if buildings is not None else BuildingStore()
+        self.timeline = timeline if timeline is not None else Timeline(self.buildings)
+        self.chains = {}  # Слот -> такты цепочки, которые ещё приходят
+        self.notes = {}  # Слот -> ноты шагов, которые ещё приходят
+        self.samples = [Building.samples.get(name) for name in BUILDING_TYPES]
+
+        self.playing = False
+        self.step_frames = rate * 60.0 / bpm / STEPS_PER_BEAT
+        self.frame = 0  # Сколько кадров уже сведено
+        self.index = 0  # Следующий шаг, который ещё не разложен на голоса
+        self.step_start = 0.0  # Кадр, на котором начнётся этот шаг
+        self.voices = []  # (первый кадр, сэмпл, громкости каналов)
+
+        # Ограничитель: задержанный блок, его допустимая громкость, громкость
+        # в начале этого блока и насколько она отпускается за блок
+        self.delayed = None
+        self.delayed_target = 1.0
+        self.limiter_gain = 1.0
+        self.release = 1.0 - math.exp(-AUDIO_BLOCK / rate / LIMITER_RELEASE)
+
+        # Уровень микса до ограничителя: средние квадраты последних блоков
+        self.levels = deque(maxlen=max(1, int(BUS_LEVEL_WINDOW * rate / AUDIO_BLOCK)))
+        self.peak = 0.0  # Пик последнего блока
+
+    def apply(self, message):
+        # Применяет сообщение от игры. False - пора выходить
+        kind = message["kind"]
+        slot = int(message["slot"])
+
+        if kind == MSG_BUILDING:
+            flags = int(message["flags"])
+            alive = bool(flags & RECORD_ALIVE)
+            self.buildings.put(slot, message["type_id"], message["value"], message["pan"],
+                               bool(flags & RECORD_MUTED), bool(flags & RECORD_SOLO), alive)
+            if alive:
+                self.timeline.update(slot)
+            else:
+                self.timeline.remove(slot)
+        elif kind == MSG_PATTERN:
+            # Цепочка приходит по такту; применяем, когда пришёл последний
+            chain = self.chains.setdefault(slot, [None] * int(message["bars"]))
+            chain[message["bar"]] = (int(message["steps"]), int(message["mask"]))
+            if message["bar"] == len(chain) - 1:
+                self.timeline.set_chain(slot, self.chains.pop(slot))
+        elif kind == MSG_NOTE:
+            # Ноты тоже приходят по шагу
+            notes = self.notes.setdefault(slot, [0] * int(message["bars"]))
+            notes[message["bar"]] = int(message["value"])
+            if message["bar"] == len(notes) - 1:
+                self.timeline.set_notes(slot, self.notes.pop(slot))
+        elif kind == MSG_CLEAR:
+            self.buildings = BuildingStore()
+            self.timeline = Timeline(self.buildings)
+            self.chains = {}
+            self.notes = {}
+        elif kind == MSG_START:
+            self.playing = True
+            self.index = int(message["bar"]) * STEPS_PER_BAR
+            self.step_start = float(self.frame)
+        elif kind == MSG_STOP:
+            self.playing = False
+        elif kind == MSG_BPM:
+            # Как и в секвенсере: новая длина шага - со следующего шага
+            self.step_frames = self.rate * 60.0 / float(message["value"]) / STEPS_PER_BEAT
+        elif kind == MSG_SEEK:
+            self.index = int(message["bar"]) * STEPS_PER_BAR
+        elif kind == MSG_QUIT:
+            return False
+        return True
+
+    def mix(self, frames):
+        # Сводит следующие frames кадров в float32 (кадры, 2), до ограничителя
+        end = self.frame + frames
+
+        # Раскладываем на голоса шаги, которые начинаются в этом блоке
+        while self.playing and self.step_start < end:
+            tick_frames = self.step_frames / TICKS_PER_STEP
+            for tick, slots, gains, notes in self.timeline.events(self.index):
+                # Хранилище шины правит главный поток - читаем под его блокировкой
+                with self.buildings.lock:
+                    type_ids = self.buildings.type_id[slots].astype(np.int32)
+                    pans = self.buildings.pan[slots]
+                # Ключ голоса: тип и нота
+                keys = type_ids * 256 + notes + 128
+                voices, inverse = np.unique(keys, return_inverse=True)
+                left, right = pan_gains(pans)
+                by_left = np.bincount(inverse, weights=gains * left, minlength=len(voices))
+                by_right = np.bincount(inverse, weights=gains * right, minlength=len(voices))
+                at = int(round(self.step_start + tick * tick_frames))
+                for key, gain_left, gain_right in zip(voices.tolist(), by_left, by_right):
+                    sample = self.sample(key // 256, key % 256 - 128)
+                    if sample is not None and (gain_left or gain_right):
+                        self.voices.append((at, sample, np.array([gain_left, gain_right],
+                                                                 dtype=np.float32)))
+            self.index += 1
+            self.step_start += self.step_frames
+
+        out = np.zeros((frames, 2), dtype=np.float32)
+        playing = []
+        for start, sample, gain in self.voices:
+            first = max(start, self.frame)
+            if first < end:
+                offset = first - start
+                length = min(len(sample) - offset, end - first)
+                out[first - self.frame:first - self.frame + length] += gain * sample[offset:offset + length]
+            if start + len(sample) > end:
+                playing.append((start, sample, gain))
+        self.voices = playing
+        self.frame = end
+        return out
+
+    def sample(self, type_id, note):
+        # Сэмпл типа на ноте (пока нота не готова - исходный)
+        if note and Building.pitch is not None:
+            pitched = Building.pitch.get(BUILDING_TYPES[type_id], note)
+            if pitched is not None:
+                return pitched[0]
+        return self.samples[type_id]
+
+    def limit(self, out):
+        """
+        Мастер-ограничитель с заглядыванием на блок вперёд. Возвращает
+        предыдущий блок, а громкость по нему плавно ведёт к той, что нужна
+        следующему (out): если пик out выше LIMITER_CEILING, громкость успевает
+        опуститься до его начала, так что пики не проходят и обрезки нет.
+        Потом громкость за LIMITER_RELEASE возвращается; ниже потолка звук
+        не меняется.
+        """
+        self.peak = float(np.abs(out).max()) if len(out) else 0.0
+        target = min(1.0, LIMITER_CEILING / self.peak) if self.peak else 1.0
+
+        block = self.delayed if self.delayed is not None else np.zeros_like(out)
+        start = self.limiter_gain
+        # Громкость в конце блока: не выше допустимой ни для него, ни для следующего
+        end = min(self.delayed_target, target, start + (1.0 - start) * self.release)
+        if start != 1.0 or end != 1.0:
+            block *= np.linspace(start, end, len(block), endpoint=False, dtype=np.float32)[:, None]
+
+        self.delayed = out
+        self.delayed_target = target
+        self.limiter_gain = end
+        return block
+
+    def render_float(self, frames):
+        # Сводит следующие frames кадров и пропускает через ограничитель
+        out = self.mix(frames)
+        self.levels.append(float(np.mean(np.square(out))))
+        return self.limit(out)
+
+    def render(self, frames):
+        # То же в int16 (формат кольцевого буфера процесса звука)
+        return (self.render_float(frames) * 32767).astype(np.int16)
+
+    def rms(self):
+        # RMS микса до ограничителя за последние BUS_LEVEL_WINDOW секунд
+        return math.sqrt(sum(self.levels) / len(self.levels)) if self.levels else 0.0
+
+    def reduction(self):
+        # Насколько ограничитель сейчас убавляет громкость, дБ (0 - не работает)
+        return 20 * math.log10(self.limiter_gain)
+
+    def align(self, position, tolerance):
+        """
+        Ставит счёт шагов на часы секвенсера: position - номер шага (дробный),
+        который по ним звучит на кадре self.frame. Если счёт разошёлся больше
+        чем на tolerance кадров, следующий шаг переносится на своё место;
+        уже разложенный шаг при этом не повторяется. True - подвинули.
+        """
+        here = self.index - (self.step_start - self.frame) / self.step_frames
+        if abs(position - here) * self.step_frames <= tolerance:
+            return False
+        if not self.index - 1 < position <= self.index:
+            self.index = math.ceil(position)
+        self.step_start = self.frame + (self.index - position) * self.step_frames
+        return True
+
+
+def audio_message(kind, **fields):
+    # Одно сообщение AUDIO_MESSAGE (остальные поля нулевые)
+    message = np.zeros(1, dtype=AUDIO_MESSAGE)
+    message["kind"] = kind
+    for name, value in fields.items():
+        message[name] = value
+    return message
+
+
+def audio_worker(messages_name, output_name, rate, bpm, voices, buffer=MIXER_DEFAULTS["buffer"],
+                 latency=MIXER_DEFAULTS["latency"]):
+    """
+    Процесс звука. Микшер сводит город блоками и складывает кадры в
+    кольцевой буфер output на AUDIO_AHEAD вперёд, отдельный поток отдаёт
+    их в канал микшера кусками по AUDIO_CHUNK. Игра сюда только пишет
+    сообщения, так что её подвисания звук не прерывают.
+    Поток вывода помнит, когда зазвучит последний отданный кусок; по этому
+    MSG_CLOCK переводится в кадры, и шаги микшера идут по секвенсеру игры.
+    В общее значение voices процесс пишет, сколько голосов сейчас звучит.
+    latency - задержка вывода из калибровки: кадр слышен на столько позже,
+    чем канал его начал, и ещё на блок позже из-за ограничителя.
+    """
+    pygame.mixer.quit()
+    pygame.mixer.init(frequency=rate, size=-16, channels=2, buffer=buffer)
+    Building.load_sounds(verbose=False)
+
+    messages = SharedRing(AUDIO_MESSAGE, name=messages_name)
+    output = SharedRing(AUDIO_FRAME, name=output_name)
+    mixer = AudioMixer(rate, bpm)
+    ahead = int(AUDIO_AHEAD * rate)
+    output_latency = latency + AUDIO_BLOCK / rate
+    running = [True]
+    heard = [None]  # (кадр, когда он прозвучит) - начало последнего отданного куска
+
+    def feed():
+        # Поток вывода: следующий кусок встаёт в очередь канала заранее
+        channel = pygame.mixer.Channel(0)
+        popped = 0
+        queued_end = 0.0
+        while running[0]:
+            if channel.get_queue() is None and output.available() >= AUDIO_CHUNK:
+                busy = channel.get_busy()
+                start = queued_end if busy else time.perf_counter()
+                sound = pygame.sndarray.make_sound(output.pop(AUDIO_CHUNK))
+                if busy:
+                    channel.queue(sound)
+                else:
+                    channel.play(sound)
+                heard[0] = (popped, start)
+                popped += AUDIO_CHUNK
+                queued_end = start + AUDIO_CHUNK / rate
+            time.sleep(0.002)
+
+    def follow(message):
+        # Часы игры: шаг, который звучит сейчас, - сдвигаем на кадр, который сводим
+        if heard[0] is None or not mixer.playing:
+            return
+        frame, start = heard[0]
+        now_frame = frame + (time.perf_counter() - output_latency - start) * rate
+        position = int(message["slot"]) + float(message["value"])
+        mixer.align(position + (mixer.frame - now_frame) / mixer.step_frames, AUDIO_DRIFT * rate)
+
+    feeder = threading.Thread(target=feed, name="audio-output", daemon=True)
+    feeder.start()
+
+    while running[0]:
+        for message in messages.pop(1024):
+            if message["kind"] == MSG_CLOCK:
+                follow(message)
+            elif not mixer.apply(message):
+                running[0] = False
+        # Правки из сообщений попадают в партитуру здесь, между блоками
+        mixer.timeline.refresh()
+        while output.available() < ahead and output.free() >= AUDIO_BLOCK:
+            output.push(mixer.render(AUDIO_BLOCK))
+        voices.value = len(mixer.voices)
+        time.sleep(0.002)
+
+    feeder.join()
+    messages.close()
+    output.close()
+
+
+class AudioEngine:
+    """
+    Сторона игры для процесса звука (--mixer process): запускает процесс и
+    шлёт ему короткие сообщения (AUDIO_MESSAGE) о правках зданий и
+    транспорте через кольцевой буфер в общей памяти. Если очередь полна,
+    send() немного ждёт - это бывает только при загрузке большого города.
+    Если и за секунду место не освободилось, сообщение теряется: send()
+    пишет об этом и ставит lost, а Game шлёт процессу город заново целиком
+    (resync_audio). Часы у процесса свои, поэтому игра раз в AUDIO_CLOCK
+    сообщает ему, какой шаг звучит по секвенсеру (send_clock).
+    """
+
+    def __init__(self, bpm, buffer=MIXER_DEFAULTS["buffer"], latency=MIXER_DEFAULTS["latency"]):
+        rate = pygame.mixer.get_init()[0] if pygame.mixer.get_init() else 44100
+        self.messages = SharedRing(AUDIO_MESSAGE, AUDIO_QUEUE)
+        self.output = SharedRing(AUDIO_FRAME, int(AUDIO_AHEAD * rate) + AUDIO_CHUNK * 2)
+        self.rate = rate
+        self.lost = False  # Сообщение потерялось - процессу нужен весь город заново
+        self.clock_sent = -AUDIO_CLOCK  # Когда последний раз слали часы
+
+        # spawn - чистый процесс без потоков и окна игры. Запускает его
+        # start(): сообщения до этого просто ждут в очереди
+        from multiprocessing import get_context
+        context = get_context("spawn")
+        self.voice_count = context.Value("i", 0, lock=False)  # Голоса, которые звучат в процессе
+        self.process = context.Process(
+            target=audio_worker, name="audio",
+            args=(self.messages.name, self.output.name, rate, bpm, self.voice_count, buffer,
+                  latency), daemon=True)
+
+    def start(self):
+        self.process.start()
+
+    def send(self, kind, **fields):
+        message = audio_message(kind, **fields)
+        deadline = time.perf_counter() + 1.0
+        while not self.messages.push(message):
+            if time.perf_counter() > deadline or not self.process.is_alive():
+                if not self.lost:
+                    print("Процесс звука не успевает читать сообщения - город будет отправлен заново")
+                self.lost = True
+                return False
+            time.sleep(0.001)
+        return True
+
+    def send_clock(self, sequencer):
+        # Какой шаг звучит сейчас по часам секвенсера (не чаще AUDIO_CLOCK)
+        now = sequencer.clock()
+        if now < self.clock_sent + AUDIO_CLOCK:
+            return
+        with sequencer.lock:
+            if not sequencer.playing:
+                return
+            position = sequencer.position(now)
+        if position < 0:
+            return
+        self.clock_sent = now
+        self.send(MSG_CLOCK, slot=int(position), value=position - int(position))
+
+    def building(self, store, slot):
+        # Поля здания (и то, стоит ли оно ещё)
+        flags = (store.alive[slot] * RECORD_ALIVE | store.muted[slot] * RECORD_MUTED
+                 | store.solo[slot] * RECORD_SOLO)
+        self.send(MSG_BUILDING, slot=slot, type_id=store.type_id[slot], flags=flags,
+                  value=store.volume[slot], pan=store.pan[slot])
+
+    def chain(self, slot, chain):
+        # Цепочка тактов здания, по сообщению на такт
+        for bar, (steps, mask) in enumerate(chain):
+            self.send(MSG_PATTERN, slot=slot, bar=bar, bars=len(chain), steps=steps, mask=mask)
+
+    def notes(self, slot, notes):
+        # Ноты шагов здания, по сообщению на шаг
+        for step, note in enumerate(notes):
+            self.send(MSG_NOTE, slot=slot, bar=step, bars=len(notes), value=note)
+
+    def samples_loaded(self):
+        pass  # Процесс звука грузит звуки сам
+
+    def buffered(self):
+        # Сколько секунд звука сведено и ждёт вывода
+        return self.output.available() / self.rate
+
+    def voices(self):
+        # Сколько голосов звучит в процессе (для профилировщика)
+        return self.voice_count.value
+
+    def status(self):
+        # Строка для HUD
+        return f"Звук в процессе, буфер {self.buffered() * 1000:.0f} мс"
+
+    def close(self):
+        self.send(MSG_QUIT)
+        self.process.join(timeout=2.0)
+        if self.process.is_alive():
+            self.process.terminate()
+        self.messages.close()
+        self.output.close()
+
+
+class MixerBus:
+    """
+    Шина микшера в процессе игры (--mixer bus): AudioMixer сводит город
+    игры блоками, а поток вывода ставит готовые куски по AUDIO_CHUNK кадров
+    в очередь одного канала. Удары не занимают каналов pygame, так что нет
+    потолка голосов, а после ограничителя нет и обрезки.
+
+    Снаружи шина выглядит как AudioEngine (send, building, chain, close),
+    только город ей пересылать не нужно - она читает хранилище и партитуру
+    игры. Подвисание главного потока тут может задержать кусок; если это
+    мешает, есть --mixer process.
+
+    Шина ведомая: перед каждым куском она узнаёт, когда он прозвучит (конец
+    уже поставленных в канал кусков), и сверяет шаги с часами секвенсера
+    (follow). Так звук не уходит от интерфейса, вспышек и целей уровня,
+    сколько бы ни играла песня.
+    """
+
+    def __init__(self, game, channel_index):
+        self.game = game
+        rate = pygame.mixer.get_init()[0]
+        self.rate = rate
+        self.mixer = AudioMixer(rate, game.sequencer.bpm, game.buildings, game.timeline)
+
+        pygame.mixer.set_num_channels(channel_index + 1)
+        pygame.mixer.set_reserved(channel_index + 1)
+        self.channel = pygame.mixer.Channel(channel_index)
+
+        self.underruns = 0  # Сколько раз канал доиграл, не дождавшись куска
+        self.queued_end = 0.0  # Когда по часам секвенсера доиграют куски в канале
+        # Кадр слышен позже, чем канал его начал: задержка вывода из
+        # калибровки и блок, на который задерживает ограничитель
+        self.output_latency = game.mixer_config["latency"] + AUDIO_BLOCK / rate
+        self.resyncs = 0  # Сколько раз шаги шины подвигали к секвенсеру
+        self.lost = False  # Как у AudioEngine; город общий с игрой, терять нечего
+
+        self.lock = threading.Lock()  # Транспорт правит главный поток, сводит поток вывода
+        self.thread = threading.Thread(target=self.run, name="mixer-bus", daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def send(self, kind, **fields):
+        # Транспорт (старт, стоп, темп, переход) - сразу в микшер
+        if kind in (MSG_BUILDING, MSG_PATTERN, MSG_NOTE, MSG_CLEAR):
+            return True  # Город общий с игрой
+        with self.lock:
+            return self.mixer.apply(audio_message(kind, **fields)[0])
+
+    def building(self, store, slot):
+        pass
+
+    def chain(self, slot, chain):
+        pass
+
+    def notes(self, slot, notes):
+        pass
+
+    def send_clock(self, sequencer):
+        pass  # Шина сверяется с секвенсером сама, перед каждым куском
+
+    def voices(self):
+        # Сколько голосов сейчас сводит шина (для профилировщика)
+        return len(self.mixer.voices)
+
+    def samples_loaded(self):
+        # Игра догрузила звуки в фоне - микшер берёт их
+        with self.lock:
+            self.mixer.samples = [Building.samples.get(name) for name in BUILDING_TYPES]
+
+    def follow(self, heard):
+        # Сверяет шаги с секвенсером: heard - когда прозвучит следующий кадр
+        sequencer = self.game.sequencer
+        with sequencer.lock:
+            if not sequencer.playing:
+                return
+            position = sequencer.position(heard)
+        with self.lock:
+            if self.mixer.playing and self.mixer.align(position, AUDIO_DRIFT * self.rate):
+                self.resyncs += 1
+
+    def render(self, heard):
+        # Следующий кусок в формате микшера pygame
+        self.follow(heard)
+        # Город могли заменить целиком (очистка, загрузка). Хранилище берём у
+        # партитуры, а не у игры, - так они всегда из одного города
+        timeline = self.game.timeline
+        with self.lock:
+            self.mixer.buildings = timeline.store
+            self.mixer.timeline = timeline
+            blocks = [self.mixer.render_float(AUDIO_BLOCK) for _ in range(AUDIO_CHUNK // AUDIO_BLOCK)]
+        return pygame.sndarray.make_sound(float_to_pcm(np.concatenate(blocks)))
+
+    def run(self):
+        # Поток вывода: следующий кусок встаёт в очередь канала заранее
+        chunk_time = AUDIO_CHUNK / self.rate
+        while self.thread is not None:
+            if self.channel.get_queue() is None:
+                now = self.game.sequencer.clock()
+                busy = self.channel.get_busy()
+                heard = self.queued_end if busy else now
+                sound = self.render(heard + self.output_latency)
+                if busy:
+                    self.channel.queue(sound)
+                else:
+                    if self.mixer.frame > AUDIO_CHUNK:
+                        self.underruns += 1
+                    self.channel.play(sound)
+                self.queued_end = heard + chunk_time
+            time.sleep(0.002)
+
+    def status(self):
+        # Строка для HUD: уровень микса и работа ограничителя
+        mixer = self.mixer
+        return (f"Шина: RMS {mixer.rms() / RMS_REFERENCE:.2f}  "
+                f"огр. {mixer.reduction():.1f} дБ  пропуски: {self.underruns}  "
+                f"сдвиги: {self.resyncs}")
+
+    def close(self):
+        thread = self.thread
+        self.thread = None
+        thread.join(timeout=1.0)
+        self.channel.stop()
+
+
+def net_message(kind, *fields):
+    # Сообщение совместной игры: байт вида и поля по NET_FORMATS
+    return bytes((kind,)) + struct.pack(NET_FORMATS[kind], *fields)
+
+
+def net_chain(cell, chain):
+    # NET_CHAIN: заголовок и такты цепочки
+    return net_message(NET_CHAIN, *cell, len(chain)) + b"".join(
+        struct.pack(NET_CHAIN_BAR, steps, mask) for steps, mask in chain)
+
+
+async def net_read(reader):
+    # Читает одно сообщение из потока: (вид, поля)
+    kind = (await reader.readexactly(1))[0]
+    if kind not in NET_FORMATS:
+        raise ValueError(f"неизвестное сообщение {kind}")
+    fmt = NET_FORMATS[kind]
+    fields = struct.unpack(fmt, await reader.readexactly(struct.calcsize(fmt)))
+    if kind == NET_CHAIN:
+        col, row, bars = fields
+        data = await reader.readexactly(struct.calcsize(NET_CHAIN_BAR) * bars)
+        fields = (col, row, tuple(struct.iter_unpack(NET_CHAIN_BAR, data)))
+    return kind, fields
+
+
+def jam_default(cell, type_id):
+    # Запись только что поставленного здания (как в BuildingStore.add)
+    mask = pattern_to_mask(make_default_pattern(BUILDING_TYPES[type_id]))
+    return {
+        "cell": cell,
+        "type": type_id,
+        "volume": round(0.7 * VOLUME_SCALE),
+        "pan": 0,
+        "muted": False,
+        "solo": False,
+        "chain": ((STEPS_PER_BAR, mask),),
+        "notes": (0,) * STEPS_PER_BAR,
+    }
+
+
+def jam_record(game, slot):
+    # Здание слота в том виде, в каком оно ходит по сети (None - здания нет)
+    store = game.buildings
+    if slot is None or slot >= store.size or not store.alive[slot]:
+        return None
+    return {
+        "cell": (int(store.col[slot]), int(store.row[slot])),
+        "type": int(store.type_id[slot]),
+        "volume": int(round(float(store.volume[slot]) * VOLUME_SCALE)),
+        "pan": int(round(float(store.pan[slot]) * PAN_SCALE)),
+        "muted": bool(store.muted[slot]),
+        "solo": bool(store.solo[slot]),
+        "chain": game.timeline.chain(slot),
+        "notes": game.timeline.notes.get(slot, (0,) * STEPS_PER_BAR),
+    }
+
+
+def jam_delta(old, new):
+    """
+    Сообщения, которые переводят здание из old в new (записи jam_record,
+    None - здания нет). Уходит только то, что поменялось: переключённый
+    шаг - 8 байт, громкость - 6, такт целиком - 15.
+    """
+    if new is None:
+        return [] if old is None else [net_message(NET_REMOVE, *old["cell"])]
+
+    cell = new["cell"]
+    messages = []
+    if old is not None and old["cell"] != cell:
+        messages.append(net_message(NET_REMOVE, *old["cell"]))
+        old = None
+    if old is None or old["type"] != new["type"]:
+        messages.append(net_message(NET_PLACE, *cell, new["type"]))
+        old = jam_default(cell, new["type"])
+
+    for field, kind in (("volume", NET_VOLUME), ("pan", NET_PAN), ("muted", NET_MUTE), ("solo", NET_SOLO)):
+        if old[field] != new[field]:
+            messages.append(net_message(kind, *cell, new[field]))
+
+    old_chain, chain = old["chain"], new["chain"]
+    if old_chain != chain:
+        if [steps for steps, _ in old_chain] == [steps for steps, _ in chain]:
+            for bar, ((steps, was), (_, mask)) in enumerate(zip(old_chain, chain)):
+                flipped = was ^ mask
+                if flipped and not flipped & (flipped - 1):  # Один шаг
+                    messages.append(net_message(NET_STEP, *cell, bar, flipped.bit_length() - 1,
+                                                bool(mask & flipped)))
+                elif flipped:
+                    messages.append(net_message(NET_BAR, *cell, bar, steps, mask))
+        else:
+            messages.append(net_chain(cell, chain))
+
+    for step, (was, note) in enumerate(zip(old["notes"], new["notes"])):
+        if was != note:
+            messages.append(net_message(NET_NOTE, *cell, step, note))
+    return messages
+
+
+def jam_apply(record, kind, fields):
+    """
+    Применяет к записи здания правку kind с полями fields (первые два -
+    клетка). Возвращает новую запись (None - здание убрали); правка, которая
+    к записи не подходит (такта нет, здания нет), - ValueError.
+    """
+    cell, args = tuple(fields[:2]), fields[2:]
+    if kind == NET_PLACE:
+        type_id, = args
+        if type_id >= len(BUILDING_TYPES):
+            raise ValueError(f"нет типа {type_id}")
+        if record is not None and record["type"] == type_id:
+            return record
+        return jam_default(cell, type_id)
+    if kind == NET_REMOVE:
+        return None
+    if record is None:
+        raise ValueError("на клетке нет здания")
+
+    if kind == NET_VOLUME:
+        return dict(record, volume=min(args[0], VOLUME_SCALE))
+    if kind == NET_PAN:
+        return dict(record, pan=max(-PAN_SCALE, min(PAN_SCALE, args[0])))
+    if kind == NET_MUTE:
+        return dict(record, muted=bool(args[0]))
+    if kind == NET_SOLO:
+        return dict(record, solo=bool(args[0]))
+    if kind == NET_NOTE:
+        step, note = args
+        if step >= STEPS_PER_BAR or abs(note) > NOTE_RANGE:
+            raise ValueError(f"нота {note} на шаге {step}")
+        notes = list(record["notes"])
+        notes[step] = note
+        return dict(record, notes=intern_pattern(tuple(notes)))
+
+    chain = list(record["chain"])
+    if kind == NET_STEP:
+        bar, bit, on = args
+        if bar >= len(chain) or bit >= chain[bar][0]:
+            raise ValueError(f"нет шага {bit} в такте {bar}")
+        steps, mask = chain[bar]
+        chain[bar] = (steps, mask | 1 << bit if on else mask & ~(1 << bit))
+    elif kind == NET_BAR:
+        bar, steps, mask = args
+        if bar >= len(chain) or steps not in RESOLUTIONS or mask >> steps:
+            raise ValueError(f"такт {bar} не подходит")
+        chain[bar] = (steps, mask)
+    elif kind == NET_CHAIN:
+        chain, = args
+        if not chain or any(steps not in RESOLUTIONS or mask >> steps for steps, mask in chain):
+            raise ValueError("цепочка не подходит")
+    return dict(record, chain=intern_pattern(tuple((int(steps), int(mask)) for steps, mask in chain)))
+
+
+class JamClient:
+    """
+    Игрок совместной игры (--jam HOST:PORT). Сеть живёт в своём потоке с
+    циклом asyncio, так что Game.run её никогда не ждёт: главный поток
+    только кладёт байты в цикл (send) и разбирает очередь входящих (poll).
+
+    Правки не ловятся по месту: Game.sync_audio отмечает изменённые слоты,
+    а flush() в конце кадра сравнивает их с зеркалом (как город выглядит
+    для сервера) и шлёт разницу через jam_delta. Правки с сервера
+    применяются через методы Game, и зеркало сразу их запоминает, поэтому
+    обратно они не уходят.
+
+    Часы: по PING/PONG сдвиг часов сервера берётся из самого быстрого из
+    последних JAM_PING_SAMPLES замеров, и расписание секвенсера ставится
+    на общие часы (Sequencer.sync) - все клиенты начинают такт вместе.
+    """
+
+    def __init__(self, address):
+        host, _, port = address.rpartition(":")
+        self.host = host or "localhost"
+        self.port = int(port) if port else JAM_PORT
+
+        self.loop = None
+        self.writer = None
+        self.connected = False
+        self.inbox = deque()  # (вид, поля) с сервера, разбирает главный поток
+
+        self.pings = deque(maxlen=JAM_PING_SAMPLES)  # (время туда-обратно, сдвиг часов)
+        self.offset = 0.0  # Часы сервера минус наши
+        self.rtt = 0.0
+        self.transport = None  # Последний NET_TRANSPORT: (играет, темп, начало песни по серверу)
+        self.synced_offset = None  # Сдвиг, по которому поставлено расписание секвенсера
+        self.audio_start = None  # (когда, такт) - старт шины звука на границе такта
+
+        # Зеркало: как город и темп выглядят для сервера (store - с каким
+        # хранилищем оно сверено; None - снимок города с сервера ещё не пришёл)
+        self.store = None
+        self.mirror = {}  # Слот -> запись здания
+        self.dirty = set()  # Слоты, изменённые с прошлого flush
+        self.bpm = None
+
+        self.sent = 0  # Байт отправлено (для отладки)
+        self.received = 0
+
+        self.thread = threading.Thread(target=self.run, name="jam", daemon=True)
+        self.thread.start()
+
+    def run(self):
+        import asyncio
+        try:
+            asyncio.run(self.main())
+        except (OSError, asyncio.IncompleteReadError, ValueError) as error:
+            print(f"Совместная игра: соединение потеряно ({error})")
+        self.connected = False
+
+    async def main(self):
+        import asyncio
+        self.loop = asyncio.get_running_loop()
+        reader, self.writer = await asyncio.open_connection(self.host, self.port)
+        self.connected = True
+        print(f"Совместная игра: подключились к {self.host}:{self.port}")
+        pinger = asyncio.ensure_future(self.ping())
+        try:
+            while True:
+                kind, fields = await net_read(reader)
+                self.received += 1
+                if kind == NET_PONG:
+                    self.pong(*fields)
+                else:
+                    self.inbox.append((kind, fields))
+        finally:
+            pinger.cancel()
+            self.writer.close()
+
+    async def ping(self):
+        import asyncio
+        # Первые замеры пачкой - к первому старту часы уже сверены
+        for _ in range(JAM_PING_SAMPLES):
+            self.writer.write(net_message(NET_PING, time.perf_counter()))
+            await asyncio.sleep(0.02)
+        while True:
+            await asyncio.sleep(JAM_PING_INTERVAL)
+            self.writer.write(net_message(NET_PING, time.perf_counter()))
+
+    def pong(self, sent, server_time):
+        # Сервер ответил в середине пути туда-обратно (NTP с одной меткой)
+        now = time.perf_counter()
+        self.pings.append((now - sent, server_time - (sent + now) / 2))
+        self.rtt, self.offset = min(self.pings)
+
+    def send(self, data):
+        # Из главного потока: байты уходят в цикл сети, ждать нечего
+        if self.connected and data:
+            self.sent += len(data)
+            self.loop.call_soon_threadsafe(self.writer.write, data)
+
+    def changed(self, slot):
+        self.dirty.add(slot)
+
+    def play(self, playing, bar=0):
+        # SPACE и переход по тактам: старт решает сервер, чтобы начали все вместе
+        self.send(net_message(NET_PLAY, playing, max(0, bar)))
+
+    def flush(self, game):
+        # Конец кадра: разница между городом и зеркалом уходит на сервер.
+        # До снимка города с сервера (он начинается с NET_CLEAR) не шлём ничего
+        if not self.connected or self.store is None:
+            return
+        messages = []
+        if game.buildings is not self.store:
+            # Город заменили целиком (загрузка, новый уровень) - шлём его весь
+            self.store = game.buildings
+            self.mirror = {}
+            self.dirty = set(np.flatnonzero(self.store.alive[:self.store.size]).tolist())
+            messages.append(net_message(NET_CLEAR))
+
+        for slot in sorted(self.dirty):
+            record = jam_record(game, slot)
+            messages += jam_delta(self.mirror.get(slot), record)
+            self.remember(slot, record)
+        self.dirty = set()
+
+        if game.sequencer.bpm != self.bpm:
+            self.bpm = game.sequencer.bpm
+            messages.append(net_message(NET_BPM, self.bpm))
+        self.send(b"".join(messages))
+
+    def remember(self, slot, record):
+        if record is None:
+            self.mirror.pop(slot, None)
+        else:
+            self.mirror[slot] = record
+
+    def poll(self, game):
+        # Начало кадра: правки с сервера - в город, транспорт - в секвенсер
+        if self.inbox and game.history:
+            game.history.commit()  # Свои правки - отдельным действием
+        applied = False
+        while self.inbox:
+            kind, fields = self.inbox.popleft()
+            applied = True
+            if kind in NET_CELL_KINDS:
+                cell = tuple(fields[:2])
+                record = jam_record(game, game.cells.get(cell))
+                try:
+                    record = jam_apply(record, kind, fields)
+                except ValueError:
+                    continue  # Сервер следом пришлёт клетку целиком
+                self.put(game, cell, record)
+            elif kind == NET_CLEAR:
+                game.clear_city()
+                if game.autosave:
+                    game.autosave.release()  # Общий город не пишем поверх своего сохранения
+                self.store = game.buildings
+                self.mirror = {}
+                self.dirty = set()
+            elif kind == NET_BPM:
+                self.bpm = fields[0]
+                if game.sequencer.bpm != self.bpm:
+                    game.set_bpm(self.bpm)
+            elif kind == NET_TRANSPORT:
+                self.transport = fields
+                self.follow(game)
+        if applied and game.history:
+            game.history.discard()  # Чужие правки отменять не нам
+
+        # Сдвиг часов уточнился - поправляем расписание
+        if (self.transport and self.transport[0] and self.synced_offset is not None
+                and abs(self.offset - self.synced_offset) > JAM_RESYNC):
+            self.follow(game)
+
+        # Шина звука считает шаги по своим кадрам - (пере)запускаем её на границе такта
+        if self.audio_start and time.perf_counter() >= self.audio_start[0]:
+            if game.audio and game.sequencer.playing:
+                game.audio.send(MSG_START, bar=self.audio_start[1])
+            self.audio_start = None
+
+    def follow(self, game):
+        # Транспорт сервера -> секвенсер (и шина звука)
+        playing, bpm, origin = self.transport
+        seq = game.sequencer
+        if not playing:
+            self.synced_offset = None
+            self.audio_start = None
+            if seq.playing:
+                seq.stop()
+                game.bar_loop.stop()
+                if game.audio:
+                    game.audio.send(MSG_STOP)
+            return
+
+        if bpm != seq.bpm:
+            game.set_bpm(bpm)
+        origin -= self.offset  # На наши часы
+        seq.sync(origin, bpm)
+        self.synced_offset = self.offset
+        if game.audio:
+            bar_time = 60.0 / bpm * BEATS_PER_BAR
+            bar = max(0, math.ceil((time.perf_counter() - origin) / bar_time))
+            self.audio_start = (origin + bar * bar_time, bar)
+
+    def put(self, game, cell, record):
+        # Делает здание на клетке таким, как в записи (None - убирает)
+        slot = game.cells.get(cell)
+        if slot is not None and (record is None or game.buildings.type_id[slot] != record["type"]):
+            building = game.buildings.view(slot)
+            game.remove_building(building)
+            self.remember(slot, None)
+            slot = None
+        if record is None:
+            return
+
+        if slot is None:
+            slot = game.add_building(*cell, BUILDING_TYPES[record["type"]]).slot
+        current = jam_record(game, slot)
+        if current != record:
+            building = game.buildings.view(slot)
+            building.volume = record["volume"] / VOLUME_SCALE
+            building.pan = record["pan"] / PAN_SCALE
+            building.muted = record["muted"]
+            building.solo = record["solo"]
+            if current["chain"] != record["chain"]:
+                game.timeline.set_chain(slot, record["chain"])
+            if current["notes"] != record["notes"]:
+                game.set_notes(building, record["notes"])
+            else:
+                game.building_changed(building)
+        self.remember(slot, jam_record(game, slot))
+        self.dirty.discard(slot)
+
+    def close(self):
+        if self.loop is not None and self.connected:
+            self.loop.call_soon_threadsafe(self.writer.close)
 
 
 class Game:
     # Главный класс игры
 
-    def __init__(self):
+    def __init__(self, headless=False, city_size=(CITY_COLS, CITY_ROWS),
+                 voice_budget=VOICE_BUDGET, voice_steal=VOICE_STEAL, profile_log=None,
+                 save_path=SAVE_PATH, autosave=AUTOSAVE_INTERVAL, mixer=MIXER_MODE, jam=None,
+                 profile_startup=False, mixer_config=MIXER_CONFIG_PATH):
+        # headless - прогон без игрока: время двигает сам update(dt),
+        # звуки не запускаются
+        self.headless = headless
+        self.startup = StartupProfile(profile_startup)
+
+        # Окно и звук - сразу (без них не собрать слои и каналы), шрифты и
+        # сэмплы - в фоне (warm_up), пока на экране уже первый кадр
+        started = time.perf_counter()
+        pygame.display.init()
         self.screen = pygame.display.set_mode((WINDOW_WIDTH, WINDOW_HEIGHT))
         pygame.display.set_caption("Ритм-город")
+        started = self.startup.mark("окно", started)
+        # Частота, буфер и каналы - из калибровки (--calibrate), если она была
+        self.mixer_config = load_mixer_config(None if headless else mixer_config)
+        if not pygame.mixer.get_init():
+            pygame.mixer.init(frequency=self.mixer_config["frequency"], size=-16,
+                              channels=self.mixer_config["channels"],
+                              buffer=self.mixer_config["buffer"])
+        self.startup.mark("звук", started)
         self.clock = pygame.time.Clock()
         self.running = True
 
         # Компоненты игры
-        self.grid = Grid()
-        self.sequencer = Sequencer(DEFAULT_BPM)
-        self.buildings = []
-
-        # UI
-        self.font = pygame.font.Font(None, 28)
-        self.font_small = pygame.font.Font(None, 22)
+        self.grid = Grid(*city_size)
+        # Шаг запускается заранее, на задержку всего пути звука: в режиме
+        # channels - вывода, у шины и процесса - ещё и их буферов
+        latency = 0.0 if headless else mixer_latency(mixer, self.mixer_config["latency"],
+                                                     pygame.mixer.get_init()[0])
+        self.sequencer = Sequencer(DEFAULT_BPM, threaded=not headless, latency=latency)
+        self.sequencer.prepare = self.collect_step
+        self.sequencer.on_step = None if headless else self.play_step
+        self.buildings = BuildingStore()
+        self.timeline = Timeline(self.buildings)  # Партитура: удары всех зданий по времени
+
+        # Индекс зданий: клетка -> слот и кусок города -> слоты в нём
+        self.cells = {}
+        self.chunks = {}
+        self.drag_pos = None  # Где зажали среднюю кнопку (перетаскивание камеры)
+
+        # UI (шрифты появятся после warm_up, до тех пор надписи пустые)
+        self.font = None
+        self.font_small = None
+        self.text_cache = {}  # (шрифт, текст, цвет) -> готовая надпись
+
+        # Слои отрисовки: фон, сетка и здания лежат в scene_layer и
+        # перерисовываются только после изменений города
+        self.scene_layer = pygame.Surface((WINDOW_WIDTH, WINDOW_HEIGHT)).convert()
+        self.scene_dirty = True
+        self.widget_keys = {}  # Виджет -> состояние, с которым он нарисован
+        self.atlas = SpriteAtlas()  # Плитки зданий по типам и состояниям
+
+        # Поверх сцены: выбранное здание и здания, прозвучавшие на этом шаге
+        self.flash = (0, np.zeros(0, dtype=np.int32))  # (номер вспышки, слоты)
+        self.overlay_key = None
+        self.overlay_rects = []  # Где оверлей нарисован сейчас
+
+        # Области виджетов поверх сцены
+        self.hud_rect = pygame.Rect(0, 0, WINDOW_WIDTH, 82)
+        self.rms_rect = pygame.Rect(18, 86, 340, 22)
+        self.level_rect = pygame.Rect(WINDOW_WIDTH - 350, 120, 330, 200)
+        self.editor_rect = pygame.Rect(0, WINDOW_HEIGHT - 142, WINDOW_WIDTH, 142)
+        self.voices_rect = pygame.Rect(WINDOW_WIDTH - 350, 86, 330, 22)
+        self.profile_rect = pygame.Rect(10, 120, 236, 226)
+        self.hint_rect = pygame.Rect(WINDOW_WIDTH - 350, 330, 330, 130)
+
+        # Профайлер (F3 - показать/скрыть)
+        self.profiler = Profiler(profile_log)
 
         # Выбор типа здания
         self.selected_type = "kick"
 
         # Редактор
         self.selected_building = None
+        self.edit_bar = 0  # Какой такт цепочки правим
 
-        # Буфер для копирования
+        # Буфер для копирования: (шагов, маска), общий объект (intern_pattern)
         self.copied_pattern = None
 
+        # Отмена и повтор (CTRL+Z, CTRL+Y)
+        self.history = None
+        if not headless:
+            self.history = History(self)
+            self.history.attach()
+
         # Система уровней
         self.current_level_index = 0
         self.level = LEVELS[0]
         self.bars_playing = 0  # Сколько тактов проиграли
+        self.bars_seen = 0  # Сколько законченных тактов секвенсера уже посчитали
         self.level_completed = False
 
         # RMS - средний уровень громкости
         self.current_rms = 0.0
 
-        # Выгружаем звуки
-        Building.load_sounds()
+        # Подсказка к уровню (H) - пересчитывается после правок города
+        self.show_hint = False
+        self.hint = None
+        self.hint_key = None
+        self.hint_time = 0.0  # Сколько считалась последняя подсказка, с
+
+        # Измеритель громкости (профили по огибающим звуков - после warm_up)
+        self.meter = Meter(self.sequencer.bpm)
+        if Building.pitch is None:
+            Building.pitch = PitchCache()
+
+        # Каналы микшера для зданий
+        self.voices = VoiceManager(voice_budget, steal=voice_steal)
+        Building.voices = self.voices
+
+        # Режим петли - такт целиком одним звуком (клавиша L)
+        self.bar_loop = BarLoop(self, self.voices.budget)
+
+        # Шина микшера (в игре или в отдельном процессе): секвенсер игры тогда
+        # только двигает интерфейс и уровни, а звуки сводит шина. Запускается
+        # после первого кадра (start_background)
+        self.audio = None
+        if mixer == "bus" and not headless:
+            self.audio = MixerBus(self, self.voices.budget + 1)
+        elif mixer == "process" and not headless:
+            self.audio = AudioEngine(self.sequencer.bpm, self.mixer_config["buffer"],
+                                     self.mixer_config["latency"])
+
+        # Сохранение: F5 - сейчас, F9 - загрузить; правки пишутся и сами.
+        # В совместной игре город общий - сохраняем его только по F5
+        self.save_path = save_path
+        self.autosave = None
+        if save_path and not headless:
+            self.autosave = Autosave(self, save_path, 0 if jam else autosave)
+
+        # Совместная игра: jam - адрес сервера HOST:PORT
+        self.jam = JamClient(jam) if jam and not headless else None
+
+        # Шрифты и звуки: прогону без окна нужны сразу, игре - в фоне
+        # после первого кадра (start_background)
+        self.warmup = None
+        if headless:
+            self.finish_warmup(self.warm_up())
+            return
+
         # Мини инструкция для игрока
         print("\n=== РИТМ-ГОРОД ===")
         print(f"Текущий уровень: {self.level['name']}")
@@ -325,10 +4086,60 @@ class Game:
         print("  ПКМ: удалить здание")
         print("  SPACE: старт/пауза")
         print("  +/-: изменить BPM")
-        print("  UP/DOWN: громкость выбранного здания")
+        print("  UP/DOWN: громкость выбранного здания, LEFT/RIGHT: панорама")
         print("  M: мьют, S: соло")
+        print("  Колесо: масштаб, средняя кнопка: двигать город, HOME: к началу")
+        print("  B: экспорт в WAV (SHIFT+B - ещё и дорожки по зданиям)")
+        print("  L: режим петли (такт играет одним звуком, --mixer channels)")
+        print("  TAB/C/DEL/R в редакторе: такт цепочки, добавить, убрать, сетка")
+        print("  PAGEUP/PAGEDOWN: предыдущий/следующий такт")
+        print("  H: подсказка к уровню")
+        print("  F3: профайлер")
+        print("  F5: сохранить город, F9: загрузить")
+        print("  CTRL+Z: отменить, CTRL+Y (CTRL+SHIFT+Z): повторить")
         print("  ESC: закрыть редактор")
         print("  N: следующий уровень (если пройден)\n")
+        if save_path and os.path.exists(save_path):
+            print(f"Есть сохранение города ({save_path}) - F9 загрузить\n")
+        if mixer_config and not os.path.exists(mixer_config):
+            print("Звук запаздывает? Подобрать буфер и задержку: --calibrate\n")
+
+    def start_background(self):
+        # Первый кадр уже на экране - запускаем звук и догружаем остальное
+        if self.audio:
+            self.audio.start()
+        executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="warmup")
+        self.warmup = executor.submit(self.warm_up)
+        executor.shutdown(wait=False)
+
+    def warm_up(self):
+        # Фоновая загрузка: шрифты и звуки (в игре - в своём потоке)
+        started = time.perf_counter()
+        pygame.font.init()
+        fonts = pygame.font.Font(None, 28), pygame.font.Font(None, 22)
+        started = self.startup.mark("шрифты", started, background=not self.headless)
+        Building.load_sounds()
+        self.startup.mark("сэмплы", started, background=not self.headless)
+        return fonts
+
+    def finish_warmup(self, fonts):
+        # Шрифты и звуки готовы - всё, что их ждало, пересчитываем
+        self.font, self.font_small = fonts
+        self.meter.set_bpm(self.sequencer.bpm)
+        self.hint_key = None
+        self.atlas.invalidate()
+        self.scene_dirty = True
+        self.bar_loop.invalidate()
+        if self.audio:
+            self.audio.samples_loaded()
+        self.warm_notes()
+        self.startup.loaded()
+
+    def warm_notes(self):
+        # Готовит транспонированные звуки всех нот партитуры
+        for slot, notes in self.timeline.notes.items():
+            for note in set(notes) - {0}:
+                Building.pitch.warm(BUILDING_TYPES[self.buildings.type_id[slot]], note)
 
     def next_level(self):
         # Переход на следующий уровень
@@ -345,73 +4156,314 @@ class Game:
         self.bars_playing = 0
 
         # Очищает карту
-        self.buildings = []
-        self.selected_building = None
+        self.clear_city()
 
         # Останавливает музыку
         self.sequencer.stop()
+        self.bar_loop.stop()
 
         print(f"\n Уровень пройден!")
         print(f"Новый уровень: {self.level['name']}")
         print(f"Цель: {self.level['description']}\n")
 
-    def check_level_goals(self):
-        # Проверяет выполнение целей уровня
-        if self.level_completed:
-            return
+    def blocking_goal(self):
+        # Возвращает первую невыполненную цель уровня (ключ из LEVELS) или None
 
         # Проверяет количество зданий
         if len(self.buildings) < self.level['target_buildings']:
-            return
+            return "target_buildings"
 
         # Проверяет BPM (если требуется)
         if self.level['required_bpm'] is not None:
             if self.sequencer.bpm != self.level['required_bpm']:
-                return
+                return "required_bpm"
 
         # Проверяет уровень громкости (если нужно)
         if self.level['max_volume'] is not None:
             if self.current_rms > self.level['max_volume']:
-                return
+                return "max_volume"
 
         # Проверяет сколько тактов проиграли
-        if self.bars_playing >= self.level['target_bars']:
+        if self.bars_playing < self.level['target_bars']:
+            return "target_bars"
+
+        return None
+
+    def check_level_goals(self):
+        # Проверяет выполнение целей уровня
+        if self.level_completed:
+            return
+
+        if self.blocking_goal() is None:
             self.level_completed = True
-            print(f"\n🎉 УРОВЕНЬ ПРОЙДЕН! Нажми N для следующего уровня\n")
+            if not self.headless:
+                print(f"\n🎉 УРОВЕНЬ ПРОЙДЕН! Нажми N для следующего уровня\n")
 
     def calculate_rms(self):
         """
         Вычисляет средний уровень громкости микса (RMS).
         RMS = Root Mean Square, показывает общую громкость всех активных инструментов.
+        Считается по настоящим сэмплам и скомпилированной партитуре (см. Meter),
+        пересчёт идёт только после правок зданий.
         """
-        if not self.buildings:
-            return 0.0
+        return self.meter.level(self.timeline)
 
-        # Суммирует громкости всех незаглушенных зданий
-        total = 0.0
-        count = 0
+    def update_hint(self, city_changed=False):
+        # Ищет подсказку заново, если изменились город, темп или уровень
+        key = (self.current_level_index, self.sequencer.bpm, len(self.buildings))
+        if not city_changed and key == self.hint_key:
+            return
+        self.hint_key = key
+        start = time.perf_counter()
+        self.hint = solve_level(self.level, self.timeline, self.sequencer.bpm)
+        self.hint_time = time.perf_counter() - start
+
+    def add_building(self, col, row, building_type):
+        # Ставит здание в город, возвращает его
+        slot = self.buildings.add(col, row, building_type)
+        self.cells[(col, row)] = slot
+        chunk = (col // CHUNK_SIZE, row // CHUNK_SIZE)
+        self.chunks.setdefault(chunk, []).append(slot)
+
+        building = self.buildings.view(slot)
+        self.timeline.update(slot)
+        self.sync_audio(slot)
+        self.meter.invalidate()
+        self.scene_dirty = True
+        return building
+
+    def remove_building(self, building):
+        # Убирает здание из города
+        col, row = building.col, building.row
+        del self.cells[(col, row)]
+        chunk = (col // CHUNK_SIZE, row // CHUNK_SIZE)
+        self.chunks[chunk].remove(building.slot)
+        if not self.chunks[chunk]:
+            del self.chunks[chunk]
+        self.meter.invalidate()
+        self.buildings.remove(building.slot)
+        self.timeline.remove(building.slot)
+        self.sync_audio(building.slot)
+        self.scene_dirty = True
+        if self.selected_building == building:
+            self.selected_building = None
+
+    def clear_city(self):
+        # Убирает все здания
+        self.buildings = BuildingStore()
+        self.timeline = Timeline(self.buildings)
+        self.cells = {}
+        self.chunks = {}
+        self.selected_building = None
+        if self.audio:
+            self.audio.send(MSG_CLEAR)
+        self.meter.invalidate()
+        self.scene_dirty = True
+
+    def index_city(self):
+        # Пересобирает индексы клеток и кусков по хранилищу (после загрузки)
+        store = self.buildings
+        slots = np.flatnonzero(store.alive[:store.size])
+        cols = store.col[slots]
+        rows = store.row[slots]
+        self.cells = dict(zip(zip(cols.tolist(), rows.tolist()), slots.tolist()))
+
+        self.chunks = {}
+        if not len(slots):
+            return
+        chunk_keys = np.stack([cols // CHUNK_SIZE, rows // CHUNK_SIZE], axis=1)
+        keys, inverse = np.unique(chunk_keys, axis=0, return_inverse=True)
+        inverse = inverse.ravel()
+        groups = np.split(slots[np.argsort(inverse, kind="stable")],
+                          np.cumsum(np.bincount(inverse))[:-1])
+        for (chunk_col, chunk_row), group in zip(keys.tolist(), groups):
+            self.chunks[(chunk_col, chunk_row)] = group.tolist()
+
+    def load_city(self, path):
+        # Загружает город, темп и прогресс уровня из файла (F9)
+        if not os.path.exists(path):
+            print(f"Нет сохранения: {path}")
+            return False
 
-        for b in self.buildings:
-            if not b.muted:
-                total += b.volume
-                count += 1
+        lock = self.autosave.lock if self.autosave else threading.Lock()
+        with lock:
+            try:
+                header, records = open_city(path)
+            except ValueError as error:
+                print(f"Не удалось загрузить город: {error}")
+                return False
+
+            self.clear_city()
+            self.grid = Grid(int(header["cols"]), int(header["rows"]))
+            self.buildings = BuildingStore.from_records(records)
+            del records  # Отображение файла держит хранилище, пока не раскодирует столбцы
+            self.timeline = Timeline(self.buildings)
+            self.timeline.chains = load_chains(path)
+            self.timeline.notes = load_notes(path)
+            self.warm_notes()
+            if self.audio:
+                for slot in np.flatnonzero(self.buildings.alive[:self.buildings.size]):
+                    self.sync_audio(int(slot))
+            self.index_city()
+            self.meter.invalidate()
+            self.set_bpm(int(header["bpm"]))
+
+            self.current_level_index = min(int(header["level"]), len(LEVELS) - 1)
+            self.level = LEVELS[self.current_level_index]
+            self.level_completed = bool(header["completed"])
+            self.bars_playing = int(header["bars"])
+            self.bars_seen = self.sequencer.bars_done
+            self.timeline.refresh()
+
+            # Файл старой версии автосохранение перепишет целиком
+            if self.autosave and os.path.abspath(path) == os.path.abspath(self.autosave.path):
+                self.autosave.synced(self.buildings if header["version"] == CITY_VERSION else None)
+
+        print(f"Загрузили город: {len(self.buildings)} зданий, {self.sequencer.bpm} BPM")
+        return True
+
+    def set_chain(self, building, chain):
+        # Задаёт зданию цепочку тактов [(шагов, маска), ...]
+        self.timeline.set_chain(building.slot, chain)
+        self.building_changed(building)
+
+    def seek(self, bar):
+        # Переход к такту (PAGEUP/PAGEDOWN)
+        if self.jam and self.jam.connected:
+            if self.sequencer.playing:
+                self.jam.play(True, bar)
+            return
+        self.sequencer.seek(bar)
+        if self.audio and self.sequencer.playing:
+            self.audio.send(MSG_SEEK, bar=max(0, bar))
+        print(f"Переход к такту {max(0, bar) + 1}")
+
+    def set_notes(self, building, notes):
+        # Задаёт зданию ноты по 16 шагам; транспонированные звуки готовятся заранее
+        self.timeline.set_notes(building.slot, notes)
+        for note in set(notes) - {0}:
+            Building.pitch.warm(building.type, note)
+        self.building_changed(building)
+
+    def restore(self, slots, fields, sequences):
+        # Возвращает зданиям slots поля fields (BuildingStore.snapshot) и
+        # цепочки с нотами sequences {слот: (цепочка, ноты)} - отмена и повтор
+        store = self.buildings
+        for slot in slots[store.alive[slots]].tolist():
+            col, row = int(store.col[slot]), int(store.row[slot])
+            if self.cells.get((col, row)) == slot:
+                del self.cells[(col, row)]
+            chunk = (col // CHUNK_SIZE, row // CHUNK_SIZE)
+            self.chunks[chunk].remove(slot)
+            if not self.chunks[chunk]:
+                del self.chunks[chunk]
+
+        store.restore(slots, fields)
+        for slot in slots.tolist():
+            if store.alive[slot]:
+                col, row = int(store.col[slot]), int(store.row[slot])
+                self.cells[(col, row)] = slot
+                self.chunks.setdefault((col // CHUNK_SIZE, row // CHUNK_SIZE), []).append(slot)
+            if slot in sequences:
+                self.timeline.restore(slot, *sequences[slot])
+            else:
+                self.timeline.update(slot)
+            self.sync_audio(slot)
 
-        if count == 0:
-            return 0.0
+        self.meter.invalidate()
+        if self.selected_building and not store.alive[self.selected_building.slot]:
+            self.selected_building = None
+        self.scene_dirty = True
 
-        # Средняя громкость умножается на коэффициент от количества источников
-        # Чем больше инструментов играет одновременно, тем выше общая громкость
-        avg = total / count
-        rms = avg * (count / 6.0)  # Нормализуем на максимум 6 инструментов
+    def undo(self, redo=False):
+        # CTRL+Z / CTRL+Y
+        if not self.history:
+            return
+        count = self.history.redo() if redo else self.history.undo()
+        if count is None:
+            print("Нечего повторять" if redo else "Нечего отменять")
+        else:
+            print(f"{'Повторили' if redo else 'Отменили'} правку (зданий: {count})")
+
+    def sync_audio(self, slot):
+        # Отправляет здание в процесс звука (если он есть) и отмечает для сети
+        if self.jam:
+            self.jam.changed(slot)
+        if self.audio:
+            self.send_building(slot)
+
+    def send_building(self, slot):
+        # Здание целиком в процесс звука: поля, цепочка и ноты
+        self.audio.building(self.buildings, slot)
+        if self.buildings.alive[slot]:
+            self.audio.chain(slot, self.timeline.chain(slot))
+            if BUILDING_TYPES[self.buildings.type_id[slot]] in PITCHED_TYPES:
+                self.audio.notes(slot, self.timeline.notes.get(slot, (0,) * STEPS_PER_BAR))
+
+    def resync_audio(self):
+        # Процесс звука потерял сообщение - шлём ему город, темп и транспорт
+        # заново, когда он разберёт очередь
+        if self.audio.messages.available():
+            return
+        self.audio.lost = False
+        self.audio.send(MSG_CLEAR)
+        self.audio.send(MSG_BPM, value=self.sequencer.bpm)
+        for slot in np.flatnonzero(self.buildings.alive[:self.buildings.size]).tolist():
+            self.send_building(slot)
+        if self.sequencer.playing:
+            # Точное место процесс найдёт по часам (MSG_CLOCK)
+            self.audio.send(MSG_START, bar=self.sequencer.current_bar)
+            self.audio.clock_sent = -AUDIO_CLOCK
+        else:
+            self.audio.send(MSG_STOP)
+        if not self.audio.lost:
+            print(f"Город заново отправлен в процесс звука: {len(self.buildings)} зданий")
+
+    def building_changed(self, building):
+        # Вызывается после любой правки здания (паттерн, громкость, mute, solo)
+        self.timeline.update(building.slot)
+        self.sync_audio(building.slot)
+        self.meter.invalidate()
+        self.scene_dirty = True
+
+    def set_bpm(self, bpm):
+        # Меняет темп секвенсера
+        self.sequencer.set_bpm(bpm)
+        if self.audio:
+            self.audio.send(MSG_BPM, value=bpm)
+        self.meter.set_bpm(bpm)
+        self.bar_loop.invalidate()
+
+    def bounce(self, path="bounce.wav", bars=BOUNCE_BARS, stems_dir=None):
+        """
+        Записывает bars тактов текущего города в WAV быстрее реального времени.
+        Если задан stems_dir - туда пишется по дорожке на каждое здание.
+        """
+        rate = pygame.mixer.get_init()[0]
 
-        return min(1.0, rms)  # Ограничиваем максимум единицей
+        stem_callback = None
+        if stems_dir:
+            os.makedirs(stems_dir, exist_ok=True)
+
+            def stem_callback(building, stem):
+                name = f"{building.col:03d}_{building.row:03d}_{building.type}.wav"
+                write_wav(os.path.join(stems_dir, name), stem, rate)
+
+        start = time.perf_counter()
+        self.timeline.refresh()
+        mix = render_city(self.buildings, self.timeline, self.sequencer.bpm, bars, rate, stem_callback)
+        write_wav(path, mix, rate)
+
+        spent = time.perf_counter() - start
+        length = len(mix) / rate
+        print(f"Экспорт: {path} ({length:.1f} с за {spent:.2f} с)")
 
     def find_building(self, col, row):
         """Ищет здание на клетке."""
-        for b in self.buildings:
-            if b.col == col and b.row == row:
-                return b
-        return None
+        slot = self.cells.get((col, row))
+        if slot is None:
+            return None
+        return self.buildings.view(slot)
 
     def handle_events(self):
         # Обработка событий
@@ -419,6 +4471,27 @@ class Game:
             if event.type == pygame.QUIT:
                 self.running = False
 
+            # Окно перекрыли или развернули - рисуем всё заново
+            if event.type in (pygame.VIDEOEXPOSE, pygame.WINDOWEXPOSED):
+                self.scene_dirty = True
+
+            # Камера: колесо - масштаб, средняя кнопка - перетаскивание
+            if event.type == pygame.MOUSEWHEEL:
+                mx, my = pygame.mouse.get_pos()
+                if self.scroll_note(mx, my, 1 if event.y > 0 else -1):
+                    continue
+                self.grid.zoom(1.25 if event.y > 0 else 0.8, mx, my)
+                self.scene_dirty = True
+
+            if event.type == pygame.MOUSEBUTTONDOWN and event.button == 2:
+                self.drag_pos = event.pos
+            if event.type == pygame.MOUSEBUTTONUP and event.button == 2:
+                self.drag_pos = None
+            if event.type == pygame.MOUSEMOTION and self.drag_pos:
+                self.grid.pan(event.pos[0] - self.drag_pos[0], event.pos[1] - self.drag_pos[1])
+                self.drag_pos = event.pos
+                self.scene_dirty = True
+
             # Клики мыши
             if event.type == pygame.MOUSEBUTTONDOWN:
                 mx, my = event.pos
@@ -439,10 +4512,10 @@ class Game:
                         if building:
                             # Открывает редактор
                             self.selected_building = building
+                            self.edit_bar = 0
                         else:
                             # Ставит новое здание
-                            new_building = Building(col, row, self.selected_type)
-                            self.buildings.append(new_building)
+                            self.add_building(col, row, self.selected_type)
                             print(f"Поставили {self.selected_type}")
 
                 # Правая кнопка - удалить
@@ -452,9 +4525,7 @@ class Game:
                         col, row = cell
                         building = self.find_building(col, row)
                         if building:
-                            self.buildings.remove(building)
-                            if self.selected_building == building:
-                                self.selected_building = None
+                            self.remove_building(building)
                             print(f"Удалили {building.type}")
 
             # Клавиши
@@ -475,37 +4546,111 @@ class Game:
 
                 # Воспроизведение
                 elif event.key == pygame.K_SPACE:
-                    if self.sequencer.playing:
+                    if self.jam and self.jam.connected:
+                        self.jam.play(not self.sequencer.playing)
+                    elif self.sequencer.playing:
                         self.sequencer.stop()
+                        self.bar_loop.stop()
+                        if self.audio:
+                            self.audio.send(MSG_STOP)
                     else:
                         self.sequencer.start()
+                        if self.audio:
+                            self.audio.send(MSG_START, bar=0)
 
                 # BPM
                 elif event.key == pygame.K_MINUS:
-                    new_bpm = max(60, self.sequencer.bpm - 10)
-                    self.sequencer.set_bpm(new_bpm)
+                    new_bpm = max(MIN_BPM, self.sequencer.bpm - BPM_STEP)
+                    self.set_bpm(new_bpm)
                 elif event.key == pygame.K_EQUALS:
-                    new_bpm = min(200, self.sequencer.bpm + 10)
-                    self.sequencer.set_bpm(new_bpm)
+                    new_bpm = min(MAX_BPM, self.sequencer.bpm + BPM_STEP)
+                    self.set_bpm(new_bpm)
 
                 # Мьют/Соло
                 elif event.key == pygame.K_m:
                     if self.selected_building:
                         self.selected_building.muted = not self.selected_building.muted
+                        self.building_changed(self.selected_building)
                 elif event.key == pygame.K_s:
                     if self.selected_building:
                         self.selected_building.solo = not self.selected_building.solo
+                        self.building_changed(self.selected_building)
+
+                # Отмена и повтор
+                elif event.key == pygame.K_z and event.mod & pygame.KMOD_CTRL:
+                    self.undo(redo=bool(event.mod & pygame.KMOD_SHIFT))
+                elif event.key == pygame.K_y and event.mod & pygame.KMOD_CTRL:
+                    self.undo(redo=True)
 
                 # Громкость выбранного здания
                 elif event.key == pygame.K_UP:
                     if self.selected_building:
                         self.selected_building.volume = min(1.0, self.selected_building.volume + 0.1)
+                        self.building_changed(self.selected_building)
                         print(f"Громкость {self.selected_building.type}: {self.selected_building.volume:.1f}")
                 elif event.key == pygame.K_DOWN:
                     if self.selected_building:
                         self.selected_building.volume = max(0.0, self.selected_building.volume - 0.1)
+                        self.building_changed(self.selected_building)
                         print(f"Громкость {self.selected_building.type}: {self.selected_building.volume:.1f}")
 
+                # Панорама выбранного здания
+                elif event.key in (pygame.K_LEFT, pygame.K_RIGHT):
+                    if self.selected_building:
+                        step = 0.1 if event.key == pygame.K_RIGHT else -0.1
+                        pan = round(self.selected_building.pan + step, 1)
+                        self.selected_building.pan = min(1.0, max(-1.0, pan))
+                        self.building_changed(self.selected_building)
+                        print(f"Панорама {self.selected_building.type}: {self.selected_building.pan:+.1f}")
+
+                # Экспорт в WAV
+                elif event.key == pygame.K_b:
+                    if event.mod & pygame.KMOD_SHIFT:
+                        self.bounce(stems_dir="stems")
+                    else:
+                        self.bounce()
+
+                # Цепочка тактов выбранного здания
+                elif (event.key in (pygame.K_TAB, pygame.K_c, pygame.K_DELETE, pygame.K_r)
+                      and self.selected_building):
+                    self.edit_chain(event.key)
+
+                # Переход по тактам
+                elif event.key == pygame.K_PAGEUP:
+                    self.seek(self.sequencer.current_bar - 1)
+                elif event.key == pygame.K_PAGEDOWN:
+                    self.seek(self.sequencer.current_bar + 1)
+
+                # Камера к началу города
+                elif event.key == pygame.K_HOME:
+                    self.grid.camera_x = self.grid.camera_y = 0
+                    self.grid.update_offset()
+                    self.scene_dirty = True
+
+                # Подсказка к уровню
+                elif event.key == pygame.K_h:
+                    self.show_hint = not self.show_hint
+                    self.hint_key = None
+
+                # Профайлер
+                elif event.key == pygame.K_F3:
+                    self.profiler.enabled = not self.profiler.enabled
+
+                # Сохранение и загрузка
+                elif event.key == pygame.K_F5:
+                    if self.autosave:
+                        self.autosave.request()
+                        print(f"Сохраняем город: {self.save_path}")
+                elif event.key == pygame.K_F9:
+                    self.load_city(self.save_path)
+
+                # Режим петли
+                elif event.key == pygame.K_l:
+                    if self.audio:
+                        print("Режим петли только для --mixer channels")
+                    else:
+                        self.bar_loop.set_enabled(not self.bar_loop.enabled)
+
                 # Закрыть редактор
                 elif event.key == pygame.K_ESCAPE:
                     self.selected_building = None
@@ -515,6 +4660,12 @@ class Game:
                     if self.level_completed:
                         self.next_level()
 
+        # Правки этого кадра - одна запись истории отмены и одна пачка в сеть
+        if self.history:
+            self.history.commit()
+        if self.jam:
+            self.jam.flush(self)
+
     def click_on_editor(self, mx, my):
         # Обрабатывает клик по редактору паттерна. Возвращает True если попали
         panel_y = WINDOW_HEIGHT - 140
@@ -527,91 +4678,359 @@ class Game:
         # Кнопки управления
         btn_y = panel_y + 10
 
+        chain, (steps, mask) = self.edited_bar()
+
         # Очистить
         if WINDOW_WIDTH - 420 <= mx <= WINDOW_WIDTH - 320 and btn_y <= my <= btn_y + 25:
-            building.pattern = [False] * 16
+            self.edit_bar_pattern(steps, 0)
             return True
 
         # Заполнить
         if WINDOW_WIDTH - 310 <= mx <= WINDOW_WIDTH - 210 and btn_y <= my <= btn_y + 25:
-            building.pattern = [True] * 16
+            self.edit_bar_pattern(steps, (1 << steps) - 1)
             return True
 
         # Копировать
         if WINDOW_WIDTH - 200 <= mx <= WINDOW_WIDTH - 100 and btn_y <= my <= btn_y + 25:
-            self.copied_pattern = building.pattern.copy()
+            self.copied_pattern = intern_pattern((steps, mask))
             return True
 
         # Вставить
         if WINDOW_WIDTH - 90 <= mx <= WINDOW_WIDTH - 10 and btn_y <= my <= btn_y + 25:
             if self.copied_pattern:
-                building.pattern = self.copied_pattern.copy()
+                self.edit_bar_pattern(*self.copied_pattern)
             return True
 
         # Клик по шагам
-        step_y = panel_y + 70
-        for i in range(16):
-            step_x = 50 + i * 65
-            if step_x <= mx <= step_x + 60 and step_y <= my <= step_y + 50:
-                building.pattern[i] = not building.pattern[i]
+        for i, rect in enumerate(self.step_rects(steps)):
+            if rect.collidepoint(mx, my):
+                self.edit_bar_pattern(steps, mask ^ (1 << i))
                 return True
 
         return False
 
-    def update(self):
-        # Обновление логики игры каждый кадр
-        dt = self.clock.get_time() / 1000.0  # Время с прошлого кадра в секундах
+    def scroll_note(self, mx, my, delta):
+        # Колесо над шагом здания на 808 меняет ноту. Возвращает True если попали
+        building = self.selected_building
+        if building is None or building.type not in PITCHED_TYPES:
+            return False
+
+        _, (steps, _) = self.edited_bar()
+        for i, rect in enumerate(self.step_rects(steps)):
+            if rect.collidepoint(mx, my):
+                notes = list(self.timeline.notes.get(building.slot, (0,) * STEPS_PER_BAR))
+                step = i * STEPS_PER_BAR // steps
+                notes[step] = max(-NOTE_RANGE, min(NOTE_RANGE, notes[step] + delta))
+                self.set_notes(building, notes)
+                return True
+        return False
 
-        # Пересчитываем RMS на каждом кадре
+    def step_rects(self, steps):
+        # Клетки шагов в редакторе: steps клеток на ширине 16 клеток по 65 пикселей
+        pitch = STEPS_PER_BAR * 65 / steps
+        width = max(2, round(pitch) - 5)
+        return [pygame.Rect(50 + round(i * pitch), WINDOW_HEIGHT - 70, width, 50)
+                for i in range(steps)]
+
+    def edited_bar(self):
+        # Цепочка выбранного здания и такт, открытый в редакторе
+        chain = self.timeline.chain(self.selected_building.slot)
+        self.edit_bar %= len(chain)
+        return chain, chain[self.edit_bar]
+
+    def edit_bar_pattern(self, steps, mask):
+        # Заменяет такт цепочки, открытый в редакторе
+        chain, _ = self.edited_bar()
+        chain = list(chain)
+        chain[self.edit_bar] = (steps, mask)
+        self.set_chain(self.selected_building, chain)
+
+    def edit_chain(self, key):
+        # Клавиши цепочки в редакторе: TAB, C, DELETE, R
+        chain, (steps, mask) = self.edited_bar()
+        chain = list(chain)
+
+        if key == pygame.K_TAB:
+            self.edit_bar = (self.edit_bar + 1) % len(chain)
+            return
+        if key == pygame.K_c:
+            # Новый такт - копия открытого, сразу за ним
+            chain.insert(self.edit_bar + 1, (steps, mask))
+            self.edit_bar += 1
+        elif key == pygame.K_DELETE:
+            if len(chain) == 1:
+                return
+            chain.pop(self.edit_bar)
+            self.edit_bar = min(self.edit_bar, len(chain) - 1)
+        elif key == pygame.K_r:
+            # Следующая сетка, удары переносятся на ближайшие шаги
+            order = list(RESOLUTIONS)
+            new_steps = order[(order.index(steps) + 1) % len(order)]
+            chain[self.edit_bar] = (new_steps, resample_pattern(steps, mask, new_steps))
+
+        self.set_chain(self.selected_building, chain)
+        print(f"Цепочка {self.selected_building.type}: {len(chain)} тактов, "
+              f"такт {self.edit_bar + 1} - {RESOLUTIONS[chain[self.edit_bar][0]]}")
+
+    def update(self, dt=None):
+        # Обновление логики игры каждый кадр
+        if dt is None:
+            dt = self.clock.get_time() / 1000.0  # Время с прошлого кадра в секундах
+
+        # Догрузились шрифты и звуки
+        if self.warmup is not None and self.warmup.done():
+            fonts = self.warmup.result()
+            self.warmup = None
+            self.finish_warmup(fonts)
+
+        # Правки и транспорт от других игроков
+        if self.jam:
+            self.jam.poll(self)
+
+        # Правки зданий попадают в партитуру здесь, а не в потоке секвенсера
+        self.timeline.refresh()
+        self.bar_loop.follow(self.timeline)
+
+        # Процесс звука: потерянные сообщения и часы секвенсера
+        if self.audio:
+            if self.audio.lost:
+                self.resync_audio()
+            self.audio.send_clock(self.sequencer)
+
+        # RMS пересчитывается только если здания менялись
+        city_changed = self.meter.dirty or self.timeline.tick is not self.meter.published
         self.current_rms = self.calculate_rms()
+        if self.show_hint:
+            self.update_hint(city_changed)
 
-        # Обновление секвенсера (проверяем, не пора ли следующий шаг)
+        # Звуки запускает поток секвенсера, здесь только узнаём о новых шагах
         new_step = self.sequencer.update(dt)
 
-        # Если наступил новый шаг - воспроизводит звуки
+        # Если закончились такты - увеличиваем счётчик тактов
         if new_step:
-            self.play_step()
-
-            # Если это начало нового такта (шаг 0) - увеличиваем счётчик тактов
-            if self.sequencer.current_step == 0 and self.sequencer.playing:
-                self.bars_playing += 1
+            bars = self.sequencer.bars_done
+            if bars != self.bars_seen:
+                self.bars_playing += bars - self.bars_seen
+                self.bars_seen = bars
                 self.check_level_goals()  # Проверяем цели уровня
 
-    def play_step(self):
-        # Проигрывает все звуки для текущего шага
-        step = self.sequencer.current_step
-
-        # Проверяется, есть ли соло-здания (если есть - играют только они)
-        any_solo = any(b.solo for b in self.buildings)
+    def collect_step(self, index):
+        # Заранее собирает удары шага index из партитуры
+        # (вызывается секвенсером за lookahead до шага)
+        return self.timeline.events(index)
+
+    def play_step(self, step=None, bar=None, due=None, triggers=None, tick=0):
+        # Проигрывает удары шага (по умолчанию - текущего) на тике tick
+        if step is None:
+            step = self.sequencer.current_step
+        if bar is None:
+            bar = self.sequencer.current_bar
+
+        if self.profiler.enabled and due is not None:
+            self.profiler.step(step, due, time.perf_counter())
+        if triggers is not None:
+            self.show_flash(triggers, tick)
+        # Удары сводит шина микшера
+        if self.audio:
+            return
+        # В режиме петли такт уже сведён в один звук
+        if self.bar_loop.enabled:
+            if tick == 0:
+                self.bar_loop.on_step(step, bar)
+            return
 
-        # Проходим по всем зданиям
-        for building in self.buildings:
-            # Если на этом шаге здание должно играть - запускаем звук
-            if building.should_play(step):
-                building.play(any_solo)
+        if triggers is None:
+            triggers = self.collect_step(bar * STEPS_PER_BAR + step)[0][1:]
+
+        # Запускаем звук каждого здания с громкостью из партитуры
+        slots, gains, notes = triggers
+        type_ids = self.buildings.type_id[slots]
+        pans = self.buildings.pan[slots]
+        for slot, type_id, gain, pan, note in zip(slots.tolist(), type_ids.tolist(), gains.tolist(),
+                                                  pans.tolist(), notes.tolist()):
+            building_type = BUILDING_TYPES[type_id]
+            sound = Building.sounds.get(building_type)
+            if note:
+                # Нота не готова - не ждём, играем без транспонирования
+                pitched = Building.pitch.get(building_type, note)
+                if pitched is not None and pitched[1] is not None:
+                    sound = pitched[1]
+            if sound:
+                self.voices.play(slot, building_type, sound, gain, pan)
+
+    def show_flash(self, triggers, tick=0):
+        # Вспышка: на шаге - новые здания, между шагами - добавляются
+        count, slots = self.flash
+        slots = triggers[0] if tick == 0 else np.concatenate([slots, triggers[0]])
+        self.flash = (count + 1, slots)
 
     def draw(self):
-        # Отрисовка
-        self.screen.fill(COLOR_BG)
+        """
+        Отрисовка слоями. Сетка и здания кешируются в scene_layer и
+        перерисовываются только после изменений города; выбранное здание и
+        вспышки шага - оверлей поверх (draw_overlay). Виджеты (HUD, RMS,
+        панель уровня, редактор) перерисовываются, только когда изменилось
+        то, что они показывают, и на экран уходят только их прямоугольники.
+        Возвращает эти прямоугольники (пустой список - кадр не изменился).
+        """
+        full = False
+        if self.scene_dirty:
+            self.draw_scene()
+            self.screen.blit(self.scene_layer, (0, 0))
+            self.widget_keys = {}
+            self.overlay_rects = []
+            self.overlay_key = None
+            full = True
+
+        overlay = self.draw_overlay()
+        dirty = list(overlay)
+        for name, rect, key, draw in self.widgets():
+            # Виджет над сеткой, который задел оверлей, рисуется заново
+            if self.widget_keys.get(name) == key and rect.collidelist(overlay) == -1:
+                continue
+            self.widget_keys[name] = key
+
+            # Стираем старое содержимое виджета кусочком сцены
+            self.screen.blit(self.scene_layer, rect, rect)
+            if draw:
+                draw()
+            dirty.append(rect)
+
+        if full:
+            pygame.display.flip()
+            return [self.screen.get_rect()]
+        if dirty:
+            pygame.display.update(dirty)
+        return dirty
+
+    def draw_scene(self):
+        # Перерисовывает кеш сцены: фон, сетка, здания
+        self.scene_layer.fill(COLOR_BG)
 
         # Сетка
-        self.grid.draw(self.screen)
-
-        # Здания
-        for building in self.buildings:
-            building.draw(self.screen, self.grid)
-
-        # HUD
-        self.draw_hud()
-
-        # Панель уровня
-        self.draw_level_panel()
+        self.grid.draw(self.scene_layer)
+
+        # Здания - только из кусков города, попавших в область просмотра,
+        # плитками атласа за один вызов blits
+        col0, row0, col1, row1 = self.grid.visible_cells()
+        slots = [slot
+                 for chunk_row in range(row0 // CHUNK_SIZE, (row1 - 1) // CHUNK_SIZE + 1)
+                 for chunk_col in range(col0 // CHUNK_SIZE, (col1 - 1) // CHUNK_SIZE + 1)
+                 for slot in self.chunks.get((chunk_col, chunk_row), ())]
+        store = self.buildings
+        slots = np.array(slots, dtype=np.int64)
+        states = np.where(store.muted[slots], SPRITE_MUTED,
+                          np.where(store.solo[slots], SPRITE_SOLO, SPRITE_NORMAL))
+        self.scene_layer.set_clip(self.grid.view)
+        self.scene_layer.blits(self.building_sprites(slots, states), doreturn=False)
+        self.scene_layer.set_clip(None)
+
+        self.scene_dirty = False
+
+    def building_sprites(self, slots, states):
+        # Плитки зданий slots в состояниях states для Surface.blits
+        self.atlas.ensure(self.grid.tile_size)
+        store = self.buildings
+        return self.atlas.sprites(self.grid, store.col[slots], store.row[slots],
+                                  store.type_id[slots], states)
+
+    def draw_overlay(self):
+        """
+        Выбранное здание и вспышки зданий, прозвучавших на текущем шаге,
+        рисуются прямо на экране поверх сцены: прошлый оверлей стирается
+        кусками scene_layer, новый кладётся плитками атласа (оба - одним
+        вызовом blits). Возвращает изменившиеся прямоугольники экрана.
+        """
+        seq = self.sequencer
+        count, slots = self.flash if seq.playing else (None, self.flash[1][:0])
+        selected = self.selected_building.slot if self.selected_building else None
+        key = (count, selected)
+        if key == self.overlay_key:
+            return []
+        self.overlay_key = key
+
+        # Только видимые здания, которые ещё стоят
+        store = self.buildings
+        slots = slots[slots < store.size]
+        col0, row0, col1, row1 = self.grid.visible_cells()
+        cols, rows = store.col[slots], store.row[slots]
+        slots = slots[store.alive[slots] & (cols >= col0) & (cols < col1)
+                      & (rows >= row0) & (rows < row1)]
+        states = np.full(len(slots), SPRITE_FLASH)
+        if selected is not None and selected not in slots:
+            slots = np.append(slots, selected)
+            states = np.append(states, SPRITE_SELECTED)
+        sprites = self.building_sprites(slots, states)
+
+        old = self.overlay_rects
+        if old:
+            self.screen.blits([(self.scene_layer, rect, rect) for rect in old], doreturn=False)
+        self.screen.set_clip(self.grid.view)
+        self.overlay_rects = [rect.clip(self.grid.view) for rect in
+                              self.screen.blits(sprites) or ()]
+        self.screen.set_clip(None)
+        return old + self.overlay_rects
+
+    def widgets(self):
+        # Виджеты поверх сцены: (имя, область, состояние, функция отрисовки)
+        seq = self.sequencer
+        playing_bar = seq.current_bar if seq.playing else None
+
+        hud_key = (self.selected_type, seq.bpm, seq.playing, len(self.buildings), playing_bar,
+                   self.bar_loop.enabled)
+        rms_key = round(self.current_rms, 3)
+        level_key = (self.current_level_index, len(self.buildings), seq.bpm,
+                     round(self.current_rms, 2), self.bars_playing, self.level_completed)
+
+        # Профайлер обновляется 4 раза в секунду
+        profile_key = None
+        if self.profiler.enabled:
+            profile_key = int(time.perf_counter() * 4)
+
+        hint_key = None
+        if self.show_hint:
+            hint = self.hint
+            hint_key = (self.level_completed, hint and tuple(hint["add"].items()),
+                        hint and (hint["bpm"], hint["cap"], len(hint["quieter"]), round(hint["level"], 2)))
+
+        if self.audio:
+            voices_key = self.audio.status()
+        else:
+            voices_key = (self.voices.active(), self.voices.dropped)
 
-        # Редактор паттерна
-        if self.selected_building:
-            self.draw_editor()
+        building = self.selected_building
+        if building:
+            playhead = (seq.current_bar, seq.current_step) if seq.playing else None
+            editor_key = (building.slot, tuple(self.timeline.chain(building.slot)),
+                          self.timeline.notes.get(building.slot), self.edit_bar,
+                          building.volume, building.pan, building.muted, building.solo, playhead)
+            draw_editor = self.draw_editor
+        else:
+            editor_key = None
+            draw_editor = None
+
+        return [
+            ("hud", self.hud_rect, hud_key, self.draw_hud),
+            ("rms", self.rms_rect, rms_key, self.draw_rms),
+            ("level", self.level_rect, level_key, self.draw_level_panel),
+            ("editor", self.editor_rect, editor_key, draw_editor),
+            ("voices", self.voices_rect, voices_key, self.draw_voices),
+            ("profile", self.profile_rect, profile_key, self.draw_profile if profile_key else None),
+            ("hint", self.hint_rect, hint_key, self.draw_hint if hint_key else None),
+        ]
 
-        pygame.display.flip()
+    def render_text(self, font, text, color):
+        # Рендерит надпись с кешем: одинаковые надписи не рендерятся заново
+        if font is None:
+            return pygame.Surface((0, 0))  # Шрифты ещё грузятся
+        key = (id(font), text, color)
+        surface = self.text_cache.get(key)
+        if surface is None:
+            if len(self.text_cache) > 512:
+                self.text_cache.clear()
+            surface = font.render(text, True, color)
+            self.text_cache[key] = surface
+        return surface
 
     def draw_hud(self):
         # Рисует верхнюю панель
@@ -624,43 +5043,46 @@ class Game:
         if self.selected_type not in BUILDING_COLORS:
             self.selected_type = "kick"
 
-        text = self.font.render(f"Строим: {self.selected_type.upper()}",
-                                True, BUILDING_COLORS[self.selected_type])
+        text = self.render_text(self.font, f"Строим: {self.selected_type.upper()}",
+                                BUILDING_COLORS[self.selected_type])
         self.screen.blit(text, (20, 15))
 
-        hint = self.font_small.render("1-6: выбрать тип", True, (150, 150, 170))
+        hint = self.render_text(self.font_small, "1-6: выбрать тип", (150, 150, 170))
         self.screen.blit(hint, (20, 45))
 
         # BPM
-        bpm_text = self.font.render(f"BPM: {self.sequencer.bpm}", True, COLOR_TEXT)
+        bpm_text = self.render_text(self.font, f"BPM: {self.sequencer.bpm}", COLOR_TEXT)
         self.screen.blit(bpm_text, (400, 15))
 
-        bpm_hint = self.font_small.render("+/- изменить", True, (150, 150, 170))
+        bpm_hint = self.render_text(self.font_small, "+/- изменить", (150, 150, 170))
         self.screen.blit(bpm_hint, (400, 45))
 
         # Статус
         if self.sequencer.playing:
             status = "> ИГРАЕТ"
             color = (50, 255, 100)
+            if self.bar_loop.enabled:
+                status += " (петля)"
         else:
             status = "|| ПАУЗА"
             color = (120, 120, 140)
 
-        status_text = self.font.render(status, True, color)
+        status_text = self.render_text(self.font, status, color)
         self.screen.blit(status_text, (650, 15))
 
-        status_hint = self.font_small.render("SPACE: старт/пауза", True, (150, 150, 170))
+        status_hint = self.render_text(self.font_small, "SPACE: старт/пауза", (150, 150, 170))
         self.screen.blit(status_hint, (650, 45))
 
         # Счётчик
-        count = self.font.render(f"Зданий: {len(self.buildings)}", True, COLOR_TEXT)
+        count = self.render_text(self.font, f"Зданий: {len(self.buildings)}", COLOR_TEXT)
         self.screen.blit(count, (950, 15))
 
         if self.sequencer.playing:
-            bar = self.font_small.render(f"Такт {self.sequencer.current_bar + 1}",
-                                         True, (150, 150, 170))
+            bar = self.render_text(self.font_small, f"Такт {self.sequencer.current_bar + 1}",
+                                   (150, 150, 170))
             self.screen.blit(bar, (950, 45))
 
+    def draw_rms(self):
         # RMS индикатор
         rms_x = 20
         rms_y = 90
@@ -688,9 +5110,51 @@ class Game:
         pygame.draw.rect(self.screen, (150, 150, 170), (rms_x, rms_y, rms_width, rms_height), 2)
 
         # Текст
-        rms_label = self.font_small.render(f"RMS: {self.current_rms:.2f}", True, COLOR_TEXT)
+        rms_label = self.render_text(self.font_small, f"RMS: {self.current_rms:.2f}", COLOR_TEXT)
         self.screen.blit(rms_label, (rms_x + rms_width + 10, rms_y - 2))
 
+    def draw_voices(self):
+        # Счётчики голосов микшера (или состояние шины)
+        if self.audio:
+            text = self.audio.status()
+            label = self.render_text(self.font_small, text, (150, 150, 170))
+            self.screen.blit(label, (self.voices_rect.x + 10, self.voices_rect.y + 2))
+            return
+        voices = self.voices
+        text = f"Голоса: {voices.active()}/{voices.budget}  сброшено: {voices.dropped}"
+        color = (255, 80, 80) if voices.dropped else (150, 150, 170)
+        label = self.render_text(self.font_small, text, color)
+        self.screen.blit(label, (self.voices_rect.x + 10, self.voices_rect.y + 2))
+
+    def draw_profile(self):
+        # Панель профайлера: p50/p99 по окну последних кадров и шагов
+        rect = self.profile_rect
+        pygame.draw.rect(self.screen, (25, 25, 35), rect)
+        pygame.draw.rect(self.screen, (70, 70, 90), rect, 1)
+
+        lines = [("Профайлер (F3)", COLOR_TEXT)]
+        for name, title in (("events", "события"), ("update", "update"),
+                            ("draw", "draw"), ("wait", "ожидание"),
+                            ("lateness", "опоздание шага")):
+            p50, p99 = self.profiler.percentiles(name)
+            lines.append((f"{title}: {p50 * 1000:.2f} / {p99 * 1000:.2f} мс", (150, 150, 170)))
+
+        p50, p99 = self.profiler.percentiles("voices")
+        lines.append((f"голоса: {p50:.0f} / {p99:.0f}", (150, 150, 170)))
+        lines.append((f"шагов пропущено / догнано: {self.sequencer.missed_steps} / "
+                      f"{self.sequencer.caught_up_steps}", (150, 150, 170)))
+        pitch = Building.pitch
+        lines.append((f"кеш нот: +{pitch.hits} -{pitch.misses}, {pitch.bytes / 2 ** 20:.1f} МБ",
+                      (150, 150, 170)))
+        lines.append(("p50 / p99", (110, 110, 130)))
+
+        if self.font_small is None:
+            return  # Шрифты ещё грузятся
+        y = rect.y + 6
+        for text, color in lines:
+            self.screen.blit(self.font_small.render(text, True, color), (rect.x + 8, y))
+            y += 22
+
     def draw_level_panel(self):
         # Рисует панель с информацией об уровне
         # Панель справа
@@ -706,11 +5170,11 @@ class Game:
                          (panel_x, panel_y, panel_w, panel_h), 2)
 
         # Заголовок уровня
-        title = self.font.render(self.level['name'], True, (200, 200, 220))
+        title = self.render_text(self.font, self.level['name'], (200, 200, 220))
         self.screen.blit(title, (panel_x + 10, panel_y + 10))
 
         # Описание
-        desc = self.font_small.render(self.level['description'], True, (150, 150, 170))
+        desc = self.render_text(self.font_small, self.level['description'], (150, 150, 170))
         self.screen.blit(desc, (panel_x + 10, panel_y + 40))
 
         # Цели
@@ -720,9 +5184,10 @@ class Game:
         buildings_ok = len(self.buildings) >= self.level['target_buildings']
         icon1 = "+" if buildings_ok else "-"
         color1 = (50, 255, 100) if buildings_ok else (200, 200, 220)
-        goal1 = self.font_small.render(
+        goal1 = self.render_text(
+            self.font_small,
             f"{icon1} Зданий: {len(self.buildings)}/{self.level['target_buildings']}",
-            True, color1
+            color1
         )
         self.screen.blit(goal1, (panel_x + 10, y))
 
@@ -732,9 +5197,10 @@ class Game:
             bpm_ok = self.sequencer.bpm == self.level['required_bpm']
             icon2 = "+" if bpm_ok else "-"
             color2 = (50, 255, 100) if bpm_ok else (200, 200, 220)
-            goal2 = self.font_small.render(
+            goal2 = self.render_text(
+                self.font_small,
                 f"{icon2} BPM: {self.sequencer.bpm}/{self.level['required_bpm']}",
-                True, color2
+                color2
             )
             self.screen.blit(goal2, (panel_x + 10, y))
             y += 25
@@ -744,9 +5210,10 @@ class Game:
             rms_ok = self.current_rms <= self.level['max_volume']
             icon3 = "+" if rms_ok else "-"
             color3 = (50, 255, 100) if rms_ok else (200, 200, 220)
-            goal3 = self.font_small.render(
+            goal3 = self.render_text(
+                self.font_small,
                 f"{icon3} RMS ≤ {self.level['max_volume']:.2f} ({self.current_rms:.2f})",
-                True, color3
+                color3
             )
             self.screen.blit(goal3, (panel_x + 10, y))
             y += 25
@@ -755,24 +5222,57 @@ class Game:
         bars_ok = self.bars_playing >= self.level['target_bars']
         icon4 = "+" if bars_ok else "-"
         color4 = (50, 255, 100) if bars_ok else (200, 200, 220)
-        goal4 = self.font_small.render(
+        goal4 = self.render_text(
+            self.font_small,
             f"{icon4} Тактов: {self.bars_playing}/{self.level['target_bars']}",
-            True, color4
+            color4
         )
         self.screen.blit(goal4, (panel_x + 10, y))
         y += 30
 
         # Статус завершения
         if self.level_completed:
-            status = self.font.render(" ПРОЙДЕН!", True, (50, 255, 100))
+            status = self.render_text(self.font, " ПРОЙДЕН!", (50, 255, 100))
             self.screen.blit(status, (panel_x + 10, y))
 
-            hint = self.font_small.render("Нажми N для след. уровня", True, (150, 150, 170))
+            hint = self.render_text(self.font_small, "Нажми N для след. уровня", (150, 150, 170))
             self.screen.blit(hint, (panel_x + 10, y + 30))
         else:
-            status = self.font_small.render("Выполни все цели...", True, (150, 150, 170))
+            status = self.render_text(self.font_small, "Выполни все цели...", (150, 150, 170))
             self.screen.blit(status, (panel_x + 10, y))
 
+    def draw_hint(self):
+        # Рисует подсказку к уровню под панелью уровня
+        rect = self.hint_rect
+        pygame.draw.rect(self.screen, (35, 35, 50), rect)
+        pygame.draw.rect(self.screen, (70, 70, 90), rect, 2)
+
+        title = self.render_text(self.font_small, f"Подсказка (H) - {self.hint_time * 1000:.1f} мс", (255, 200, 50))
+        self.screen.blit(title, (rect.x + 10, rect.y + 8))
+
+        hint = self.hint
+        if self.level_completed:
+            lines = ["Уровень уже пройден"]
+        elif hint is None:
+            lines = ["Подходящего микса не нашлось"]
+        else:
+            lines = []
+            if hint["add"]:
+                lines.append("Поставь: " + ", ".join(f"{name} x{count}" for name, count in hint["add"].items()))
+            if hint["bpm"] != self.sequencer.bpm:
+                lines.append(f"Темп: {hint['bpm']} BPM")
+            if hint["cap"] is not None:
+                lines.append(f"Громкость зданий ≤ {hint['cap']:.2f} (убавить у {len(hint['quieter'])})")
+            if not lines:
+                lines.append("Всё уже так - играй такты")
+            lines.append(f"Уровень будет {hint['level']:.2f}")
+
+        y = rect.y + 32
+        for line in lines:
+            text = self.render_text(self.font_small, line, (200, 200, 220))
+            self.screen.blit(text, (rect.x + 10, y))
+            y += 24
+
     def draw_editor(self):
         """Рисует редактор паттерна."""
         panel_y = WINDOW_HEIGHT - 140
@@ -785,8 +5285,8 @@ class Game:
                          (0, panel_y), (WINDOW_WIDTH, panel_y), 3)
 
         # Заголовок
-        title = self.font.render(f"Редактор: {building.type.upper()}",
-                                 True, building.color)
+        title = self.render_text(self.font, f"Редактор: {building.type.upper()}",
+                                 building.color)
         self.screen.blit(title, (20, panel_y + 10))
 
         # Статус
@@ -796,9 +5296,14 @@ class Game:
         if building.solo:
             status_parts.append("SOLO")
         status_parts.append(f"Vol: {building.volume:.1f}")
-
-        status = self.font_small.render(" | ".join(status_parts),
-                                        True, (255, 200, 50))
+        if building.pan:
+            status_parts.append(f"Pan: {building.pan:+.1f}")
+        chain, (steps, _) = self.edited_bar()
+        status_parts.append(f"Такт {self.edit_bar + 1}/{len(chain)}")
+        status_parts.append(f"Сетка {RESOLUTIONS[steps]}")
+
+        status = self.render_text(self.font_small, " | ".join(status_parts),
+                                  (255, 200, 50))
         self.screen.blit(status, (250, panel_y + 13))
 
         # Кнопки управления паттерном
@@ -812,57 +5317,276 @@ class Game:
             pygame.draw.rect(self.screen, color, rect)
             pygame.draw.rect(self.screen, (255, 255, 255), rect, 2)
 
-            label = self.font_small.render(text, True, (255, 255, 255))
+            label = self.render_text(self.font_small, text, (255, 255, 255))
             label_rect = label.get_rect(center=rect.center)
             self.screen.blit(label, label_rect)
 
         # Подсказка
-        hint = self.font_small.render("M: mute | S: solo | UP/DOWN: громкость | ESC: закрыть",
-                                      True, (150, 150, 170))
+        hint = ("M: mute | S: solo | UP/DOWN: громкость | LEFT/RIGHT: панорама | TAB: такт | "
+                "C: добавить такт | DEL: убрать | R: сетка | ESC: закрыть")
+        if building.type in PITCHED_TYPES:
+            hint += " | Колесо над шагом: нота"
+        hint = self.render_text(self.font_small, hint, (150, 150, 170))
         self.screen.blit(hint, (20, panel_y + 40))
 
-        # 16 шагов паттерна
-        for i in range(16):
-            x = 50 + i * 65
-            y = panel_y + 70
+        # Шаги такта (16, 32, 64 или триоли - клетки делят ту же ширину)
+        chain, (steps, mask) = self.edited_bar()
+        notes = self.timeline.notes.get(building.slot)
+        playhead = None
+        seq = self.sequencer
+        if seq.playing and seq.current_bar % len(chain) == self.edit_bar:
+            playhead = seq.current_step * steps // STEPS_PER_BAR
+
+        for i, rect in enumerate(self.step_rects(steps)):
+            on = mask >> i & 1
 
             # Выбираем цвет шага
-            if building.pattern[i]:
+            if on:
                 color = building.color  # Активный шаг - цветом инструмента
             else:
                 color = (60, 60, 75)  # Неактивный шаг - серый
 
             # Подсвечиваем текущий шаг при воспроизведении
-            if self.sequencer.playing and self.sequencer.current_step == i:
-                pygame.draw.rect(self.screen, (255, 255, 100),
-                                 (x - 3, y - 3, 66, 56), 3)
+            if playhead == i:
+                pygame.draw.rect(self.screen, (255, 255, 100), rect.inflate(6, 6), 3)
 
             # Рисуем квадрат шага
-            rect = pygame.Rect(x, y, 60, 50)
             pygame.draw.rect(self.screen, color, rect)
-            pygame.draw.rect(self.screen, (150, 150, 170), rect, 2)
-
-            # Номер шага (1-16)
-            num_color = (0, 0, 0) if building.pattern[i] else (120, 120, 140)
-            num = self.font_small.render(str(i + 1), True, num_color)
-            num_rect = num.get_rect(center=rect.center)
-            self.screen.blit(num, num_rect)
+            pygame.draw.rect(self.screen, (150, 150, 170), rect, 2 if rect.width > 20 else 1)
+
+            # Номер шага (если влезает)
+            if rect.width >= 24:
+                num_color = (0, 0, 0) if on else (120, 120, 140)
+                num = self.render_text(self.font_small, str(i + 1), num_color)
+                num_rect = num.get_rect(center=rect.center)
+                self.screen.blit(num, num_rect)
+
+            # Нота шага (ноты лежат по шестнадцатым)
+            note = notes[i * STEPS_PER_BAR // steps] if notes else 0
+            if note and rect.width >= 24:
+                label = self.render_text(self.font_small, f"{note:+d}", (255, 255, 255))
+                self.screen.blit(label, label.get_rect(midtop=(rect.centerx, rect.y + 3)))
+
+        # Волна и огибающая сэмпла справа от шагов
+        envelope = Building.envelopes.get(building.type)
+        wave_rect = pygame.Rect(1110, WINDOW_HEIGHT - 70, 150, 50)
+        pygame.draw.rect(self.screen, (25, 25, 35), wave_rect)
+        wave = self.atlas.waveform(building.type, wave_rect.size, building.color)
+        if wave is not None:
+            self.screen.blit(wave, wave_rect)
+            length = self.render_text(self.font_small, f"{envelope.length * 1000:.0f} мс", (150, 150, 170))
+            self.screen.blit(length, length.get_rect(bottomright=(wave_rect.right, wave_rect.y - 2)))
+        pygame.draw.rect(self.screen, (70, 70, 90), wave_rect, 1)
+
+    def run_profiled_frame(self):
+        # Тот же кадр, но с замером каждой части
+        t0 = time.perf_counter()
+        self.handle_events()
+        t1 = time.perf_counter()
+        self.update()
+        t2 = time.perf_counter()
+        self.draw()
+        t3 = time.perf_counter()
+        self.clock.tick(FPS)
+        t4 = time.perf_counter()
+
+        # Со звуком в процессе голоса звучат там, а не в каналах pygame
+        voices = self.audio.voices() if self.audio else self.voices.active()
+        self.profiler.frame(t1 - t0, t2 - t1, t3 - t2, t4 - t3, voices)
 
     def run(self):
         """Главный цикл игры."""
+        # Первый кадр - сразу, шрифты и звуки догружаются уже под ним
+        self.handle_events()
+        self.update()
+        self.draw()
+        self.startup.frame()
+        self.start_background()
+
         while self.running:
+            if self.profiler.enabled:
+                self.run_profiled_frame()
+                continue
+
             self.handle_events()
             self.update()
             self.draw()
             self.clock.tick(FPS)
 
+        self.sequencer.shutdown()
+        self.profiler.close()
+        if self.autosave:
+            self.autosave.stop()
+        if self.audio:
+            self.audio.close()
+        if self.jam:
+            self.jam.close()
         pygame.quit()
         sys.exit()
 
 
-# Запуск
-if __name__ == "__main__":
-    game = Game()
+def city_size_arg(text):
+    # Тип аргумента --city: "COLSxROWS", оба числа от 1 до MAX_CITY_SIDE
+    parts = text.lower().split("x")
+    try:
+        size = tuple(int(part) for part in parts)
+    except ValueError:
+        size = ()
+    if len(size) != 2 or not all(1 <= side <= MAX_CITY_SIDE for side in size):
+        raise argparse.ArgumentTypeError(
+            f"нужно COLSxROWS, два целых от 1 до {MAX_CITY_SIDE}, а не {text!r}")
+    return size
+
+
+def load_mixer_config(path):
+    """Настройки микшера pygame из файла калибровки (или по умолчанию)."""
+    config = dict(MIXER_DEFAULTS)
+    if path is None or not os.path.exists(path):
+        return config
+    try:
+        with open(path, encoding="utf-8") as f:
+            saved = json.load(f)
+        for key, default in MIXER_DEFAULTS.items():
+            if key in saved:
+                config[key] = type(default)(saved[key])
+    except (OSError, ValueError, TypeError) as error:
+        print(f"Не удалось прочитать настройки звука {path}: {error}")
+        return dict(MIXER_DEFAULTS)
+    config["latency"] = min(max(config["latency"], 0.0), MAX_LATENCY)
+    return config
+
+
+def save_mixer_config(path, config):
+    # Пишет настройки микшера (и замеры калибровки) в JSON
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(config, f, ensure_ascii=False, indent=2)
+
+
+def mixer_latency(mode, output, rate):
+    """
+    Через сколько секунд после запуска шага слышен его удар. В режиме
+    channels это задержка вывода output (из калибровки); шина и процесс
+    звука добавляют кусок в очереди канала и блок ограничителя, а процесс
+    ещё сводит на AUDIO_AHEAD вперёд.
+    """
+    if mode == "channels":
+        return output
+    latency = output + (AUDIO_CHUNK + AUDIO_BLOCK) / rate
+    if mode == "process":
+        latency += AUDIO_AHEAD
+    return latency
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Ритм-город")
+    parser.add_argument("--simulate", nargs="*", metavar="LAYOUT",
+                        help="прогнать раскладки (JSON) по всем уровням без окна и звука")
+    parser.add_argument("--report", default="simulation.json",
+                        help="куда записать отчёт прогона")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1,
+                        help="сколько процессов для прогона раскладок и сжатия кадров записи")
+    parser.add_argument("--city", type=city_size_arg, default=(CITY_COLS, CITY_ROWS),
+                        metavar="COLSxROWS",
+                        help="размер города в клетках, например 1000x1000")
+    parser.add_argument("--voices", type=int, default=VOICE_BUDGET,
+                        help="сколько звуков может играть одновременно (--mixer channels)")
+    parser.add_argument("--steal", default=VOICE_STEAL, choices=["oldest", "quietest", "none"],
+                        help="кого глушить, когда голоса кончились (none - пропускать удар)")
+    parser.add_argument("--profile-log", metavar="PATH",
+                        help="включить профайлер и писать замеры в файл (.csv или JSON lines)")
+    parser.add_argument("--bench", action="store_true",
+                        help="замерить точность секвенсера по темпам и размерам города")
+    parser.add_argument("--bench-bpm", type=int, nargs="+",
+                        default=list(range(MIN_BPM, MAX_BPM + 1, BPM_STEP)),
+                        help="темпы для замера")
+    parser.add_argument("--bench-sizes", type=int, nargs="+", default=list(BENCH_SIZES),
+                        help="размеры города (зданий) для замера")
+    parser.add_argument("--bench-bars", type=int, default=BENCH_BARS,
+                        help="сколько тактов в каждом прогоне")
+    parser.add_argument("--bench-jitter", type=float, default=BENCH_OVERSLEEP * 1000.0,
+                        help="среднее опоздание пробуждения потока, мс")
+    parser.add_argument("--bench-stalls", type=float, default=0.0,
+                        help=f"доля пробуждений с подвисанием на {BENCH_STALL * 1000:.0f} мс")
+    parser.add_argument("--bench-seed", type=int, default=0,
+                        help="зерно случайных опозданий")
+    parser.add_argument("--bench-out", default="bench.csv",
+                        help="куда записать таблицу замера")
+    parser.add_argument("--bench-compare", metavar="CSV",
+                        help="прошлая таблица замера для сравнения")
+    parser.add_argument("--save", default=SAVE_PATH, metavar="PATH",
+                        help="файл сохранения города (F5/F9 и автосохранение)")
+    parser.add_argument("--open", action="store_true",
+                        help="при запуске загрузить город из файла сохранения")
+    parser.add_argument("--autosave", type=float, default=AUTOSAVE_INTERVAL, metavar="SECONDS",
+                        help="раз во сколько секунд автосохранение (0 - только по F5)")
+    parser.add_argument("--mixer", default=MIXER_MODE, choices=["bus", "process", "channels"],
+                        help="bus - шина с ограничителем в игре, process - она же в отдельном "
+                             "процессе (подвисания окна её не прерывают), channels - канал pygame "
+                             "на каждый удар")
+    parser.add_argument("--audio-process", action="store_true",
+                        help="то же, что --mixer process")
+    parser.add_argument("--jam", metavar="HOST:PORT",
+                        help="играть вместе: подключиться к серверу совместной игры")
+    parser.add_argument("--jam-server", metavar="[HOST:]PORT",
+                        help=f"запустить сервер совместной игры (без окна), порт по умолчанию "
+                             f"{JAM_PORT}; без HOST слушает только {JAM_HOST}, для игры по сети "
+                             f"укажите адрес явно, например 0.0.0.0:{JAM_PORT}")
+    parser.add_argument("--capture", metavar="PATH",
+                        help="записать проигрывание города из --save без окна: .gif, .mp4 "
+                             "(сводит ffmpeg) или папка кадров PNG; звук - WAV рядом")
+    parser.add_argument("--capture-seconds", type=float, default=CAPTURE_SECONDS,
+                        help="длина записи, с")
+    parser.add_argument("--capture-fps", type=int, default=CAPTURE_FPS,
+                        help="кадров в секунду записи")
+    parser.add_argument("--calibrate", action="store_true",
+                        help="калибровка звука: задержка и пропуски при разных буферах "
+                             "и моно/стерео, лучшие настройки - в файл --mixer-config")
+    parser.add_argument("--mixer-config", default=MIXER_CONFIG_PATH, metavar="PATH",
+                        help="файл настроек звука (частота, буфер, каналы, задержка вывода)")
+    parser.add_argument("--profile-startup", action="store_true",
+                        help="напечатать, сколько заняли импорт, окно, звук, шрифты и сэмплы "
+                             "и через сколько появился первый кадр")
+    args = parser.parse_args()
+
+    if args.simulate is not None:
+        from simulate import run_simulation
+        run_simulation(args.simulate, args.report, args.workers)
+        return
+
+    if args.jam_server:
+        from jam_server import run_jam_server
+        run_jam_server(args.jam_server)
+        return
+
+    if args.capture:
+        from capture import run_capture
+        run_capture(args.capture, args.save, args.capture_seconds, args.capture_fps, args.workers)
+        return
+
+    if args.calibrate:
+        from calibrate import Calibration
+        Calibration(args.mixer_config).run()
+        return
+
+    if args.bench:
+        from bench import run_benchmark
+        run_benchmark(args.bench_bpm, args.bench_sizes, args.bench_bars, args.bench_out,
+                      args.bench_compare, args.bench_jitter / 1000.0, args.bench_stalls,
+                      args.bench_seed)
+        return
+
+    steal = None if args.steal == "none" else args.steal
+    game = Game(city_size=args.city, voice_budget=args.voices, voice_steal=steal,
+                profile_log=args.profile_log, save_path=args.save, autosave=args.autosave,
+                mixer="process" if args.audio_process else args.mixer, jam=args.jam,
+                profile_startup=args.profile_startup, mixer_config=args.mixer_config)
+    if args.open:
+        game.load_city(args.save)
 
     game.run()
 
+
+# Запуск
+if __name__ == "__main__":
+    main()
+
@@ -0,0 +1,7 @@
+# Игра под именем, которое можно импортировать (в имени файла игры дефис):
+# через него игру импортируют тесты и процессы, запущенные без неё
+import os
+
+_GAME_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "rhytm-city.py")
+with open(_GAME_PATH, encoding="utf-8") as _file:
+    exec(compile(_file.read(), _GAME_PATH, "exec"))
@@ -0,0 +1,127 @@
+# Прогон раскладок по уровням без окна и звука (--simulate)
+import json
+import os
+import time
+from multiprocessing import Pool
+
+from rhytm_city import BUILDING_COLORS, DEFAULT_BPM, FPS, LEVELS, Game, parse_pattern
+
+
+def default_layout():
+    """
+    Раскладка по умолчанию для прогона уровней: на каждом уровне ставит
+    нужное число зданий по кругу из всех типов и выставляет требуемый BPM.
+    """
+    types = list(BUILDING_COLORS)
+    levels = {}
+    for index, level in enumerate(LEVELS):
+        buildings = []
+        for i in range(level['target_buildings']):
+            buildings.append({"col": i % 12, "row": i // 12,
+                              "type": types[i % len(types)], "volume": 0.5})
+        levels[str(index)] = {"bpm": level['required_bpm'] or DEFAULT_BPM,
+                              "buildings": buildings}
+    return {"name": "default", "levels": levels}
+
+
+def load_layout(path):
+    """
+    Читает раскладку города из JSON:
+    {"name": ..., "bpm": 120, "buildings": [{"col", "row", "type",
+     "volume", "pattern": "x...x...x...x...", "muted", "solo",
+     "arrangement": ["x...x...x...x...", "x.x.x.x.x.x.x.x.x.x.x.x.x.x.x.x.", ...]}, ...],
+     "levels": {"2": {"bpm": ..., "buildings": [...]}}}
+    Раздел levels необязательный и заменяет bpm/buildings для уровня.
+    arrangement - цепочка тактов; сетка такта задаётся длиной строки
+    (16, 32, 64 шага или триоли - 12 и 24).
+    """
+    with open(path, encoding="utf-8") as f:
+        layout = json.load(f)
+    layout.setdefault("name", os.path.splitext(os.path.basename(path))[0])
+    return layout
+
+
+def simulate_layout(layout, fps=FPS):
+    """
+    Прогоняет раскладку через Game.update / check_level_goals на каждом
+    уровне из LEVELS по виртуальным часам, без окна и звука.
+    Возвращает отчёт: сколько тактов сыграно, за сколько секунд игрового
+    времени пройден уровень и какая цель не дала его пройти.
+    """
+    started = time.perf_counter()
+    game = Game(headless=True)
+    dt = 1.0 / fps
+    report = {"layout": layout["name"], "levels": []}
+
+    for index, level in enumerate(LEVELS):
+        script = layout.get("levels", {}).get(str(index), layout)
+
+        # Загружаем уровень с чистой картой
+        game.current_level_index = index
+        game.level = level
+        game.level_completed = False
+        game.bars_playing = 0
+        game.clear_city()
+
+        game.set_bpm(script.get("bpm", DEFAULT_BPM))
+        for item in script.get("buildings", []):
+            building = game.add_building(item["col"], item["row"], item["type"])
+            building.volume = item.get("volume", building.volume)
+            building.muted = item.get("muted", False)
+            building.solo = item.get("solo", False)
+            if "pattern" in item:
+                building.pattern = [c == "x" for c in item["pattern"]]
+            game.building_changed(building)
+            if "arrangement" in item:
+                game.set_chain(building, [parse_pattern(text) for text in item["arrangement"]])
+
+        # Играем, пока уровень не пройден или такты не кончились
+        game.sequencer.start()
+        game.bars_seen = game.sequencer.bars_done
+        start_time = game.sequencer.virtual_time
+        while not game.level_completed and game.bars_playing <= level['target_bars']:
+            game.update(dt)
+        game.sequencer.stop()
+
+        report["levels"].append({
+            "level": index,
+            "name": level['name'],
+            "completed": game.level_completed,
+            "bars_played": game.bars_playing,
+            "time_to_complete": (round(game.sequencer.virtual_time - start_time, 3)
+                                 if game.level_completed else None),
+            "blocked_by": None if game.level_completed else game.blocking_goal(),
+            "bpm": game.sequencer.bpm,
+            "buildings": len(game.buildings),
+            "rms": round(game.current_rms, 3),
+        })
+
+    report["wall_time"] = round(time.perf_counter() - started, 3)
+    return report
+
+
+def run_simulation(paths, report_path, workers=1):
+    # Прогоняет раскладки (по умолчанию - встроенную) и пишет отчёт в JSON
+    layouts = [load_layout(path) for path in paths] or [default_layout()]
+
+    if workers > 1 and len(layouts) > 1:
+        # Процессы отпускаем через close/join: в них поднят SDL, а он перехватывает
+        # SIGTERM, которым их останавливает Pool.terminate (выход из with)
+        pool = Pool(workers)
+        reports = pool.map(simulate_layout, layouts)
+        pool.close()
+        pool.join()
+    else:
+        reports = [simulate_layout(layout) for layout in layouts]
+
+    with open(report_path, "w", encoding="utf-8") as f:
+        json.dump(reports, f, ensure_ascii=False, indent=2)
+
+    for report in reports:
+        passed = sum(1 for level in report["levels"] if level["completed"])
+        print(f"{report['layout']}: пройдено {passed}/{len(LEVELS)} "
+              f"за {report['wall_time']:.2f} с")
+        for level in report["levels"]:
+            if not level["completed"]:
+                print(f"  {level['name']}: мешает {level['blocked_by']}")
+    print(f"Отчёт: {report_path}")
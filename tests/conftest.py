@@ -0,0 +1,21 @@
+import importlib
+import os
+import sys
+
+import pytest
+
+GAME_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "rhytm city")
+sys.path.insert(0, GAME_DIR)
+
+
+@pytest.fixture(scope="session")
+def rc():
+    # Модуль игры (через rhytm_city - в имени файла дефис), без окна и звука
+    os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+    os.environ.setdefault("SDL_AUDIODRIVER", "dummy")
+    return importlib.import_module("rhytm_city")
+
+
+@pytest.fixture(scope="session")
+def game(rc):
+    return rc.Game(headless=True)
@@ -0,0 +1,67 @@
+import importlib
+import struct
+
+import numpy as np
+import pytest
+
+
+@pytest.fixture(scope="module")
+def capture(rc):
+    # Модуль записи импортирует игру, поэтому - после rc
+    return importlib.import_module("capture")
+
+
+def lzw_decode(data):
+    # Распаковка данных кадра GIF: размер кода, блоки до 255 байт, коды 9-12 бит
+    assert data[0] == 8
+    stream, pos = bytearray(), 1
+    while data[pos]:
+        stream += data[pos + 1:pos + 1 + data[pos]]
+        pos += 1 + data[pos]
+    assert pos == len(data) - 1
+
+    bits, offset = int.from_bytes(stream, "little"), 0
+    out, table, previous, width = bytearray(), [], None, 9
+    while True:
+        code = bits >> offset & (1 << width) - 1
+        offset += width
+        if code == 256:
+            table, previous, width = [bytes((i,)) for i in range(256)] + [b"", b""], None, 9
+            continue
+        if code == 257:
+            return bytes(out)
+        if previous is None:
+            entry = table[code]
+        else:
+            entry = table[code] if code < len(table) else previous + previous[:1]
+            table.append(previous + entry[:1])
+        out += entry
+        previous = entry
+        if len(table) == 1 << width and width < 12:
+            width += 1
+
+
+@pytest.mark.parametrize("colors", [2, 256])
+def test_lzw_round_trip(capture, colors):
+    # Много повторов и шум: словарь заполняется и очищается несколько раз
+    rng = np.random.default_rng(colors)
+    indices = np.repeat(rng.integers(0, colors, 40000), rng.integers(1, 8, 40000)).astype(np.uint8)
+    data = capture.lzw_encode(indices)
+    assert lzw_decode(data) == indices.tobytes()
+
+
+def test_gif_frame_is_image_block(capture):
+    rng = np.random.default_rng(0)
+    pixels = rng.integers(0, 256, (30, 40, 3), dtype=np.uint8)
+    palette, lookup = capture.gif_palette(pixels)
+    block = capture.gif_frame((5, 7, pixels, lookup))
+
+    # Описание куска: место и размер, без своей палитры
+    assert block[0] == 0x2c
+    assert struct.unpack("<4HB", block[1:10]) == (5, 7, 40, 30, 0)
+
+    # Распакованный кусок - номера цветов из таблицы gif_palette, строка за строкой
+    indices = np.frombuffer(lzw_decode(block[10:]), dtype=np.uint8).reshape(30, 40)
+    coarse = pixels >> 3
+    np.testing.assert_array_equal(indices, lookup[coarse[..., 0], coarse[..., 1], coarse[..., 2]])
+    assert len(palette) == 256
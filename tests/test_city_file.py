@@ -0,0 +1,141 @@
+import os
+
+import numpy as np
+import pytest
+
+
+@pytest.fixture
+def city(rc, game):
+    # Город из нескольких зданий с разными полями; одно удалено (мёртвая запись)
+    game.clear_city()
+    game.set_bpm(128)
+    game.current_level_index = 2
+    game.bars_playing = 7
+    for i, building_type in enumerate(rc.BUILDING_TYPES):
+        building = game.add_building(i, i % 3, building_type)
+        building.volume = 0.1 * (i + 1)
+        building.pan = -0.5 + 0.25 * i
+        building.muted = i % 2 == 0
+        building.solo = i == 3
+        building.pattern = [(step + i) % 3 == 0 for step in range(rc.STEPS_PER_BAR)]
+        game.building_changed(building)
+    game.remove_building(game.buildings.view(1))
+    return game
+
+
+def stored(store):
+    # Поля всех слотов хранилища, как их видит файл
+    with store.lock:
+        return store.records()
+
+
+def test_round_trip(rc, city, tmp_path):
+    path = str(tmp_path / "city.rcity")
+    count = rc.save_city(city, path)
+
+    header, records = rc.open_city(path)
+    assert isinstance(records, np.memmap)
+    assert count == len(records) == city.buildings.size
+    assert header["version"] == rc.CITY_VERSION
+    assert header["bpm"] == 128
+    assert header["level"] == 2
+    assert header["bars"] == 7
+    assert (header["cols"], header["rows"]) == (city.grid.cols, city.grid.rows)
+    np.testing.assert_array_equal(records, stored(city.buildings))
+
+    store = rc.BuildingStore.from_records(records)
+    assert len(store) == len(city.buildings)
+    np.testing.assert_array_equal(stored(store), stored(city.buildings))
+
+
+def test_from_records_is_lazy(rc, city, tmp_path):
+    path = str(tmp_path / "city.rcity")
+    rc.save_city(city, path)
+    _, records = rc.open_city(path)
+
+    store = rc.BuildingStore.from_records(records)
+    assert "pan" not in store.__dict__ and store.source is not None
+    np.testing.assert_allclose(store.pan[:store.size], city.buildings.pan[:store.size], atol=0.01)
+    assert "pan" in store.__dict__
+
+    # Рост массивов раскодирует всё и отпускает файл
+    store.grow()
+    assert store.source is None
+    assert len(store.col) == 2 * max(64, len(records))
+
+
+def test_incremental_rewrite(rc, city, tmp_path):
+    path = str(tmp_path / "city.rcity")
+    autosave = rc.Autosave(city, path, interval=0)
+    try:
+        autosave.save()
+        assert autosave.records_written == city.buildings.size
+
+        # Одна правка - одна запись
+        size = city.buildings.size
+        building = city.buildings.view(0)
+        building.volume = 0.95
+        city.building_changed(building)
+        autosave.save()
+        assert autosave.records_written == size + 1
+
+        # Первое новое здание занимает освободившийся слот, второе - дописывается в конец
+        city.add_building(20, 5, rc.BUILDING_TYPES[0])
+        city.add_building(21, 5, rc.BUILDING_TYPES[1])
+        autosave.save()
+        assert city.buildings.size == size + 1
+        assert autosave.records_written == size + 3
+
+        header, records = rc.open_city(path)
+        assert header["records"] == city.buildings.size
+        np.testing.assert_array_equal(records, stored(city.buildings))
+    finally:
+        autosave.stop()
+
+
+def test_autosave_keeps_foreign_file(rc, city, tmp_path):
+    path = str(tmp_path / "city.rcity")
+    with open(path, "wb") as f:
+        f.write(b"saved by another session")
+
+    autosave = rc.Autosave(city, path, interval=0)
+    try:
+        city.add_building(20, 5, rc.BUILDING_TYPES[0])
+        autosave.save()
+        with open(path, "rb") as f:
+            assert f.read() == b"saved by another session"
+        assert not os.path.exists(path + ".chains")
+
+        # F5 - игрок сам решил перезаписать
+        autosave.request()
+        autosave.save()
+        header, _ = rc.open_city(path)
+        assert header["records"] == city.buildings.size
+    finally:
+        autosave.stop()
+
+
+def test_load_version_1(rc, city, tmp_path):
+    path = str(tmp_path / "old.rcity")
+    records = stored(city.buildings)
+    old = np.zeros(len(records), dtype=rc.CITY_RECORDS[1])
+    for name in old.dtype.names:
+        old[name] = records[name]
+    header = rc.city_header(city, len(old))
+    header["version"] = 1
+    with open(path, "wb") as f:
+        f.write(header.tobytes())
+        f.write(old.tobytes())
+
+    header, loaded = rc.open_city(path)
+    assert header["version"] == 1 and loaded.dtype == rc.CITY_RECORDS[1]
+    store = rc.BuildingStore.from_records(loaded)
+    assert not store.pan[:store.size].any()
+
+    expected = records.copy()
+    expected["pan"] = 0
+    np.testing.assert_array_equal(stored(store), expected)
+
+    assert city.load_city(path)
+    assert city.sequencer.bpm == 128
+    np.testing.assert_array_equal(stored(city.buildings), expected)
@@ -0,0 +1,65 @@
+import numpy as np
+import pytest
+
+
+@pytest.fixture
+def history(rc, game, monkeypatch):
+    # Пустой город с историей отмены (в игре без окна её нет)
+    game.clear_city()
+    history = rc.History(game)
+    monkeypatch.setattr(game, "history", history)
+    history.attach()
+    return history
+
+
+def test_undo_and_redo_restore_buildings(rc, game, history):
+    kick = game.add_building(2, 3, "kick")
+    history.commit()
+    kick.volume = 0.3
+    game.building_changed(kick)
+    game.set_chain(kick, [(rc.STEPS_PER_BAR, 1), (rc.STEPS_PER_BAR, 0)])
+    history.commit()
+    game.remove_building(kick)
+    history.commit()
+    assert len(history.undo_stack) == 3
+
+    # Здание вернулось со своей громкостью и цепочкой
+    game.undo()
+    slot = game.cells[(2, 3)]
+    assert game.buildings.volume[slot] == pytest.approx(0.3)
+    assert game.timeline.chain(slot) == ((rc.STEPS_PER_BAR, 1), (rc.STEPS_PER_BAR, 0))
+
+    # Правка громкости и цепочки - одна запись
+    game.undo()
+    assert game.buildings.volume[slot] != pytest.approx(0.3)
+    assert slot not in game.timeline.chains
+
+    game.undo()
+    assert (2, 3) not in game.cells and len(game.buildings) == 0
+    assert history.undo() is None
+
+    # Повтор проходит те же записи обратно; отмена не попадает в журнал
+    game.undo(redo=True)
+    game.undo(redo=True)
+    history.commit()
+    assert game.timeline.chain(game.cells[(2, 3)])[1] == (rc.STEPS_PER_BAR, 0)
+    assert len(history.undo_stack) == 2 and len(history.redo_stack) == 1
+
+
+def test_history_stays_within_memory_limit(rc, game, history):
+    building = game.add_building(0, 0, "hihat")
+    history.commit()
+    one = history.bytes
+    history.limit = 3 * one
+
+    for step in range(10):
+        building.volume = step / 10
+        game.building_changed(building)
+        history.commit()
+
+    # Старые записи забыты, последние правки отменяются
+    assert history.bytes <= history.limit
+    assert len(history.undo_stack) == 3
+    game.undo()
+    assert game.buildings.volume[building.slot] == pytest.approx(0.8)
+    assert np.count_nonzero(game.buildings.alive) == 1
@@ -0,0 +1,88 @@
+import asyncio
+import importlib
+
+import pytest
+
+
+def parse(rc, messages):
+    # Сообщения jam_delta -> [(вид, поля)], как их читает сервер
+    async def read():
+        reader = asyncio.StreamReader()
+        reader.feed_data(b"".join(messages))
+        reader.feed_eof()
+        parsed = []
+        while not reader.at_eof():
+            parsed.append(await rc.net_read(reader))
+        return parsed
+
+    return asyncio.run(read())
+
+
+def replay(rc, record, messages):
+    # Применяет сообщения к записи одной клетки, как сервер и клиенты
+    for kind, fields in parse(rc, messages):
+        record = rc.jam_apply(record, kind, fields)
+    return record
+
+
+@pytest.fixture
+def kick(rc):
+    return rc.jam_default((3, 4), rc.BUILDING_TYPES.index("kick"))
+
+
+def edits(rc, kick):
+    # Пары (было, стало) - от правки одного шага до замены здания
+    chain = kick["chain"]
+    steps, mask = chain[0]
+    bass = rc.BUILDING_TYPES.index("bass")
+    return [
+        (None, kick),
+        (kick, None),
+        (kick, kick),
+        (kick, dict(kick, volume=37)),
+        (kick, dict(kick, pan=-rc.PAN_SCALE, muted=True, solo=True)),
+        (kick, dict(kick, chain=((steps, mask ^ 1 << 5),))),
+        (kick, dict(kick, chain=((steps, mask ^ 0b1011),))),
+        (kick, dict(kick, chain=((32, 0xF0F0F0F0), (12, 0b101), (steps, mask)))),
+        (kick, dict(kick, notes=(0, 3, -5) + (0,) * (rc.STEPS_PER_BAR - 3))),
+        (kick, dict(kick, cell=(7, 1))),
+        (kick, dict(rc.jam_default((3, 4), bass), volume=150)),
+    ]
+
+
+def test_delta_round_trip(rc, kick):
+    for old, new in edits(rc, kick):
+        assert replay(rc, old, rc.jam_delta(old, new)) == new
+
+
+def test_delta_is_minimal(rc, kick):
+    steps, mask = kick["chain"][0]
+    assert rc.jam_delta(kick, kick) == []
+    assert len(rc.jam_delta(kick, dict(kick, volume=37))) == 1
+    # Один переключённый шаг - одно NET_STEP в 8 байт
+    step = rc.jam_delta(kick, dict(kick, chain=((steps, mask ^ 1 << 5),)))
+    assert len(step) == 1 and step[0][0] == rc.NET_STEP and len(step[0]) == 8
+
+
+def test_apply_rejects_stale_edits(rc, kick):
+    with pytest.raises(ValueError):
+        rc.jam_apply(None, rc.NET_VOLUME, (3, 4, 10))
+    with pytest.raises(ValueError):
+        rc.jam_apply(kick, rc.NET_STEP, (3, 4, 5, 0, True))
+    with pytest.raises(ValueError):
+        rc.jam_apply(kick, rc.NET_PLACE, (3, 4, len(rc.BUILDING_TYPES)))
+    assert rc.jam_apply(kick, rc.NET_VOLUME, (3, 4, 255))["volume"] == rc.VOLUME_SCALE
+
+
+def test_server_applies_and_corrects(rc, kick):
+    server = importlib.import_module("jam_server").JamServer()
+    assert server.host == rc.JAM_HOST
+    for message in rc.jam_delta(None, kick):
+        kind, fields = parse(rc, [message])[0]
+        assert server.apply(kind, fields) is None
+    assert server.records[(3, 4)] == kick
+
+    # Клетка занята - автору приходит она целиком, как на сервере
+    kind, fields = parse(rc, [rc.net_message(rc.NET_PLACE, 3, 4, 1)])[0]
+    reply = server.apply(kind, fields)
+    assert replay(rc, None, [reply]) == kick
@@ -0,0 +1,69 @@
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+from conftest import GAME_DIR
+
+# Моно микшер поднимается в отдельном процессе: в тестах микшер уже стерео.
+# Калибровка замеряет моно (щелчки и куски тишины), игра с её микшером
+# транспонирует ноту и сводит петлю и шину
+MONO = """
+import sys
+sys.path.insert(0, sys.argv[1])
+import rhytm_city as rc
+import calibrate
+
+calibrate.CALIBRATE_PROBES = 2
+calibrate.CALIBRATE_FEED = 0.1
+result = calibrate.Calibration(sys.argv[2]).measure(44100, 512, channels=1)
+assert result["channels"] == 1 and rc.pygame.mixer.get_init()[2] == 1
+
+game = rc.Game(headless=True)
+bass = game.add_building(0, 0, "bass")
+game.set_notes(bass, (7,) + (0,) * (rc.STEPS_PER_BAR - 1))
+game.add_building(1, 0, "kick")
+game.timeline.refresh()
+rc.Building.pitch.get("bass", 7)
+rc.Building.pitch.drain()
+assert rc.Building.pitch.get("bass", 7)[1] is not None
+
+game.bar_loop.render()
+assert rc.pygame.sndarray.array(game.bar_loop.take_sound()).ndim == 1
+bus = rc.MixerBus(game, 0)
+assert rc.pygame.sndarray.array(bus.render(0.0)).shape == (rc.AUDIO_CHUNK,)
+"""
+
+
+def test_mixer_config_defaults_and_limits(rc, tmp_path):
+    path = str(tmp_path / "mixer.json")
+    assert rc.load_mixer_config(path) == rc.MIXER_DEFAULTS
+
+    # Задержка ограничена MAX_LATENCY, типы - как у настроек по умолчанию
+    rc.save_mixer_config(path, {"buffer": "1024", "channels": 1, "latency": 5})
+    config = rc.load_mixer_config(path)
+    assert config["buffer"] == 1024 and config["channels"] == 1
+    assert config["latency"] == rc.MAX_LATENCY
+    assert config["frequency"] == rc.MIXER_DEFAULTS["frequency"]
+
+    # Битый файл - настройки по умолчанию
+    (tmp_path / "mixer.json").write_text("{", encoding="utf-8")
+    assert rc.load_mixer_config(path) == rc.MIXER_DEFAULTS
+
+
+def test_mixer_latency_counts_buffers(rc):
+    rate = 44100
+    assert rc.mixer_latency("channels", 0.02, rate) == 0.02
+    bus = rc.mixer_latency("bus", 0.02, rate)
+    assert bus == pytest.approx(0.02 + (rc.AUDIO_CHUNK + rc.AUDIO_BLOCK) / rate)
+    assert rc.mixer_latency("process", 0.02, rate) == pytest.approx(bus + rc.AUDIO_AHEAD)
+
+
+def test_mono_mixer(tmp_path):
+    env = dict(os.environ, SDL_VIDEODRIVER="dummy", SDL_AUDIODRIVER="dummy")
+    done = subprocess.run([sys.executable, "-c", MONO, GAME_DIR, str(tmp_path / "mixer.json")],
+                          env=env, capture_output=True, text=True, timeout=120)
+    assert done.returncode == 0, done.stderr
+    assert "Не удалось" not in done.stdout
@@ -0,0 +1,174 @@
+import math
+import time
+
+import numpy as np
+import pytest
+
+
+@pytest.fixture(scope="module")
+def city(rc):
+    # 50 зданий всех типов с паттернами по умолчанию
+    rc.Building.load_sounds()
+    store = rc.BuildingStore()
+    for i in range(50):
+        store.add(i % 10, i // 10, rc.BUILDING_TYPES[i % len(rc.BUILDING_TYPES)])
+    timeline = rc.Timeline(store)
+    timeline.refresh()
+    return store, timeline
+
+
+@pytest.fixture
+def song(rc, game):
+    # Бочка с цепочкой из двух тактов: второй такт молчит
+    game.clear_city()
+    game.set_bpm(120)
+    kick = game.add_building(0, 0, "kick")
+    game.timeline.refresh()
+    plain = game.calculate_rms()
+    game.set_chain(kick, [(rc.STEPS_PER_BAR, kick.mask), (rc.STEPS_PER_BAR, 0)])
+    game.timeline.refresh()
+    return game, plain
+
+
+def bar_frames(rc, game, rate):
+    return int(round(rate * 60.0 / game.sequencer.bpm / rc.STEPS_PER_BEAT * rc.STEPS_PER_BAR))
+
+
+def test_bounce_is_faster_than_real_time(rc, city):
+    # 64 такта при 120 BPM - это 128 секунд звука
+    store, timeline = city
+    rate, bars = 44100, 64
+    seconds = bars * rc.STEPS_PER_BAR * 60.0 / 120 / rc.STEPS_PER_BEAT
+    best = float("inf")
+    for _ in range(3):
+        start = time.perf_counter()
+        mix = rc.render_city(store, timeline, 120, bars, rate)
+        best = min(best, time.perf_counter() - start)
+
+    assert len(mix) >= seconds * rate
+    assert abs(mix).max() > 0.1
+    assert best * 100 < seconds
+
+
+def test_meter_follows_timeline(song):
+    game, plain = song
+    assert game.timeline.bars == 2
+    # Половина тактов молчит - энергия вдвое меньше
+    assert game.calculate_rms() == pytest.approx(plain / np.sqrt(2), rel=0.02)
+
+
+def test_bounce_plays_chains(rc, song):
+    game, _ = song
+    rate = 44100
+    bar = bar_frames(rc, game, rate)
+    mix = rc.render_city(game.buildings, game.timeline, game.sequencer.bpm, 4, rate)
+
+    assert len(mix) >= 4 * bar
+    tail = len(rc.Building.samples["kick"])
+    assert np.abs(mix[:bar]).max() > 0.1
+    assert not mix[bar + tail:2 * bar].any()
+    assert np.abs(mix[2 * bar:3 * bar]).max() > 0.1
+
+    # Экспорт целиком и начало песни сводятся одинаково
+    np.testing.assert_array_equal(
+        mix[:2 * bar], rc.render_song(game.buildings, game.timeline, game.sequencer.bpm, rate, 2 * bar))
+
+
+def test_bar_loop_is_whole_song(rc, song):
+    game, _ = song
+    loop = game.bar_loop
+    loop.render()
+    rate = rc.pygame.mixer.get_init()[0]
+    assert loop.bars == 2 and loop.published is game.timeline.tick
+    sound = rc.pygame.sndarray.array(loop.take_sound())
+    assert len(sound) == 2 * bar_frames(rc, game, rate)
+
+
+def test_offline_render_is_pitched(rc, game, monkeypatch):
+    # Нота ещё не в кеше: экспорт ждёт её, а не играет исходный сэмпл
+    game.clear_city()
+    bass = game.add_building(0, 0, "bass")
+    bass.pattern = [step == 0 for step in range(rc.STEPS_PER_BAR)]
+    game.building_changed(bass)
+    game.set_notes(bass, (7,) + (0,) * (rc.STEPS_PER_BAR - 1))
+    game.timeline.refresh()
+    monkeypatch.setattr(rc.Building, "pitch", rc.PitchCache())
+
+    rate = 44100
+    stem = rc.render_song(game.buildings, game.timeline, game.sequencer.bpm, rate, 4096,
+                          rc.STEPS_PER_BAR)
+    left, _ = rc.pan_gains(bass.pan)
+    pitched = rc.pitch_sample(rc.Building.samples["bass"], 7)
+    np.testing.assert_allclose(stem[:, 0], left * bass.volume * pitched[:4096, 0], atol=1e-6)
+
+
+def test_failed_pitch_is_requested_again(rc, monkeypatch):
+    cache = rc.PitchCache()
+    with monkeypatch.context() as patch:
+        patch.setattr(rc, "pitch_sample", lambda sample, semitones: 1 / 0)
+        assert cache.get("bass", 5) is None
+        cache.drain()
+    # Неудачная нота не висит в очереди - следующий промах заказывает её снова
+    assert not cache.pending and not cache.entries
+    assert cache.get("bass", 5) is None
+    cache.drain()
+    assert cache.get("bass", 5) is not None
+
+
+def test_bar_loop_renders_only_changed_types(rc, song):
+    game, _ = song
+    loop = game.bar_loop
+    game.add_building(1, 0, "snare")
+    game.timeline.refresh()
+    loop.render()
+    renders = loop.renders
+
+    # Правка малого барабана не трогает петлю бочки
+    snare = game.buildings.view(game.cells[(1, 0)])
+    snare.volume = 0.3
+    game.building_changed(snare)
+    game.timeline.refresh()
+    loop.render()
+    assert loop.renders == renders + 1
+    assert set(loop.type_loops) == {"kick", "snare"}
+
+
+def test_mixer_follows_sequencer_clock(rc):
+    rate = 44100
+    mixer = rc.AudioMixer(rate, 120)
+    mixer.apply(rc.audio_message(rc.MSG_START, bar=0)[0])
+    mixer.render(rc.AUDIO_CHUNK)
+    step = mixer.step_frames
+    here = mixer.index - (mixer.step_start - mixer.frame) / step
+    tolerance = rc.AUDIO_DRIFT * rate
+
+    # Мелкое расхождение не трогаем
+    assert not mixer.align(here + 0.5 * tolerance / step, tolerance)
+
+    # Отстали на полшага - следующий шаг раньше, ничего не повторяется
+    index = mixer.index
+    assert mixer.align(here + 0.5, tolerance)
+    assert mixer.index == index
+    assert mixer.step_start == pytest.approx(mixer.frame + (index - here - 0.5) * step)
+
+    # Секвенсер ушёл на такт вперёд - прыгаем туда же
+    assert mixer.align(here + rc.STEPS_PER_BAR + 0.25, tolerance)
+    assert mixer.index == math.ceil(here + rc.STEPS_PER_BAR + 0.25)
+
+
+def test_bounce_limiter_matches_bus(rc):
+    # Ограничитель по всей записи делает то же, что шина блок за блоком
+    rate = 44100
+    rng = np.random.default_rng(1)
+    blocks = 200
+    loud = np.repeat(rng.uniform(0.2, 3.0, blocks), rc.AUDIO_BLOCK)[:, None]
+    song = (rng.uniform(-1.0, 1.0, (blocks * rc.AUDIO_BLOCK, 2)) * loud).astype(np.float32)
+
+    mixer = rc.AudioMixer(rate, 120)
+    parts = [mixer.limit(block.copy()) for block in np.split(song, blocks)]
+    parts.append(mixer.limit(np.zeros((rc.AUDIO_BLOCK, 2), dtype=np.float32)))
+    bus = np.concatenate(parts[1:])
+
+    limited = rc.limit_buffer(song.copy(), rate)
+    np.testing.assert_allclose(limited, bus, atol=1e-6)
+    assert np.abs(limited).max() <= rc.LIMITER_CEILING + 1e-6
@@ -0,0 +1,32 @@
+import os
+
+import numpy as np
+
+
+def test_pcm_cache(rc, tmp_path, monkeypatch):
+    monkeypatch.setattr(rc, "CACHE_DIR", str(tmp_path))
+    path = os.path.join(rc.SOUNDS_DIR, "Hi Hat - Hit 1.wav")
+
+    # Промах: WAV раскодирован и разобран, оба кеша записаны
+    pcm, envelope = rc.load_pcm(path)
+    cached = sorted(os.listdir(tmp_path))
+    assert len(cached) == 2
+    assert cached[0].endswith(".npy") and cached[1].endswith(".env.npz")
+    assert envelope.frames == len(pcm)
+
+    # Попадание: кеш открыт через memory map, WAV не разбирается, разбор не считается
+    def no_decode(*args, **kwargs):
+        raise AssertionError("WAV раскодирован при попадании в кеш")
+    with monkeypatch.context() as patch:
+        patch.setattr(rc.pygame.mixer, "Sound", no_decode)
+        patch.setattr(rc.SampleEnvelope, "from_sample", no_decode)
+        hit, hit_envelope = rc.load_pcm(path)
+    assert isinstance(hit, np.memmap)
+    np.testing.assert_array_equal(hit, pcm)
+    np.testing.assert_array_equal(hit_envelope.high, envelope.high)
+
+    # Битый кеш раскодируется заново
+    (tmp_path / cached[0]).write_bytes(b"not a numpy file")
+    np.testing.assert_array_equal(rc.load_pcm(path)[0], pcm)
+
+    assert rc.load_pcm(os.path.join(rc.SOUNDS_DIR, "missing.wav")) == (None, None)
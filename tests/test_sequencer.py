@@ -0,0 +1,54 @@
+import numpy as np
+import pytest
+
+
+@pytest.fixture
+def sequencer(rc):
+    # Секвенсер без потока: время двигает update(dt), запуски пишутся в fired.
+    # У каждого шага одна пустая группа ударов на тике 0
+    sequencer = rc.Sequencer(120, threaded=False)
+    sequencer.prepare = lambda index: [(0, np.zeros(0, dtype=np.int32), np.zeros(0, dtype=np.float32),
+                                        np.zeros(0, dtype=np.int8))]
+    sequencer.fired = []
+    sequencer.on_step = lambda step, bar, due, triggers, tick: sequencer.fired.append((bar, step, due))
+    sequencer.start()
+    return sequencer
+
+
+def test_steps_fire_on_schedule(sequencer):
+    sequencer.update(0.0)
+    for _ in range(40):
+        sequencer.update(sequencer.step_time / 4)
+    steps = [step for _, step, _ in sequencer.fired]
+    assert steps == list(range(11))
+    assert [due for _, _, due in sequencer.fired] == pytest.approx(
+        [step * sequencer.step_time for step in range(11)])
+    assert sequencer.missed_steps == sequencer.caught_up_steps == 0
+
+
+def test_catch_up_after_stall(sequencer):
+    sequencer.update(0.0)
+    # Подвисание на 10 шагов: звучат только последние catch_up опоздавших и
+    # шаг, опоздавший меньше max_late, остальные проходятся без звука
+    sequencer.update(10 * sequencer.step_time + 0.01)
+
+    assert [step for _, step, _ in sequencer.fired] == [0, 8, 9, 10]
+    assert sequencer.missed_steps == 7
+    assert sequencer.caught_up_steps == 2
+    assert sequencer.current_step == 10
+    assert sequencer.steps_done == 11
+
+
+def test_bpm_changes_on_step_boundary(sequencer):
+    sequencer.update(0.0)
+    old = sequencer.step_time
+    sequencer.set_bpm(60)
+    # Уже идущий шаг доигрывает в старом темпе, новый начинается с границы
+    assert sequencer.step_time == old
+    while len(sequencer.fired) < 4:
+        sequencer.update(0.01)
+
+    dues = [due for _, _, due in sequencer.fired]
+    assert dues == pytest.approx([0.0, old, old + 0.25, old + 0.5])
+    assert sequencer.step_time == pytest.approx(0.25)
+    assert sequencer.missed_steps == 0
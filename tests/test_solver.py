@@ -0,0 +1,55 @@
+import pytest
+
+
+@pytest.fixture
+def city(rc, game):
+    # 8 зданий, у каждого второго цепочка с тремя молчащими тактами и 32-ми:
+    # песня из 4 тактов, и большая её часть тише одного такта
+    game.clear_city()
+    game.set_bpm(120)
+    for i in range(8):
+        building = game.add_building(i, 0, rc.BUILDING_TYPES[i % len(rc.BUILDING_TYPES)])
+        building.volume = 0.3 + 0.05 * i
+        game.building_changed(building)
+        if i % 2:
+            game.set_chain(building, [(32, 0b1001 << 4 | 1)] + [(rc.STEPS_PER_BAR, 0)] * 3)
+    game.timeline.refresh()
+    assert game.timeline.bars == 4
+    return game
+
+
+def level(target_buildings=8, required_bpm=None, max_volume=None):
+    return {"target_buildings": target_buildings, "required_bpm": required_bpm,
+            "max_volume": max_volume}
+
+
+def test_solver_sees_what_meter_sees(rc, city):
+    # Без целей подсказка ничего не меняет, а её уровень - уровень измерителя
+    hint = rc.solve_level(level(), city.timeline, city.sequencer.bpm)
+    assert hint["add"] == {} and hint["cap"] is None and hint["bpm"] == 120
+    assert hint["level"] == pytest.approx(city.meter.level(city.timeline), rel=1e-6)
+
+
+def test_solver_hint_passes_the_meter(rc, city):
+    target = 0.7 * city.meter.level(city.timeline)
+    hint = rc.solve_level(level(10, max_volume=target), city.timeline, city.sequencer.bpm)
+    assert hint is not None and sum(hint["add"].values()) == 2
+
+    # Применяем подсказку - измеритель показывает предсказанный уровень
+    city.set_bpm(hint["bpm"])
+    for slot in hint["quieter"].tolist():
+        building = city.buildings.view(slot)
+        building.volume = hint["cap"]
+        city.building_changed(building)
+    col = 8
+    for name, count in hint["add"].items():
+        for _ in range(count):
+            building = city.add_building(col, 0, name)
+            building.volume = hint["new_volume"]
+            city.building_changed(building)
+            col += 1
+    city.timeline.refresh()
+
+    measured = city.meter.level(city.timeline)
+    assert measured == pytest.approx(hint["level"], rel=1e-5)
+    assert measured <= target + 1e-6
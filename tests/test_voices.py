@@ -0,0 +1,52 @@
+import pytest
+
+
+@pytest.fixture
+def sound(rc):
+    # Секунда тишины: пока идёт тест, голос звучит. Каналы общие - после
+    # теста глушим их
+    rate, size, channels = rc.pygame.mixer.get_init()
+    yield rc.pygame.mixer.Sound(buffer=bytes(rate * channels * abs(size) // 8))
+    rc.pygame.mixer.stop()
+
+
+def test_owner_keeps_tail_on_second_channel(rc, sound):
+    voices = rc.VoiceManager(budget=4)
+    for _ in range(3):
+        voices.play(0, "bass", sound, 0.7)
+
+    # Второй удар не обрывает первый, третий перезапускает свой старый голос
+    assert len(voices.channel_of[0]) == rc.OWNER_VOICES
+    assert voices.active() == rc.OWNER_VOICES
+    assert voices.stolen == voices.dropped == 0
+
+
+def test_steals_oldest_voice(rc, sound):
+    voices = rc.VoiceManager(budget=2, steal="oldest")
+    voices.play(0, "kick", sound, 0.7)
+    voices.play(1, "kick", sound, 0.7)
+    voices.play(2, "kick", sound, 0.7)
+
+    assert voices.stolen == 1
+    assert 0 not in voices.channel_of
+    assert voices.channel_of[2] == [0]
+
+
+def test_steals_quietest_voice(rc, sound):
+    voices = rc.VoiceManager(budget=2, steal="quietest")
+    voices.play(0, "kick", sound, 0.9)
+    voices.play(1, "kick", sound, 0.1)
+    voices.play(2, "kick", sound, 0.7)
+
+    assert 1 not in voices.channel_of
+    assert voices.channel_of[2] == [1]
+
+
+def test_drops_when_stealing_is_off(rc, sound):
+    voices = rc.VoiceManager(budget=2, steal=None)
+    for slot in range(3):
+        voices.play(slot, "kick", sound, 0.7)
+
+    assert voices.dropped == 1
+    assert voices.triggers == 3
+    assert 2 not in voices.channel_of